@@ -2,6 +2,11 @@
 # Copyright (C) 2021, MediaMonks B.V. All rights reserved.
 
 # This is to maintain a list of publically available HLS examples that can be easily referred to.
+#
+# Local mirrors of streams (made with download-hls.py) can be referred to by their names as well,
+# when they are served by our origin (see `origin.py`).
+
+import os
 
 HLS = {
 	"apple1": "https://devstreaming-cdn.apple.com/videos/streaming/examples/bipbop_4x3/bipbop_4x3_variant.m3u8",
@@ -10,8 +15,34 @@ HLS = {
 	"elephant": "https://cdn.theoplayer.com/video/elephants-dream/playlist.m3u8"
 }
 
-def resolve_hls(url_or_alias):	
+# The directory with local mirrors, each in a subdirectory named after the mirror.
+MIRRORS_DIR = os.environ.get('HLSED_MIRRORS_DIR')
+# Where the mirrors are served, when it's not our own app (e.g. a standalone `origin.py`).
+MIRRORS_URL = os.environ.get('HLSED_MIRRORS_URL')
+
+def mirrors():
+	"""The names of the local mirrors available, i.e. subdirectories of MIRRORS_DIR with 'index.m3u8'."""
+	if not MIRRORS_DIR or not os.path.isdir(MIRRORS_DIR):
+		return []
+	return sorted(filter(
+		lambda name: os.path.isfile(os.path.join(MIRRORS_DIR, name, 'index.m3u8')),
+		os.listdir(MIRRORS_DIR)
+	))
+
+def resolve_hls(url_or_alias, mirrors_url = None):	
+	
+	"""
+	The URL of a well-known example or a local mirror with the given name, or `url_or_alias` itself.
+	Mirrors are served at `mirrors_url` (or MIRRORS_URL when set) and take precedence over the examples,
+	so the same alias can be used offline.
+	"""
+	
 	# We could check if url_or_alias is not a full URL first, but seems easier to look it up in our list instead.
+	mirrors_url = MIRRORS_URL or mirrors_url
+	if mirrors_url and MIRRORS_DIR and '/' not in url_or_alias:
+		if os.path.isfile(os.path.join(MIRRORS_DIR, url_or_alias, 'index.m3u8')):
+			return mirrors_url.rstrip('/') + '/' + url_or_alias + '/index.m3u8'
+	
 	url = HLS.get(url_or_alias.lower())
 	if url:
 		return url
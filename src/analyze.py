@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Audits a corpus of playlists: segment durations versus EXT-X-TARGETDURATION, discontinuities, key rotations
+# and bitrate ladders. Playlists are parsed by a pool of processes (via the m3u module), the per-segment values
+# are collected into NumPy arrays and the statistics are calculated on those, so it's fast enough for corpora
+# with hundreds of thousands of segments. NumPy is required.
+#
+# Examples:
+#
+#	analyze.py /path/to/mirrors
+#	analyze.py -l urls.txt --follow-variants -o report.json
+#	analyze.py /path/to/mirrors --csv playlists > playlists.csv
+
+import aliases
+import argparse
+import csv
+import json
+import m3u
+import multiprocessing
+import os
+import requests
+import sys
+import urlparse
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# The per-playlist columns, in the order they are written in CSV.
+PLAYLIST_COLUMNS = [
+	'source', 'segments', 'total_duration', 'target_duration',
+	'mean_duration', 'std_duration', 'min_duration', 'p50_duration', 'p95_duration', 'max_duration',
+	'mean_drift', 'over_target', 'max_over_target', 'discontinuities', 'key_rotations', 'keys',
+	'mean_bitrate', 'max_bitrate'
+]
+
+LADDER_COLUMNS = [
+	'source', 'variants', 'min_bandwidth', 'max_bandwidth', 'max_step_ratio', 'resolutions', 'codecs'
+]
+
+OUTLIER_COLUMNS = ['source', 'index', 'uri', 'duration', 'target_duration', 'drift', 'reason']
+
+class Segments:
+
+	"""
+	The per-segment values of a media playlist as NumPy arrays of the same length:
+
+	- durations: the durations from EXTINF tags, seconds;
+	- discontinuities: True for segments following EXT-X-DISCONTINUITY;
+	- key_changes: True for segments using a different EXT-X-KEY than the previous one (the first one counts
+	  if it's encrypted);
+	- bitrates: the values of EXT-X-BITRATE (kbps) or NaN.
+	"""
+
+	def __init__(self, playlist):
+
+		durations = []
+		discontinuities = []
+		key_changes = []
+		bitrates = []
+		keys = set()
+
+		nan = float('nan')
+		previous_key = None
+		for u in playlist.uris:
+			# Walking the tags once instead of looking up every one of them.
+			duration = 0
+			discontinuity = False
+			key = None
+			bitrate = nan
+			for t in u.tags:
+				name = t.name
+				if name == 'EXTINF':
+					duration = float(t.values[0])
+				elif name == 'EXT-X-DISCONTINUITY':
+					discontinuity = True
+				elif name == 'EXT-X-KEY':
+					key = t
+				elif name == 'EXT-X-BITRATE':
+					bitrate = float(t.values[0])
+			durations.append(duration)
+			discontinuities.append(discontinuity)
+			# Keys are shared by all the segments they apply to, see m3u.Playlist.
+			key_changes.append(key is not previous_key and not _is_clear_key(key, previous_key))
+			if key is not None and not _is_clear_key(key, None):
+				keys.add(key.text())
+			previous_key = key
+			bitrates.append(bitrate)
+
+		self.uris = map(lambda u: u.uri, playlist.uris)
+		self.durations = numpy.array(durations, dtype = numpy.float64)
+		self.discontinuities = numpy.array(discontinuities, dtype = numpy.bool_)
+		self.key_changes = numpy.array(key_changes, dtype = numpy.bool_)
+		self.bitrates = numpy.array(bitrates, dtype = numpy.float64)
+		self.keys = len(keys)
+
+def _is_clear_key(key, previous_key):
+	# Switching between no key and METHOD=NONE is not a rotation.
+	def clear(k):
+		return k is None or k.attributes.get('METHOD') is None or k.attributes['METHOD'].value.upper() == 'NONE'
+	return clear(key) and clear(previous_key)
+
+def media_stats(source, playlist, segments):
+
+	"""A dictionary with PLAYLIST_COLUMNS for the given media playlist and its Segments."""
+
+	d = segments.durations
+	target = playlist.target_duration()
+
+	stats = dict.fromkeys(PLAYLIST_COLUMNS)
+	stats.update({
+		'source': source,
+		'segments': len(d),
+		'target_duration': target,
+		'discontinuities': int(segments.discontinuities.sum()),
+		'key_rotations': int(segments.key_changes.sum()),
+		'keys': segments.keys
+	})
+	if len(d) == 0:
+		return stats
+
+	p50, p95 = numpy.percentile(d, [50, 95])
+	# EXTINF durations rounded to the nearest integer must not exceed the target duration, see RFC 8216, 4.3.3.1.
+	over = numpy.floor(d + 0.5) > target
+	stats.update({
+		'total_duration': float(d.sum()),
+		'mean_duration': float(d.mean()),
+		'std_duration': float(d.std()),
+		'min_duration': float(d.min()),
+		'p50_duration': float(p50),
+		'p95_duration': float(p95),
+		'max_duration': float(d.max()),
+		'mean_drift': float(d.mean() - target),
+		'over_target': int(over.sum()),
+		'max_over_target': float(max(0, (d - target).max()))
+	})
+
+	bitrates = segments.bitrates[~numpy.isnan(segments.bitrates)]
+	if len(bitrates):
+		stats['mean_bitrate'] = float(bitrates.mean())
+		stats['max_bitrate'] = float(bitrates.max())
+
+	return stats
+
+def media_outliers(source, playlist, segments, short_ratio):
+
+	"""
+	Segments that are longer than the target duration (after rounding) or shorter than `short_ratio` of it
+	(not counting the last segment and the ones before discontinuities, which are often shorter).
+	"""
+
+	d = segments.durations
+	target = playlist.target_duration()
+	if len(d) == 0 or target <= 0:
+		return []
+
+	long = numpy.floor(d + 0.5) > target
+	short = d < target * short_ratio
+	short[-1] = False
+	short[:-1] &= ~segments.discontinuities[1:]
+
+	result = []
+	for i in numpy.flatnonzero(long | short):
+		result.append({
+			'source': source,
+			'index': int(i),
+			'uri': segments.uris[i],
+			'duration': float(d[i]),
+			'target_duration': target,
+			'drift': float(d[i] - target),
+			'reason': 'long' if long[i] else 'short'
+		})
+	return result
+
+def ladder_stats(source, playlist):
+
+	"""A dictionary with LADDER_COLUMNS for the given master playlist."""
+
+	variants = []
+	for u in playlist.uris:
+		inf = u.tag_by_name('EXT-X-STREAM-INF')
+		if inf is None:
+			continue
+		attrs = inf.attributes
+		bandwidth = attrs.get('BANDWIDTH')
+		resolution = attrs.get('RESOLUTION')
+		codecs = attrs.get('CODECS')
+		variants.append((
+			bandwidth.value if isinstance(bandwidth, m3u.Tag.NumberValue) else 0,
+			resolution.text() if isinstance(resolution, m3u.Tag.ResolutionValue) else '',
+			codecs.value if codecs is not None else ''
+		))
+
+	stats = dict.fromkeys(LADDER_COLUMNS)
+	stats.update({ 'source': source, 'variants': len(variants) })
+	if not variants:
+		return stats
+
+	bandwidths = numpy.unique(numpy.array(map(lambda v: v[0], variants), dtype = numpy.float64))
+	steps = bandwidths[1:] / numpy.maximum(bandwidths[:-1], 1)
+	stats.update({
+		'min_bandwidth': int(bandwidths.min()),
+		'max_bandwidth': int(bandwidths.max()),
+		'max_step_ratio': float(steps.max()) if len(steps) else None,
+		'resolutions': ' '.join(sorted(set(filter(None, map(lambda v: v[1], variants))))),
+		'codecs': ' '.join(sorted(set(filter(None, map(lambda v: v[2], variants)))))
+	})
+	return stats
+
+def _is_url(source):
+	return urlparse.urlparse(source).scheme in ('http', 'https')
+
+def read_source(source):
+	"""The text of the playlist at the given path or URL."""
+	if _is_url(source):
+		r = requests.get(source, timeout = 30)
+		r.raise_for_status()
+		return r.text
+	with open(source, 'rb') as f:
+		return f.read().decode('utf_8')
+
+def analyze_source(task):
+
+	"""
+	Analyzes a single playlist, this is what the worker processes run. Returns a dictionary with 'source'
+	and either 'media' (media_stats() and 'outliers') or 'master' (ladder_stats() and 'variants', the absolute URLs
+	of the variant playlists), or 'error'.
+	"""
+
+	source, short_ratio = task
+	try:
+		playlist = m3u.Playlist(read_source(source))
+		if playlist.is_master_playlist:
+			variants = []
+			if _is_url(source):
+				variants = map(lambda u: urlparse.urljoin(source, u.uri), playlist.uris)
+			return { 'source': source, 'master': ladder_stats(source, playlist), 'variants': variants }
+		else:
+			segments = Segments(playlist)
+			return {
+				'source': source,
+				'media': media_stats(source, playlist, segments),
+				'outliers': media_outliers(source, playlist, segments, short_ratio),
+				'durations': segments.durations
+			}
+	except Exception as e:
+		return { 'source': source, 'error': "%s: %s" % (e.__class__.__name__, e) }
+
+def find_sources(inputs, url_lists = []):
+
+	"""The paths of all the playlists in the given directories, files or URLs (aliases are resolved as well)."""
+
+	sources = []
+	for path in url_lists:
+		with open(path) as f:
+			inputs = list(inputs) + filter(lambda l: l and not l.startswith('#'), map(lambda l: l.strip(), f))
+	for i in inputs:
+		if os.path.isdir(i):
+			for dirpath, dirnames, filenames in os.walk(i):
+				dirnames.sort()
+				for name in sorted(filenames):
+					if name.endswith('.m3u8') or name.endswith('.m3u'):
+						sources.append(os.path.join(dirpath, name))
+		elif os.path.isfile(i):
+			sources.append(i)
+		else:
+			sources.append(aliases.resolve_hls(i))
+	return sources
+
+def analyze(sources, processes = None, short_ratio = 0.5, follow_variants = False, max_outliers = 100):
+
+	"""
+	Analyzes all the given playlists (paths or URLs) with a pool of `processes` (the number of CPUs by default)
+	and returns a report: a dictionary with 'summary', 'playlists', 'ladders', 'outliers' and 'errors'.
+	"""
+
+	if numpy is None:
+		raise ImportError("NumPy is required for the analysis, please install it: pip install numpy")
+
+	playlists = []
+	ladders = []
+	outliers = []
+	errors = []
+	durations = []
+
+	seen = set()
+	pool = multiprocessing.Pool(processes)
+	try:
+		while sources:
+			tasks = []
+			for s in sources:
+				if s not in seen:
+					seen.add(s)
+					tasks.append((s, short_ratio))
+			sources = []
+			chunksize = max(1, len(tasks) // ((processes or multiprocessing.cpu_count()) * 4))
+			for result in pool.imap_unordered(analyze_source, tasks, chunksize):
+				if 'error' in result:
+					errors.append({ 'source': result['source'], 'error': result['error'] })
+				elif 'master' in result:
+					ladders.append(result['master'])
+					if follow_variants:
+						sources += result['variants']
+				else:
+					playlists.append(result['media'])
+					outliers += result['outliers']
+					durations.append(result['durations'])
+	finally:
+		pool.terminate()
+		pool.join()
+
+	playlists.sort(key = lambda p: p['source'])
+	ladders.sort(key = lambda l: l['source'])
+	outliers.sort(key = lambda o: (-abs(o['drift']), o['source'], o['index']))
+	errors.sort(key = lambda e: e['source'])
+
+	summary = {
+		'playlists': len(playlists),
+		'master_playlists': len(ladders),
+		'errors': len(errors),
+		'segments': sum(map(lambda p: p['segments'], playlists)),
+		'outliers': len(outliers),
+		'discontinuities': sum(map(lambda p: p['discontinuities'], playlists)),
+		'key_rotations': sum(map(lambda p: p['key_rotations'], playlists)),
+		'playlists_over_target': len(filter(lambda p: p['over_target'], playlists))
+	}
+	if durations:
+		d = numpy.concatenate(durations)
+		if len(d):
+			p50, p95, p99 = numpy.percentile(d, [50, 95, 99])
+			summary.update({
+				'total_duration': float(d.sum()),
+				'mean_duration': float(d.mean()),
+				'p50_duration': float(p50),
+				'p95_duration': float(p95),
+				'p99_duration': float(p99),
+				'max_duration': float(d.max())
+			})
+	drifts = numpy.array(filter(lambda x: x is not None, map(lambda p: p['mean_drift'], playlists)))
+	if len(drifts):
+		summary['mean_drift'] = float(drifts.mean())
+		summary['max_abs_drift'] = float(numpy.abs(drifts).max())
+
+	return {
+		'summary': summary,
+		'playlists': playlists,
+		'ladders': ladders,
+		'outliers': outliers[:max_outliers] if max_outliers >= 0 else outliers,
+		'errors': errors
+	}
+
+def write_csv(f, rows, columns):
+	writer = csv.writer(f)
+	writer.writerow(columns)
+	for row in rows:
+		writer.writerow(map(lambda c: _csv_value(row.get(c)), columns))
+
+def _csv_value(v):
+	if v is None:
+		return ''
+	if isinstance(v, unicode):
+		return v.encode('utf_8')
+	if isinstance(v, float):
+		return "%.6g" % (v,)
+	return v
+
+def main():
+
+	parser = argparse.ArgumentParser(description = "Analyzes a corpus of HLS playlists.")
+	parser.add_argument(
+		"inputs", nargs = "*",
+		help = "Directories (searched for .m3u8 files recursively), playlist files, URLs or aliases."
+	)
+	parser.add_argument(
+		"-l", "--list", action = "append", default = [],
+		help = "A file with more inputs, one per line."
+	)
+	parser.add_argument(
+		"-j", "--processes", type = int, default = None,
+		help = "The number of worker processes, the number of CPUs by default."
+	)
+	parser.add_argument(
+		"--follow-variants", action = "store_true",
+		help = "Analyze the variants of master playlists given via URLs as well."
+	)
+	parser.add_argument(
+		"--short", type = float, default = 0.5,
+		help = "Segments shorter than this fraction of the target duration are reported as outliers (0.5 by default)."
+	)
+	parser.add_argument(
+		"--max-outliers", type = int, default = 100,
+		help = "How many outliers (the ones differing the most from the target duration) to report, -1 for all."
+	)
+	parser.add_argument(
+		"--csv", choices = ['playlists', 'ladders', 'outliers', 'errors'],
+		help = "Output the given table as CSV instead of the whole report as JSON."
+	)
+	parser.add_argument("-o", "--output", help = "Where to write the report, stdout by default.")
+	args = parser.parse_args()
+
+	if numpy is None:
+		sys.exit("NumPy is required for the analysis, please install it: pip install numpy")
+
+	sources = find_sources(args.inputs, args.list)
+	if not sources:
+		parser.error("No playlists were found")
+
+	report = analyze(
+		sources,
+		processes = args.processes,
+		short_ratio = args.short,
+		follow_variants = args.follow_variants,
+		max_outliers = args.max_outliers
+	)
+
+	f = open(args.output, 'wb') if args.output else sys.stdout
+	try:
+		if args.csv:
+			columns = {
+				'playlists': PLAYLIST_COLUMNS,
+				'ladders': LADDER_COLUMNS,
+				'outliers': OUTLIER_COLUMNS,
+				'errors': ['source', 'error']
+			}[args.csv]
+			write_csv(f, report[args.csv], columns)
+		else:
+			json.dump(report, f, indent = 1, sort_keys = True)
+			f.write("\n")
+	finally:
+		if f is not sys.stdout:
+			f.close()
+
+	s = report['summary']
+	sys.stderr.write(
+		"%d playlists (%d master), %d segments, %d outliers, %d errors\n"
+		% (s['playlists'], s['master_playlists'], s['segments'], s['outliers'], s['errors'])
+	)
+
+if __name__ == '__main__':
+	main()
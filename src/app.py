@@ -1,15 +1,32 @@
 # HLS tools.
 # Copyright (C) 2021, MediaMonks B.V. All rights reserved.
 
-from flask import Flask, request, url_for, make_response, abort, render_template
+from flask import Flask, request, url_for, make_response, abort, render_template, g
+from werkzeug.middleware.proxy_fix import ProxyFix
 import aliases
+import cache
+import clock
+import collections
 import hlsed
+import hmac
+import json
 import m3u
+import metrics
+import multiprocessing.pool
+import origin
+import os
+import profiling
+import requests
+import sessions
+import threading
 import time
+import upstream
 import urllib
 import urlparse
+import warmup
 
 app = Flask(__name__)
+app.register_blueprint(origin.blueprint, url_prefix = '/origin')
 
 # Parameter names for our main endpoint, to be able to rename them in one place and let them show up in help.
 URL_ARG = "url"
@@ -18,6 +35,65 @@ EVENT_DURATION_ARG = "duration"
 AD_INTERVAL_ARG = "ad_interval"
 AD_DURATION_ARG = "ad_duration"
 AD_STYLE_ARG = "ad_style"
+PROXY_SEGMENTS_ARG = "proxy_segments"
+PDT_INTERVAL_ARG = "pdt_interval"
+# The virtual clock of the event (see `clock`): how fast it runs, how far ahead it is and when it stops.
+SPEED_ARG = "speed"
+TIME_OFFSET_ARG = "time_offset"
+PAUSE_AT_ARG = "pause_at"
+# The signature of the URLs passed via /v1/segment, see upstream.segment_signature().
+SIGNATURE_ARG = "sig"
+# Refers to a session created via /v1/sessions instead of all the above.
+SESSION_ARG = "session"
+
+# All the parameters defining a session.
+SESSION_ARGS = [
+	URL_ARG, START_TIME_ARG, EVENT_DURATION_ARG, AD_INTERVAL_ARG, AD_DURATION_ARG, AD_STYLE_ARG, PROXY_SEGMENTS_ARG,
+	PDT_INTERVAL_ARG, SPEED_ARG, TIME_OFFSET_ARG, PAUSE_AT_ARG
+]
+
+# Profiling of a single request can be requested either via this parameter or the header, 
+# with 'sample' or 'cprofile' as the value, see the `profiling` module.
+PROFILE_ARG = "profile"
+PROFILE_HEADER = "X-Hlsed-Profile"
+
+# Only the clients with these addresses (comma-separated) can request profiling. Nobody by default.
+# Behind a reverse proxy every request comes from the address of the proxy, so set TRUSTED_PROXIES as well
+# (or rely on the token only).
+PROFILE_ALLOWED_ADDRS = filter(None, os.environ.get('HLSED_PROFILE_ALLOW', '').split(','))
+# Or the ones knowing this secret passed via the below header. 
+PROFILE_TOKEN = os.environ.get('HLSED_PROFILE_TOKEN')
+PROFILE_TOKEN_HEADER = "X-Hlsed-Profile-Token"
+# When set, then profiles are saved into this directory rather than returned instead of the playlist.
+PROFILE_DIR = os.environ.get('HLSED_PROFILE_DIR')
+
+# A directory for the caches shared by all the worker processes (see `serve.py`), if any.
+CACHE_DIR = os.environ.get('HLSED_CACHE_DIR')
+# How long (seconds) transformed playlists can be reused for identical requests, 0 to disable.
+RESPONSE_TTL = float(os.environ.get('HLSED_RESPONSE_TTL', 1))
+
+# The maximum number of sessions in a single batch request, and the number of threads handling them.
+BATCH_MAX_SESSIONS = int(os.environ.get('HLSED_BATCH_MAX_SESSIONS', 1000))
+BATCH_THREADS = int(os.environ.get('HLSED_BATCH_THREADS', 16))
+
+# The number of reverse proxies (like nginx) in front of us adding the address of the client to X-Forwarded-For.
+# Only when it's set, the addresses of the clients are taken from there. None by default.
+TRUSTED_PROXIES = int(os.environ.get('HLSED_TRUSTED_PROXIES', 0))
+
+if TRUSTED_PROXIES > 0:
+	app.wsgi_app = ProxyFix(app.wsgi_app, x_for = TRUSTED_PROXIES)
+
+upstream.configure_cache(CACHE_DIR)
+
+if CACHE_DIR:
+	response_cache = cache.TieredCache(cache.MemoryCache(), cache.DiskCache(os.path.join(CACHE_DIR, 'responses')))
+else:
+	response_cache = cache.TieredCache(cache.MemoryCache())
+
+session_registry = sessions.Registry(
+	lambda args: EventifyParams(args), 
+	cache.DiskCache(os.path.join(CACHE_DIR, 'sessions')) if CACHE_DIR else None
+)
 
 @app.route('/')
 def help():
@@ -29,11 +105,41 @@ def help():
 		event_duration_arg = EVENT_DURATION_ARG,
 		ad_interval_arg = AD_INTERVAL_ARG,
 		ad_duration_arg = AD_DURATION_ARG,
-		ad_style_arg = AD_STYLE_ARG
+		ad_style_arg = AD_STYLE_ARG,
+		proxy_segments_arg = PROXY_SEGMENTS_ARG,
+		pdt_interval_arg = PDT_INTERVAL_ARG,
+		speed_arg = SPEED_ARG,
+		time_offset_arg = TIME_OFFSET_ARG,
+		pause_at_arg = PAUSE_AT_ARG
 	)
 
-def string_param(name, default = None):
-	v = request.args.get(name)
+@app.before_first_request
+def start_warmup():
+	# For servers other than serve.py (which warms up the aliases before accepting requests), with HLSED_WARM_ALIASES.
+	warmup.start()
+
+@app.before_request
+def before_request():
+	g.started = metrics.clock()
+
+@app.after_request
+def after_request(response):
+	endpoint = request.endpoint or 'unknown'
+	metrics.REQUESTS.inc((endpoint, str(response.status_code)))
+	metrics.REQUEST_SECONDS.observe(metrics.clock() - g.started, (endpoint,))
+	metrics.maybe_flush()
+	return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+	response = make_response(metrics.exposition())
+	response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+	return response
+
+def string_param(name, default = None, args = None):
+	if args is None:
+		args = request.args
+	v = args.get(name)
 	if v:
 		return v
 	else:
@@ -42,8 +148,11 @@ def string_param(name, default = None):
 		else:
 			raise Exception("Parameter '%s' is required" % (name,))
 
-def int_param(name, default = None):
-	return int(string_param(name, default))
+def int_param(name, default = None, args = None):
+	return int(string_param(name, default, args))
+
+def float_param(name, default = None, args = None):
+	return float(string_param(name, default, args))
 
 def url_overriding_scheme(url, scheme):
 	parsed = urlparse.urlparse(url)
@@ -56,71 +165,475 @@ def url_overriding_scheme(url, scheme):
 		fragment = parsed.fragment
 	))
 	
+def url_without_query_param(url, name):
+	parsed = urlparse.urlparse(url)
+	query = filter(lambda p: p[0] != name, urlparse.parse_qsl(parsed.query))
+	return urlparse.urlunparse(urlparse.ParseResult(
+		scheme = parsed.scheme,
+		netloc = parsed.netloc,
+		path = parsed.path,
+		params = parsed.params,
+		query = urllib.urlencode(query),
+		fragment = parsed.fragment
+	))
+
+def profiling_allowed():
+	if request.remote_addr in PROFILE_ALLOWED_ADDRS:
+		return True
+	if PROFILE_TOKEN:
+		token = request.headers.get(PROFILE_TOKEN_HEADER) or ''
+		if isinstance(token, unicode):
+			token = token.encode('utf_8')
+		# In constant time, so the secret cannot be guessed character by character.
+		if hmac.compare_digest(PROFILE_TOKEN, token):
+			return True
+	return False
+
+def profiled(mode, func):
+	
+	if not profiling_allowed():
+		return ("Profiling is not allowed", 403)
+	if mode not in profiling.MODES:
+		return ("Unsupported profiling mode, expected one of: %s" % (", ".join(profiling.MODES)), 400)
+	
+	g.profiling = True
+	response, data, extension = profiling.profile_call(mode, func)
+	
+	name = "proxy-%d-%d%s" % (int(time.time() * 1000), os.getpid(), extension)
+	if PROFILE_DIR:
+		path = os.path.join(PROFILE_DIR, name)
+		with open(path, 'wb') as f:
+			f.write(data)
+		response = make_response(response)
+		response.headers["X-Hlsed-Profile-Path"] = path
+		return response
+	else:
+		response = make_response(data)
+		response.mimetype = "application/octet-stream"
+		response.headers["Content-Disposition"] = "attachment; filename=%s" % (name,)
+		return response
+
 @app.route('/v1/eventify')
 @app.route('/v1/eventify.m3u8') # Chrome on Android apparently relies on the extension instead of the content type!
 def proxy():
+	# Keeping the regular path as short as possible.
+	profile_mode = request.args.get(PROFILE_ARG) or request.headers.get(PROFILE_HEADER)
+	if profile_mode:
+		response = make_response(profiled(profile_mode, _proxy))
+	else:
+		response = make_response(_proxy())
+	
+	# Let's break down the time spent for those checking the requests in the browser.
+	timer = g.get('stage_timer')
+	if timer:
+		response.headers["Server-Timing"] = timer.server_timing(total = metrics.clock() - g.started)
 		
-	try:
+	return response
+
+class EventifyParams:
+	
+	"""
+	The parameters of /v1/eventify taken from the query string or from the given dictionary 
+	(i.e. a session of a batch request).
+	"""
+	
+	def __init__(self, args = None):
 		
-		# Note that we cannot support URLs that are served by us, that would cause a deadlock, 
-		# and thus we don't attempt to make them absolute.
-		playlist_url = aliases.resolve_hls(string_param(URL_ARG))
+		self.url = string_param(URL_ARG, args = args)
 		
-		# Let's force 'https' for our own redirects when not debugging because 
-		# nginx might be using `http` with us. 
-		# TODO: get the scheme of the original request from the proxy.
-		if app.debug:
-			proxy_url = request.url
-		else:
-			proxy_url = url_overriding_scheme(request.url, "https")
-
 		# Let's use the current server time as a reference when the playlist is accessed withot one.
-		start_time = int_param(START_TIME_ARG, int(time.time()))
-		proxy_url = hlsed.url_overriding_query_param(proxy_url, START_TIME_ARG, str(start_time))
+		self.start_time = int_param(START_TIME_ARG, int(time.time()), args)
+		
+		self.event_duration = int_param(EVENT_DURATION_ARG, 60, args)
+		self.ad_interval = int_param(AD_INTERVAL_ARG, 0, args)
+		self.ad_duration = int_param(AD_DURATION_ARG, 30, args)
+		self.ad_style = int_param(AD_STYLE_ARG, hlsed.CUE_STYLE_IN_OUT, args)
+		self.proxy_segments = bool(int_param(PROXY_SEGMENTS_ARG, 0, args))
+		self.pdt_interval = max(0, int_param(PDT_INTERVAL_ARG, 0, args))
+		
+		pause_at = string_param(PAUSE_AT_ARG, '', args)
+		self.clock = clock.Clock(
+			self.start_time,
+			speed = float_param(SPEED_ARG, 1, args),
+			offset = int_param(TIME_OFFSET_ARG, 0, args),
+			pause_at = int(pause_at) if pause_at else None
+		)
 
-		event_duration = int_param(EVENT_DURATION_ARG, 60), 
-		ad_interval = int_param(AD_INTERVAL_ARG, 0)
-		ad_duration = int_param(AD_DURATION_ARG, 30)
-		ad_style = int_param(AD_STYLE_ARG, hlsed.CUE_STYLE_IN_OUT)
+def external_url(url):
+	# Let's force 'https' for our own redirects when not debugging because 
+	# nginx might be using `http` with us. 
+	# TODO: get the scheme of the original request from the proxy.
+	if app.debug:
+		return url
+	else:
+		return url_overriding_scheme(url, "https")
+
+def resolve_playlist_url(url_or_alias):
+	# Note that we cannot support arbitrary URLs that are served by us, so we don't attempt to make them absolute.
+	# Local mirrors are fine though as long as the server handles requests concurrently (like `serve.py` does), 
+	# otherwise the below would deadlock.
+	return aliases.resolve_hls(url_or_alias, mirrors_url = url_for('origin.index', _external = True))
+
+class UpstreamError(Exception):
+	pass
+
+def eventify(playlist_url, proxy_url, params, segment_proxy_url = None, timer = None, use_cache = True):
 	
-		try:
-			playlist = hlsed.download_and_rebase(playlist_url, proxy_url)
-		except Exception as e:
-			return ("Could not download or parse the given playlist: %s." % (e), 400)
-		
-		if playlist.is_master_playlist:
-			# Not much things to do for the master playlist yet.
-			pass
-		else:
-			current_time = time.time()
-			hlsed.event_to_vod(
-				playlist, 
-				event_duration = event_duration,
-				ref_time = start_time, 
+	"""
+	Returns the text of the playlist at `playlist_url` transformed according to `params` (EventifyParams),
+	with its variants (if it's a master playlist) proxied via `proxy_url`, which is also the key of the response cache.
+	Raises UpstreamError when the playlist cannot be downloaded or parsed, upstream.Overloaded when there are
+	too many requests to its host already.
+	
+	This does not depend on the current request, so can be called from other threads.
+	"""
+	
+	if timer is None:
+		timer = metrics.StageTimer()
+	
+	# Note that the proxy URL contains all our parameters in the normalized order, so it's a good key.
+	if use_cache and RESPONSE_TTL > 0:
+		text = response_cache.get(proxy_url)
+		metrics.record_cache('response', text is not None)
+		if text is not None:
+			timer.lap('response_cache', 'hit')
+			return text
+	
+	try:
+		# The parsed playlist is shared with other requests, we're working with our own view of it.
+		snapshot, hit = upstream.get_snapshot(playlist_url, timer)
+		playlist = snapshot.view()
+	except upstream.Overloaded:
+		raise
+	except Exception as e:
+		raise UpstreamError("Could not download or parse the given playlist: %s." % (e))
+	
+	# All the transformations are applied in a single pass, which stops at the end of the window.
+	stages = [hlsed.RebaseStage(playlist_url, proxy_url, segment_proxy_url)]
+	if playlist.is_master_playlist:
+		# Not much things to do for the master playlist yet.
+		pass
+	else:
+		current_time = params.clock.now()
+		stages.append(hlsed.UpstreamCuesStage(params.event_duration, params.start_time, current_time))
+		stages.append(hlsed.EventToVODStage(
+			event_duration = params.event_duration,
+			ref_time = params.start_time, 
+			current_time = current_time,
+			program_date_time = True,
+			logger = app.logger,
+			program_date_time_interval = params.pdt_interval
+		))
+		if params.ad_interval > 0 and params.ad_duration > 0:
+			stages.append(hlsed.AdCuesStage(
+				event_duration = params.event_duration,
+				ref_time = params.start_time, 
 				current_time = current_time,
-				program_date_time = True,
-				logger = app.logger
-			)
-			if ad_interval > 0 and ad_duration > 0:
-				hlsed.insert_ad_cues(
-					playlist,
-					event_duration = event_duration,
-					ref_time = start_time, 
-					current_time = current_time,
-					time_between_ads = ad_interval,
-					ad_duration = ad_duration, 
-					style = ad_style,
-					logger = app.logger
-				)
+				time_between_ads = params.ad_interval,
+				ad_duration = params.ad_duration, 
+				style = params.ad_style
+			))
+	hlsed.Pipeline(stages).apply(playlist, timer)
+	
+	text = playlist.text()
+	timer.lap('render')
+	timer.observe()
+	metrics.UPSTREAM_BYTES_OUT.inc((upstream.host_of(playlist_url),), len(text))
+	
+	if use_cache and RESPONSE_TTL > 0:
+		# The window moves faster when the clock does.
+		response_cache.set(proxy_url, text, params.clock.real_seconds(RESPONSE_TTL))
+	
+	return text
 
+def _proxy():
+	
+	if SESSION_ARG in request.args:
+		return _session_proxy(request.args[SESSION_ARG])
+		
+	try:
+		params = EventifyParams()
+		playlist_url = resolve_playlist_url(params.url)
+		
+		proxy_url = external_url(request.url)
+		if PROFILE_ARG in request.args:
+			# We don't want every variant of a master playlist to be profiled.
+			proxy_url = url_without_query_param(proxy_url, PROFILE_ARG)
+		proxy_url = hlsed.url_overriding_query_param(proxy_url, START_TIME_ARG, str(params.start_time))
+		
+		if params.proxy_segments:
+			segment_proxy_url = external_url(url_for('segment', _external = True))
+		else:
+			segment_proxy_url = None
+	
+		timer = metrics.StageTimer()
+		g.stage_timer = timer
+		
+		# (Not using the cache when profiling, we want to see the work being done.)
+		text = eventify(
+			playlist_url, proxy_url, params, segment_proxy_url, 
+			timer = timer, 
+			use_cache = not g.get('profiling')
+		)
+		
+	except UpstreamError as e:
+		return (str(e), 400)
+	except upstream.Overloaded as e:
+		return overloaded_response(e)
 	except Exception as e:
 		app.logger.error("Error: %s" % (e))
 		return ("Unable to proxy: %s." % (e), 400)
-		
-	text = playlist.text()
+	
 	if app.debug:
 		app.logger.debug(text)
+	
+	return playlist_response(text, params.clock)
+
+def session_url(id):
+	return external_url(url_for('proxy', _external = True, **{ SESSION_ARG: id }))
+
+def _session_proxy(id):
+	
+	session = session_registry.get(id)
+	if session is None:
+		return ("Unknown session, it might have expired", 404)
+	
+	# The master playlist of the session unless it's one of its variants.
+	playlist_url = request.args.get(URL_ARG) or resolve_playlist_url(session.params.url)
+	if session.params.proxy_segments:
+		segment_proxy_url = external_url(url_for('segment', _external = True))
+	else:
+		segment_proxy_url = None
+	
+	timer = metrics.StageTimer()
+	g.stage_timer = timer
+	
+	try:
+		timeline = session.timeline(playlist_url, session_url(session.id), segment_proxy_url, timer)
+	except upstream.Overloaded as e:
+		return overloaded_response(e)
+	except Exception as e:
+		return ("Could not download or parse the given playlist: %s." % (e), 400)
+	timer.lap('timeline')
+	
+	text = session.render(timeline, session.params.clock.now())
+	timer.lap('render', 'window')
+	timer.observe()
+	metrics.UPSTREAM_BYTES_OUT.inc((upstream.host_of(playlist_url),), len(text))
+	
+	return playlist_response(text, session.params.clock)
+
+@app.route('/v1/sessions', methods = ['POST'])
+def create_session():
+	
+	"""
+	Creates a session with the parameters of /v1/eventify passed either as a JSON object or as form fields. 
+	Returns a JSON object with the ID of the session and the URL of its master playlist.
+	"""
+	
+	body = request.get_json(silent = True)
+	if body is None:
+		body = request.values
+	if not isinstance(body, dict) and not hasattr(body, 'getlist'):
+		return ("Expected a JSON object or form fields", 400)
+	
+	args = {}
+	for name in SESSION_ARGS:
+		v = body.get(name)
+		if v is not None and v != '':
+			args[name] = unicode(v)
+	try:
+		params = EventifyParams(args)
+	except Exception as e:
+		return ("Invalid session: %s" % (e,), 400)
+	# The same session should not be different depending on the time it was created at.
+	args[START_TIME_ARG] = unicode(params.start_time)
+	
+	session = session_registry.create(args)
+	response = make_response(json.dumps({ 'id': session.id, 'url': session_url(session.id) }))
+	response.mimetype = "application/json"
+	return response
+
+def overloaded_response(e):
+	# Failing fast, so the players come back later instead of piling up on a slow origin.
+	return ("Too busy: %s." % (e,), 503, { "Retry-After": str(e.retry_after) })
+
+def playlist_response(text, event_clock):
 	response = make_response(text)
 	response.mimetype = "application/x-mpegurl"
-	response.headers["Cache-Control"] = "max-age=2"
+	# A couple of seconds of the event, which are shorter when its clock runs faster.
+	response.headers["Cache-Control"] = "max-age=%d" % (event_clock.real_seconds(2),)
 	return response
+
+@app.route('/v1/segment')
+def segment():
+	
+	"""Proxies segments (as well as keys and init sections) of the playlists passed via us with `proxy_segments=1`."""
+	
+	segment_url = request.args.get(URL_ARG)
+	if not segment_url:
+		return ("Parameter '%s' is required" % (URL_ARG,), 400)
+	# Only the segments of our own playlists, we're not an open proxy.
+	if not upstream.is_signed_segment(segment_url, request.args.get(SIGNATURE_ARG)):
+		return ("The segment URL is not signed by us", 403)
+	
+	try:
+		(content_type, body, size), hit = upstream.get_segment(segment_url)
+	except requests.HTTPError as e:
+		# Passing 404s and such as is, players might handle them differently.
+		return ("Could not download the segment: %s." % (e,), e.response.status_code)
+	except upstream.Overloaded as e:
+		return overloaded_response(e)
+	except ValueError as e:
+		return (str(e), 400)
+	except Exception as e:
+		app.logger.error("Error: %s" % (e))
+		return ("Could not download the segment: %s." % (e,), 502)
+	
+	metrics.UPSTREAM_BYTES_OUT.inc((upstream.host_of(segment_url),), size)
+	
+	if isinstance(body, str):
+		response = make_response(body)
+		response.headers["Content-Type"] = content_type
+		# This handles Range requests.
+		response = response.make_conditional(request, accept_ranges = True, complete_length = size)
+	else:
+		# Larger segments are sent right from the cache.
+		response = origin.file_response(body, body.tell(), size, content_type)
+		response.headers["Content-Type"] = content_type
+	response.headers["Cache-Control"] = "max-age=%d" % (upstream.SEGMENT_TTL,)
+	response.headers["X-Hlsed-Cache"] = "hit" if hit else "miss"
+	return response
+
+# Created on first use, so it belongs to the worker process using it.
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+def batch_pool():
+	global _batch_pool
+	with _batch_pool_lock:
+		if _batch_pool is None:
+			_batch_pool = multiprocessing.pool.ThreadPool(BATCH_THREADS)
+		return _batch_pool
+
+@app.route('/v1/batch', methods = ['POST'])
+def batch():
+	
+	"""
+	Transforms many playlists at once, e.g. when a test sets up lots of sessions. Expects a JSON object like:
+	
+		{ 
+			"sessions": [ { "url": "apple1", "ref_time": 1612345678, "duration": 600, "ad_interval": 30 }, ... ],
+			"variants": true,
+			"playlists": true
+		}
+	
+	where every session has the same parameters as /v1/eventify. Returns a list of sessions in the same order, 
+	each with the URL of /v1/eventify for it and (unless "playlists" is false) the current transformed playlist; 
+	with "variants" the media playlists of master playlists are returned as well. Sessions that failed have 
+	an "error" instead.
+	
+	Upstream playlists are fetched concurrently, and only once for all the sessions using the same one.
+	"""
+	
+	body = request.get_json(silent = True)
+	if not isinstance(body, dict) or not isinstance(body.get('sessions'), list):
+		return ("Expected a JSON object with a list of 'sessions'", 400)
+	sessions = body['sessions']
+	if len(sessions) > BATCH_MAX_SESSIONS:
+		return ("Too many sessions, %d at most" % (BATCH_MAX_SESSIONS,), 400)
+	include_playlists = body.get('playlists', True)
+	include_variants = body.get('variants', False)
+	
+	# URLs cannot be built outside of the request, so let's prepare everything here.
+	base_url = external_url(url_for('proxy', _external = True))
+	segment_proxy_url = external_url(url_for('segment', _external = True))
+	
+	def job_from_args(args, proxy_url = None):
+		params = EventifyParams(args)
+		playlist_url = resolve_playlist_url(params.url)
+		if proxy_url is None:
+			# The same as the URL of a regular request with the same parameters would be after normalization.
+			query = dict(map(lambda (k, v): (k, unicode(v).encode('utf_8')), args.items()))
+			query[START_TIME_ARG] = str(params.start_time)
+			proxy_url = base_url + '?' + urllib.urlencode(sorted(query.items()))
+		return (playlist_url, proxy_url, params, segment_proxy_url if params.proxy_segments else None)
+	
+	jobs = []
+	for session in sessions:
+		try:
+			if not isinstance(session, dict):
+				raise Exception("Expected an object")
+			jobs.append(job_from_args(session))
+		except Exception as e:
+			jobs.append(e)
+	
+	results = run_batch(jobs, include_playlists or include_variants)
+	
+	if include_variants:
+		# The variant URLs in the transformed master playlists are our own, with all the parameters in place.
+		variant_jobs = []
+		for result in results:
+			playlist = result.get('playlist')
+			if playlist is None:
+				continue
+			master = m3u.Playlist(playlist)
+			if not master.is_master_playlist:
+				continue
+			for item in master.uris:
+				args = dict(urlparse.parse_qsl(urlparse.urlparse(item.uri).query))
+				variant_jobs.append(job_from_args(args, item.uri))
+			result['variants'] = len(master.uris)
+		variant_results = iter(run_batch(variant_jobs, include_playlists))
+		for result in results:
+			if 'variants' in result:
+				result['variants'] = [next(variant_results) for i in range(result['variants'])]
+	
+	if not include_playlists:
+		for result in results:
+			result.pop('playlist', None)
+	
+	response = make_response(json.dumps({ 'sessions': results }, separators = (',', ':')))
+	response.mimetype = "application/json"
+	return response
+
+def run_batch(jobs, render):
+	
+	"""
+	Runs eventify() for the given jobs, tuples of its arguments (or exceptions for the sessions that could not 
+	be parsed), concurrently. Returns a list of dictionaries with the results for every job in the same order.
+	"""
+	
+	pool = batch_pool()
+	
+	def prefetch(playlist_url):
+		try:
+			upstream.get_playlist(playlist_url)
+		except Exception:
+			# Let the actual job report this.
+			pass
+	
+	def run(job):
+		if isinstance(job, Exception):
+			return { 'error': "Invalid session: %s" % (job,) }
+		playlist_url, proxy_url, params, segment_proxy_url = job
+		result = { 'url': proxy_url }
+		if render:
+			try:
+				result['playlist'] = eventify(playlist_url, proxy_url, params, segment_proxy_url)
+			except Exception as e:
+				result['error'] = str(e)
+		return result
+	
+	valid_jobs = filter(lambda job: not isinstance(job, Exception), jobs)
+	
+	# Each upstream playlist is fetched once, then the sessions using it take it from the cache.
+	if render:
+		unique_urls = list(collections.OrderedDict.fromkeys(map(lambda job: job[0], valid_jobs)))
+		pool.map(prefetch, unique_urls)
+	
+	# Identical sessions are not uncommon either.
+	unique_jobs = collections.OrderedDict(map(lambda job: (job[1], job), valid_jobs))
+	results = dict(zip(unique_jobs.keys(), pool.map(run, unique_jobs.values())))
+	
+	return map(lambda job: run(job) if isinstance(job, Exception) else dict(results[job[1]]), jobs)
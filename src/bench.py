@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Micro-benchmarks for the hot paths of the proxy, mainly to compare different implementations of the same thing.
+
+import argparse
+import hlsed
+import m3u
+import scte35
+import sessions
+import timeit
+import urlparse
+
+def large_media_playlist_text(segment_count, target_duration = 6):
+	"""A synthetic VOD media playlist with the given number of segments with relative URIs."""
+	lines = [
+		"#EXTM3U",
+		"#EXT-X-VERSION:3",
+		"#EXT-X-TARGETDURATION:%d" % (target_duration,),
+		"#EXT-X-MEDIA-SEQUENCE:0"
+	]
+	for i in range(segment_count):
+		lines.append("#EXTINF:%.3f," % (target_duration - 0.005 * (i % 3),))
+		lines.append("media/segment%d.ts" % (i,))
+	lines.append("#EXT-X-ENDLIST")
+	return "\n".join(lines)
+
+# The media playlist used instead of the synthetic ones when given via --fixture.
+fixture_text = None
+
+def media_playlist_text(segment_count):
+	"""The text of the --fixture playlist if any, or a synthetic one with the given number of segments."""
+	return fixture_text if fixture_text is not None else large_media_playlist_text(segment_count)
+
+def load_fixture(path):
+	"""A media playlist from a file, either the text or its binary form (see m3u.dumps())."""
+	with open(path, 'rb') as f:
+		data = f.read()
+	playlist = m3u.loads(data) if m3u.is_serialized(data) else m3u.Playlist(data.decode('utf_8'))
+	if playlist.is_master_playlist:
+		raise Exception("The fixture '%s' is a master playlist" % (path,))
+	return playlist
+
+def report(name, seconds, count):
+	print("%-40s %10.2f ms %10.2f us/item" % (name, seconds * 1000, seconds * 1e6 / count))
+
+def best_of(repeat, func):
+	return min(timeit.repeat(func, number = 1, repeat = repeat))
+
+def bench_rebase(segment_count, repeat):
+	
+	print("Rebasing %d URIs:" % (segment_count,))
+	
+	playlist_url = "https://origin.example.com/streams/event/variant.m3u8?token=abcdef"
+	proxy_url = "https://hlsed.example.com/v1/eventify?duration=3600&ref_time=1612345678&url=x"
+	uris = ["media/segment%d.ts" % (i,) for i in range(segment_count)]
+
+	report("urljoin", best_of(repeat, lambda: [urlparse.urljoin(playlist_url, u) for u in uris]), segment_count)
+	report(
+		"url_overriding_query_param", 
+		best_of(repeat, lambda: [hlsed.url_overriding_query_param(proxy_url, "url", u) for u in uris]),
+		segment_count
+	)
+	
+	def absolute():
+		rebaser = hlsed.Rebaser(playlist_url, proxy_url)
+		return [rebaser.absolute(u) for u in uris]
+	report("Rebaser.absolute", best_of(repeat, absolute), segment_count)
+
+	def proxied():
+		rebaser = hlsed.Rebaser(playlist_url, proxy_url)
+		return [rebaser.proxied(u) for u in uris]
+	report("Rebaser.proxied", best_of(repeat, proxied), segment_count)
+	
+	text = media_playlist_text(segment_count)
+	report(
+		"parse + rebase()", 
+		best_of(repeat, lambda: hlsed.rebase(m3u.Playlist(text), playlist_url, proxy_url)), 
+		segment_count
+	)
+	
+class _SessionParams:
+	url = "https://origin.example.com/streams/event/variant.m3u8"
+	start_time = 1612345678
+	event_duration = 24 * 3600
+	ad_interval = 60
+	ad_duration = 15
+	ad_style = hlsed.CUE_STYLE_IN_OUT
+	proxy_segments = False
+	pdt_interval = 0
+
+def bench_window(segment_count, repeat):
+	
+	print("Rendering a window of %d segments with ad cues:" % (segment_count,))
+	
+	params = _SessionParams()
+	playlist_url = params.url
+	proxy_url = "https://hlsed.example.com/v1/eventify?session=x"
+	text = media_playlist_text(segment_count)
+	# Somewhere in the end of the playlist.
+	current_time = params.start_time + segment_count * 6 - 60
+	
+	def eventify():
+		playlist = hlsed.rebase(m3u.Playlist(text), playlist_url, proxy_url)
+		hlsed.event_to_vod(playlist, params.event_duration, params.start_time, current_time, True)
+		hlsed.insert_ad_cues(
+			playlist, params.event_duration, params.start_time, current_time, params.ad_interval, params.ad_duration
+		)
+		return playlist.text()
+	report("parse + event_to_vod + insert_ad_cues", best_of(repeat, eventify), segment_count)
+
+	snapshot = m3u.Snapshot(m3u.Playlist(text))
+	def eventify_view():
+		playlist = hlsed.rebase(snapshot.view(), playlist_url, proxy_url)
+		hlsed.event_to_vod(playlist, params.event_duration, params.start_time, current_time, True)
+		hlsed.insert_ad_cues(
+			playlist, params.event_duration, params.start_time, current_time, params.ad_interval, params.ad_duration
+		)
+		return playlist.text()
+	report("view + event_to_vod + insert_ad_cues", best_of(repeat, eventify_view), segment_count)
+
+	session = sessions.Session('x', {}, params)
+	timeline = sessions.Timeline(hlsed.rebase(m3u.Playlist(text), playlist_url, proxy_url), 'digest')
+	session.render(timeline, current_time)
+	report("Session.render", best_of(repeat, lambda: session.render(timeline, current_time)), segment_count)
+	
+def bench_pipeline(segment_count, repeat):
+	
+	print("Transforming %d segments one by one vs in a single pass:" % (segment_count,))
+	
+	params = _SessionParams()
+	playlist_url = params.url
+	proxy_url = "https://hlsed.example.com/v1/eventify?duration=3600&url=x"
+	segment_proxy_url = "https://hlsed.example.com/v1/segment"
+	text = media_playlist_text(segment_count)
+	
+	def stages(current_time):
+		return [
+			hlsed.RebaseStage(playlist_url, proxy_url, segment_proxy_url),
+			hlsed.EventToVODStage(params.event_duration, params.start_time, current_time, True),
+			hlsed.AdCuesStage(
+				params.event_duration, params.start_time, current_time, params.ad_interval, params.ad_duration
+			)
+		]
+	
+	for fraction in [0.1, 1.0]:
+		# The window is a fraction of the playlist.
+		current_time = params.start_time + segment_count * 6 * fraction
+		playlists = [m3u.Playlist(text) for i in range(repeat)]
+		def unfused():
+			playlist = playlists.pop()
+			for stage in stages(current_time):
+				hlsed.Pipeline([stage]).apply(playlist)
+		report("unfused, %d%% window" % (fraction * 100,), best_of(repeat, unfused), segment_count)
+		playlists = [m3u.Playlist(text) for i in range(repeat)]
+		report(
+			"fused, %d%% window" % (fraction * 100,), 
+			best_of(repeat, lambda: hlsed.Pipeline(stages(current_time)).apply(playlists.pop())), 
+			segment_count
+		)
+
+def bench_serialization(segment_count, repeat):
+
+	print("Parsing %d segments vs loading them from the binary form:" % (segment_count,))
+
+	text = media_playlist_text(segment_count)
+	playlist = m3u.Playlist(text)
+	data = m3u.dumps(playlist)
+	print("%-40s %10d bytes" % ("text", len(text)))
+	print("%-40s %10d bytes" % ("binary", len(data)))
+
+	report("parse", best_of(repeat, lambda: m3u.Playlist(text)), segment_count)
+	report("parse + segment_ends", best_of(repeat, lambda: m3u.Playlist(text).segment_ends()), segment_count)
+	report("dumps", best_of(repeat, lambda: m3u.dumps(playlist)), segment_count)
+	report("loads", best_of(repeat, lambda: m3u.loads(data)), segment_count)
+	report("loads + segment_ends", best_of(repeat, lambda: m3u.loads(data).segment_ends()), segment_count)
+
+def bench_scte35(segment_count, repeat):
+
+	# One ad break every 10 segments, some with a break duration.
+	cue_count = max(segment_count // 10, 1)
+	print("Encoding %d SCTE-35 splice_inserts:" % (cue_count,))
+
+	cues = []
+	for i in range(cue_count):
+		cue = (i, True, i * 60.0)
+		if i % 2:
+			cue += (30.0, True)
+		cues.append(cue)
+
+	report(
+		"one by one", 
+		best_of(repeat, lambda: [scte35.splice_info_with_splice_insert(*c) for c in cues]), 
+		cue_count
+	)
+	report("batch", best_of(repeat, lambda: scte35.splice_infos_with_splice_insert(cues)), cue_count)
+
+BENCHMARKS = {
+	"pipeline": bench_pipeline,
+	"rebase": bench_rebase,
+	"scte35": bench_scte35,
+	"serialization": bench_serialization,
+	"window": bench_window
+}
+
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		"benchmarks", nargs = "*", default = sorted(BENCHMARKS.keys()),
+		help = "The names of the benchmarks to run: %s. All by default." % (", ".join(sorted(BENCHMARKS.keys())),)
+	)
+	parser.add_argument(
+		"-n", "--segments", type = int, default = 10000, 
+		help = "The number of segments in the synthetic playlists."
+	)
+	parser.add_argument(
+		"-r", "--repeat", type = int, default = 5, 
+		help = "How many times to repeat each measurement (the best one is reported)."
+	)
+	parser.add_argument(
+		"--fixture", 
+		help = "A media playlist (text or binary) to use instead of the synthetic ones, the number of segments is its own."
+	)
+	parser.add_argument(
+		"--save-fixture", 
+		help = "Saves the synthetic playlist with the given number of segments in the binary form and exits."
+	)
+	args = parser.parse_args()
+	
+	if args.save_fixture:
+		with open(args.save_fixture, 'wb') as f:
+			f.write(m3u.dumps(m3u.Playlist(large_media_playlist_text(args.segments))))
+		parser.exit()
+	if args.fixture:
+		playlist = load_fixture(args.fixture)
+		fixture_text = playlist.text()
+		args.segments = len(playlist.uris)
+	
+	for name in args.benchmarks:
+		BENCHMARKS[name](args.segments, args.repeat)
+		print("")
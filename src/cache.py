@@ -0,0 +1,548 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Simple caches for upstream playlists and rendered responses.
+#
+# - MemoryCache is private to a process and is the fastest one.
+# - DiskCache is shared by all the worker processes using the same directory.
+# - TieredCache checks the memory first, then the disk, and makes sure that only one thread or process
+#   computes a missing value at a time, so adding workers does not multiply the work. It can also keep serving
+#   expired values while they are recomputed in the background (see get_or_revalidate()).
+
+import collections
+import contextlib
+import cPickle
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+class MemoryCache:
+
+	"""A thread-safe LRU cache with the entries expiring after the time-to-live given when they are set."""
+
+	def __init__(self, max_items = 1000):
+		self.max_items = max_items
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		"""The value stored under the given key or None when there is no such value or it has expired."""
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None:
+				return None
+			expires, value = entry
+			if expires < time.time():
+				return None
+			# Moving it to the end, so it's the most recently used one.
+			self._entries[key] = entry
+			return value
+
+	def set(self, key, value, ttl):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (time.time() + ttl, value)
+			while len(self._entries) > self.max_items:
+				self._entries.popitem(last = False)
+
+class DiskCache:
+
+	"""
+	A cache storing every entry in a separate file in the given directory, so it can be shared by several processes.
+	The total size of the files is kept around `max_bytes` by removing the least recently written ones.
+	"""
+
+	# How many writes can happen before we check the total size of the cache.
+	PRUNE_EVERY = 100
+	# Lock files (see lock()) that are not held are removed by prune() when they are older than this (seconds).
+	LOCK_FILE_TTL = 60
+
+	def __init__(self, directory, max_bytes = 256 * 1024 * 1024):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		for d in [self.directory, self._locks_dir()]:
+			try:
+				os.makedirs(d)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+		self._writes = 0
+
+	def _locks_dir(self):
+		return os.path.join(self.directory, 'locks')
+
+	def _name(self, key):
+		if isinstance(key, unicode):
+			key = key.encode('utf_8')
+		return hashlib.sha1(key).hexdigest()
+
+	def _path(self, key):
+		return os.path.join(self.directory, self._name(key))
+
+	def get(self, key):
+		entry = self.get_entry(key)
+		if entry is None:
+			return None
+		return entry[1]
+	
+	def get_entry(self, key):
+		"""A tuple with the expiration time and the value stored under the given key, or None."""
+		try:
+			with open(self._path(key), 'rb') as f:
+				stored_key, expires, value = cPickle.load(f)
+		except IOError as e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+		except (EOFError, cPickle.UnpicklingError, ValueError):
+			# Should not happen as we write atomically, but let's not fail because of a corrupted file.
+			return None
+		if stored_key != key or expires < time.time():
+			return None
+		return expires, value
+
+	def set(self, key, value, ttl):
+
+		# Writing into a temporary file first and then renaming it, so readers never see partially written files.
+		fd, temp_path = tempfile.mkstemp(dir = self.directory, prefix = '.tmp-')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				cPickle.dump((key, time.time() + ttl, value), f, cPickle.HIGHEST_PROTOCOL)
+			os.rename(temp_path, self._path(key))
+		except:
+			os.remove(temp_path)
+			raise
+
+		self._writes += 1
+		if self._writes % DiskCache.PRUNE_EVERY == 0:
+			self.prune()
+
+	def set_file(self, key, value, chunks, ttl):
+
+		"""
+		Like set(), but also stores the data from the iterable `chunks` after the value, writing it as it comes,
+		so it's never all in memory (see get_file()). Nothing is stored when iterating `chunks` fails.
+		"""
+
+		fd, temp_path = tempfile.mkstemp(dir = self.directory, prefix = '.tmp-')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				cPickle.dump((key, time.time() + ttl, value), f, cPickle.HIGHEST_PROTOCOL)
+				for chunk in chunks:
+					f.write(chunk)
+			os.rename(temp_path, self._path(key))
+		except:
+			os.remove(temp_path)
+			raise
+
+		self._writes += 1
+		if self._writes % DiskCache.PRUNE_EVERY == 0:
+			self.prune()
+
+	def get_file(self, key):
+
+		"""
+		A tuple with the expiration time and the value stored by set_file() under the given key, the file positioned
+		at the data stored along with them (to be closed by the caller) and the size of the data, or None.
+		"""
+
+		try:
+			f = open(self._path(key), 'rb')
+		except IOError as e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+		try:
+			stored_key, expires, value = cPickle.load(f)
+		except (EOFError, cPickle.UnpicklingError, ValueError):
+			stored_key = None
+		if stored_key != key or expires < time.time():
+			f.close()
+			return None
+		return expires, value, f, os.fstat(f.fileno()).st_size - f.tell()
+
+	def lock(self, key):
+		"""An exclusive lock associated with the given key, shared by all threads and processes using this cache."""
+		return _FileLock(os.path.join(self._locks_dir(), self._name(key)))
+
+	def prune(self):
+
+		"""Removes the least recently written entries until the total size of the cache fits `max_bytes`."""
+
+		# One process pruning at a time is enough.
+		lock = _FileLock(os.path.join(self._locks_dir(), 'prune'))
+		if not lock.acquire(blocking = False):
+			return
+		try:
+			entries = []
+			total = 0
+			for name in os.listdir(self.directory):
+				path = os.path.join(self.directory, name)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				if not os.path.isfile(path):
+					continue
+				entries.append((st.st_mtime, st.st_size, path))
+				total += st.st_size
+
+			entries.sort()
+			for mtime, size, path in entries:
+				if total <= self.max_bytes:
+					break
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+				total -= size
+
+			self._remove_lock_files(time.time() - DiskCache.LOCK_FILE_TTL)
+		finally:
+			lock.release()
+
+	def _remove_lock_files(self, created_before):
+		# Holding the lock while removing the file, so nobody else gets it meanwhile (see _FileLock.acquire()).
+		for name in os.listdir(self._locks_dir()):
+			if name == 'prune':
+				continue
+			path = os.path.join(self._locks_dir(), name)
+			try:
+				if os.stat(path).st_mtime >= created_before:
+					continue
+			except OSError:
+				continue
+			lock = _FileLock(path)
+			if lock.acquire(blocking = False):
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+				finally:
+					lock.release()
+
+class _FileLock:
+
+	"""
+	An exclusive lock via flock() on a file. Because locks are associated with open files,
+	this works not only for different processes, but for different threads of the same process as well.
+
+	The file can be removed by whoever holds the lock (see DiskCache.prune()), the others then lock a new one.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._f = None
+
+	def acquire(self, blocking = True):
+		while True:
+			f = open(self.path, 'a')
+			try:
+				if blocking:
+					fcntl.flock(f, fcntl.LOCK_EX)
+				else:
+					fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except IOError as e:
+				f.close()
+				if e.errno in (errno.EAGAIN, errno.EACCES):
+					return False
+				raise
+			# The file could have been removed while we were waiting for it.
+			try:
+				if os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+					self._f = f
+					return True
+			except OSError as e:
+				if e.errno != errno.ENOENT:
+					f.close()
+					raise
+			f.close()
+
+	def release(self):
+		# Closing the file releases the lock.
+		self._f.close()
+		self._f = None
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.release()
+
+class _KeyLocks:
+
+	"""Per-key locks within a single process, created on demand and dropped when nobody is waiting for them."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._locks = {}
+
+	def acquire(self, key, blocking = True):
+		"""Returns False, without waiting, if the lock is held by another thread and not `blocking`."""
+		with self._lock:
+			entry = self._locks.get(key)
+			if entry is None:
+				entry = [threading.Lock(), 0]
+				self._locks[key] = entry
+			entry[1] += 1
+		if entry[0].acquire(blocking):
+			return True
+		with self._lock:
+			entry[1] -= 1
+			if entry[1] == 0:
+				del self._locks[key]
+		return False
+
+	def release(self, key):
+		with self._lock:
+			entry = self._locks[key]
+			entry[0].release()
+			entry[1] -= 1
+			if entry[1] == 0:
+				del self._locks[key]
+
+class TieredCache:
+
+	"""A memory cache backed by an optional disk cache shared with other processes."""
+
+	# Expired failures of the keys that are not used anymore are dropped when there are more than this many.
+	MAX_FAILURES = 1000
+
+	def __init__(self, memory, disk = None):
+		self.memory = memory
+		self.disk = disk
+		self._key_locks = _KeyLocks()
+		# The keys being recomputed in the background, see get_or_revalidate().
+		self._revalidating = set()
+		self._revalidating_lock = threading.Lock()
+		# Key -> the time the last failure to compute its value is forgotten and the exception, 
+		# see get_or_revalidate().
+		self._failures = {}
+
+	def get(self, key):
+		value = self.memory.get(key)
+		if value is not None or self.disk is None:
+			return value
+		entry = self.disk.get_entry(key)
+		if entry is None:
+			return None
+		# Keeping it in memory till it expires on the disk, so we don't have to read it again.
+		expires, value = entry
+		self.memory.set(key, value, expires - time.time())
+		return value
+
+	def set(self, key, value, ttl):
+		self.memory.set(key, value, ttl)
+		if self.disk is not None:
+			self.disk.set(key, value, ttl)
+
+	@contextlib.contextmanager
+	def locked(self, key):
+		"""Holds the lock of the given key, the same one get_or_compute() does, across the processes as well."""
+		self._key_locks.acquire(key)
+		try:
+			if self.disk is not None:
+				with self.disk.lock(key):
+					yield
+			else:
+				yield
+		finally:
+			self._key_locks.release(key)
+
+	def get_or_compute(self, key, ttl, compute):
+
+		"""
+		Returns a tuple with the value cached under the given key and True, if there is one;
+		otherwise calls `compute()`, caches its result and returns it with False.
+
+		Concurrent callers missing the same key wait for the first one instead of computing the value again,
+		which works across processes as well when the disk cache is used.
+		"""
+
+		value = self.get(key)
+		if value is not None:
+			return value, True
+
+		self._key_locks.acquire(key)
+		try:
+			if self.disk is not None:
+				with self.disk.lock(key):
+					return self._compute_locked(key, ttl, compute)
+			else:
+				return self._compute_locked(key, ttl, compute)
+		finally:
+			self._key_locks.release(key)
+
+	def _compute_locked(self, key, ttl, compute, usable = lambda value: True):
+
+		# Someone could have computed it while we were waiting for the lock.
+		value = self.get(key)
+		if value is not None and usable(value):
+			return value, True
+
+		value = compute()
+		self.set(key, value, ttl)
+		return value, False
+
+	def get_or_revalidate(
+		self, key, ttl, compute, max_stale = 0, max_stale_if_error = 0, revalidate = None, error_ttl = 0
+	):
+
+		"""
+		Like get_or_compute(), but the values are kept for a while after they expire:
+
+		- a value expired not more than `max_stale` seconds ago is returned right away, while a new one is computed
+		  in the background via `revalidate()` (`compute()` by default) by a single thread (and process, when
+		  the disk cache is used) at a time, i.e. "stale-while-revalidate";
+		- a value expired not more than `max_stale_if_error` seconds ago is returned when computing a new one fails,
+		  i.e. "stale-if-error", as well as when another thread is computing it already;
+		- a failure is remembered for `error_ttl` seconds: meanwhile the stale value is returned (or the same
+		  exception raised) without computing it again, so the callers don't keep trying one after another.
+
+		Returns a tuple with the value, True if it was taken from the cache and None if it's fresh or the reason
+		it's stale: 'revalidate' or 'error'. The values are stored along with the time they expire, so the same keys
+		cannot be used with the other methods.
+		"""
+
+		keep = ttl + max(max_stale, max_stale_if_error)
+		def computed(func):
+			def entry():
+				# Someone else could have failed while we were waiting for the lock.
+				failure = self._recent_failure(key)
+				if failure is not None:
+					raise failure
+				try:
+					value = func()
+				except Exception as e:
+					if error_ttl > 0:
+						self._remember_failure(key, e, error_ttl)
+					raise
+				self._failures.pop(key, None)
+				return (time.time() + ttl, value)
+			return entry
+
+		entry = self.get(key)
+		stale_if_error = False
+		if entry is not None:
+			expires, value = entry
+			now = time.time()
+			if now <= expires:
+				return value, True, None
+			if now <= expires + max_stale:
+				self._revalidate(key, keep, computed(revalidate or compute))
+				return value, True, 'revalidate'
+			stale_if_error = now <= expires + max_stale_if_error
+
+		failure = self._recent_failure(key)
+		if failure is not None:
+			if stale_if_error:
+				return entry[1], True, 'error'
+			raise failure
+
+		fresh = lambda e: time.time() <= e[0]
+		# With a stale value to use, there's no point in waiting for another thread to fail as well.
+		if not self._key_locks.acquire(key, blocking = not stale_if_error):
+			return entry[1], True, 'error'
+		try:
+			if self.disk is not None:
+				with self.disk.lock(key):
+					new_entry, hit = self._compute_locked(key, keep, computed(compute), fresh)
+			else:
+				new_entry, hit = self._compute_locked(key, keep, computed(compute), fresh)
+		except Exception as e:
+			if stale_if_error and time.time() <= entry[0] + max_stale_if_error:
+				_logger.warning("Using the stale value of '%s': %s", key, e)
+				return entry[1], True, 'error'
+			raise
+		finally:
+			self._key_locks.release(key)
+		return new_entry[1], hit, None
+
+	def _remember_failure(self, key, e, error_ttl):
+		now = time.time()
+		if len(self._failures) >= TieredCache.MAX_FAILURES:
+			for k, (until, failure) in self._failures.items():
+				if until <= now:
+					self._failures.pop(k, None)
+		self._failures[key] = (now + error_ttl, e)
+
+	def _recent_failure(self, key):
+		failure = self._failures.get(key)
+		if failure is None:
+			return None
+		if time.time() < failure[0]:
+			return failure[1]
+		# (Another thread could have replaced it meanwhile, it's fine to forget that one as well.)
+		self._failures.pop(key, None)
+		return None
+
+	def refresh(self, key, ttl, compute, max_stale = 0, max_stale_if_error = 0):
+
+		"""
+		Computes a new value for get_or_revalidate() ahead of the requests, so they find it fresh, unless another
+		process has done that within the first half of its `ttl`. Returns the value.
+		"""
+
+		keep = ttl + max(max_stale, max_stale_if_error)
+		self._key_locks.acquire(key)
+		try:
+			if self.disk is not None:
+				with self.disk.lock(key):
+					return self._refresh_locked(key, ttl, keep, compute)
+			else:
+				return self._refresh_locked(key, ttl, keep, compute)
+		finally:
+			self._key_locks.release(key)
+
+	def _refresh_locked(self, key, ttl, keep, compute):
+
+		# Only the disk knows whether other processes have just done it.
+		entry = self.disk.get_entry(key) if self.disk is not None else None
+		if entry is not None:
+			stored, (expires, value) = entry
+			if time.time() < expires - ttl / 2.0:
+				self.memory.set(key, (expires, value), stored - time.time())
+				return value
+
+		value = compute()
+		self.set(key, (time.time() + ttl, value), keep)
+		return value
+
+	def _revalidate(self, key, ttl, compute):
+
+		with self._revalidating_lock:
+			if key in self._revalidating:
+				return
+			self._revalidating.add(key)
+
+		def run():
+			try:
+				lock = self.disk.lock(key) if self.disk is not None else None
+				# Another process is at it already.
+				if lock is not None and not lock.acquire(blocking = False):
+					return
+				try:
+					entry = self.get(key)
+					if entry is None or entry[0] < time.time():
+						self.set(key, compute(), ttl)
+				finally:
+					if lock is not None:
+						lock.release()
+			except Exception as e:
+				# The stale value is used till it's too old, then it's up to the requests.
+				_logger.warning("Could not revalidate '%s': %s", key, e)
+			finally:
+				with self._revalidating_lock:
+					self._revalidating.discard(key)
+
+		t = threading.Thread(target = run, name = 'Revalidate')
+		t.daemon = True
+		t.start()
+
+_logger = logging.getLogger(__name__)
@@ -0,0 +1,44 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# The time events are rendered at. It's the real time by default, but it can run faster (or slower), be shifted
+# and be stopped, so that hours-long events with all their ad breaks and the switch to VOD can be played through
+# in minutes.
+
+import time
+
+class Clock:
+
+	"""
+	The virtual time of an event with the given reference time (a Unix timestamp): it runs `speed` times as fast
+	as the real one from the reference time on (so the event starts at the same moment either way), `offset` seconds
+	ahead of it, and stops at `pause_at` seconds after the reference time, if given.
+	"""
+
+	# Hours of an event per second are more than enough, and much faster clocks would overflow.
+	MAX_SPEED = 10000
+
+	def __init__(self, ref_time, speed = 1, offset = 0, pause_at = None):
+		# (Also false for NaN.)
+		if not (0 < speed <= Clock.MAX_SPEED):
+			raise Exception("The speed of the clock should be positive and at most %d" % (Clock.MAX_SPEED,))
+		self.ref_time = ref_time
+		self.speed = speed
+		self.offset = offset
+		self.pause_at = pause_at
+
+	def is_real(self):
+		return self.speed == 1 and self.offset == 0 and self.pause_at is None
+
+	def now(self, real_time = None):
+		"""The virtual time at the given real time, the current one by default."""
+		if real_time is None:
+			real_time = time.time()
+		t = self.ref_time + (real_time - self.ref_time) * self.speed + self.offset
+		if self.pause_at is not None:
+			t = min(t, self.ref_time + self.pause_at)
+		return t
+
+	def real_seconds(self, seconds):
+		"""How long the given number of seconds of the virtual time take in real time."""
+		return seconds / float(self.speed)
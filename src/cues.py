@@ -0,0 +1,143 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Ad cues that are already present in upstream playlists, either as EXT-X-DATERANGE tags with SCTE35-* attributes
+# or as the tags of segments (EXT-X-CUE-OUT/EXT-X-CUE-OUT-CONT/EXT-X-CUE-IN, EXT-OATCLS-SCTE35).
+#
+# We are re-presenting the segments of a playlist as an event starting at its first segment, so the times
+# in the SCTE-35 sections of the cues are shifted to the same timeline our own cues are using (the time since
+# the beginning of the playlist, see hlsed.ad_cues()). This depends only on the content of the playlist,
+# so it's done once when it's parsed (see retime()) before the playlist is cached. The dates of EXT-X-DATERANGE
+# tags depend on the start time of every event and are shifted later (see hlsed.UpstreamCuesStage).
+
+import base64
+import binascii
+import calendar
+import re
+import scte35
+import time
+
+def parse_iso8601(s):
+	"""
+	A Unix time from an ISO 8601 date and time as it's used in EXT-X-PROGRAM-DATE-TIME and EXT-X-DATERANGE tags,
+	e.g. '2021-02-03T09:47:58.123Z' or '2021-02-03T10:47:58+01:00'. Raises ValueError for anything else.
+	"""
+	m = _iso8601_re.match(s)
+	if not m:
+		raise ValueError("Unsupported date: '%s'" % (s,))
+	t = calendar.timegm(time.strptime(m.group('datetime'), "%Y-%m-%dT%H:%M:%S"))
+	if m.group('fraction'):
+		t += float('0' + m.group('fraction'))
+	if m.group('sign'):
+		offset = int(m.group('hours')) * 3600 + int(m.group('minutes') or 0) * 60
+		t += -offset if m.group('sign') == '+' else offset
+	return t
+
+_iso8601_re = re.compile(
+	r'^(?P<datetime>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?P<fraction>\.\d+)?'
+	r'(Z|(?P<sign>[+-])(?P<hours>\d{2}):?(?P<minutes>\d{2})?)$'
+)
+
+def program_date_time(tag):
+	"""The time of an EXT-X-PROGRAM-DATE-TIME tag or None, if it cannot be parsed."""
+	if tag is None:
+		return None
+	try:
+		return parse_iso8601(tag.values[0])
+	except ValueError:
+		return None
+
+def daterange_times(tag):
+	"""A tuple with the times of START-DATE and END-DATE of an EXT-X-DATERANGE tag, either can be None."""
+	result = []
+	for name in ['START-DATE', 'END-DATE']:
+		value = tag.attributes.get(name)
+		try:
+			result.append(parse_iso8601(value.value) if value is not None else None)
+		except ValueError:
+			result.append(None)
+	return tuple(result)
+
+def retime(playlist):
+
+	"""
+	Shifts the times in the SCTE-35 sections of all the cues of the given media playlist (m3u.Playlist),
+	so they are relative to the beginning of the playlist. Cues that cannot be decoded are left as is.
+	"""
+
+	if playlist.is_master_playlist or not playlist.uris:
+		return playlist
+
+	# The cues in EXT-X-DATERANGE tags are placed via dates, so we need to know the date of the first segment.
+	first_date = program_date_time(playlist.uris[0].tag_by_name('EXT-X-PROGRAM-DATE-TIME'))
+	if first_date is not None:
+		for tag in playlist.globals:
+			if tag.name != 'EXT-X-DATERANGE':
+				continue
+			start, end = daterange_times(tag)
+			for name in ['SCTE35-OUT', 'SCTE35-CMD', 'SCTE35-IN']:
+				value = tag.attributes.get(name)
+				t = end if name == 'SCTE35-IN' and end is not None else start
+				if value is None or t is None:
+					continue
+				try:
+					section = binascii.unhexlify(value.value)
+				except TypeError:
+					continue
+				value.value = binascii.hexlify(_retimed(section, t - first_date)).upper()
+
+	segment_start = 0
+	for u in playlist.uris:
+		for tag in u.tags:
+			if tag.name == 'EXT-OATCLS-SCTE35':
+				tag.values[0] = _retimed_base64(tag.values[0], segment_start)
+			elif tag.name == 'EXT-X-CUE-OUT-CONT':
+				_retime_cue_out_cont(tag, segment_start)
+		segment_start += u.duration()
+
+	return playlist
+
+def _retime_cue_out_cont(tag, segment_start):
+	# The section is the one of the original cue, which happened ElapsedTime seconds ago.
+	elapsed = 0
+	for v in tag.values:
+		name, sep, value = v.partition('=')
+		if name.lower() == 'elapsedtime':
+			try:
+				elapsed = float(value)
+			except ValueError:
+				pass
+	for i, v in enumerate(tag.values):
+		name, sep, value = v.partition('=')
+		if name.upper() == 'SCTE35':
+			tag.values[i] = name + sep + _retimed_base64(value, segment_start - elapsed)
+
+def _retimed_base64(value, t):
+	try:
+		section = base64.b64decode(value)
+	except TypeError:
+		return value
+	return base64.b64encode(_retimed(section, t))
+
+# The same cues are repeated in all the versions of a live playlist, so let's remember what we did for them.
+_retimed_sections = {}
+
+def _retimed(section, t):
+	"""The given binary splice_info_section() with pts_adjustment set so its splice time becomes `t` seconds."""
+	ticks = int(round(t * scte35.PTS_TICKS_PER_SECOND))
+	key = (section, ticks)
+	result = _retimed_sections.get(key)
+	if result is None:
+		try:
+			splice_time = scte35.decode(section).splice_time()
+		except scte35.DecodingError:
+			splice_time = None
+		if splice_time is None:
+			# Nothing to align, e.g. splice_null() or an immediate splice_insert().
+			result = section
+		else:
+			result = scte35.with_pts_adjustment(section, ticks - splice_time)
+		if len(_retimed_sections) >= 10000:
+			_retimed_sections.clear()
+		_retimed_sections[key] = result
+	return result
@@ -1,11 +1,15 @@
 # HLS tools.
 # Copyright (C) 2021, MediaMonks B.V. All rights reserved.
 
+import bisect
+import cues
 import logging
 import m3u
-import requests
+import new
+import re
 import scte35
 import time
+import upstream
 import urllib
 import urlparse
 
@@ -22,58 +26,296 @@ def url_overriding_query_param(url, name, value):
 		fragment = parsed.fragment
 	))
 	
-def rebase(playlist, playlist_url, proxy_url):
+class Rebaser:
 	
 	"""
-	Modifies the given M3U playlist so:
+	Rewrites URIs the same way as urlparse.urljoin() and url_overriding_query_param() would, 
+	but parses `playlist_url` and `proxy_url` only once, so it can be reused for all the URIs of a large playlist.
+	
+	- absolute(uri) returns `uri` made absolute relative to `playlist_url`;
+	- proxied(uri) returns the absolute version of `uri` passed via `proxy_url` in its `name` query parameter
+	  (along with its signature in the `signature_name` one, when `sign` is given).
+	"""
+	
+	# A URI with a scheme and an authority, which is what all the absolute URIs in playlists look like in practice.
+	_absolute_re = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://')
+	
+	# A relative path that urljoin() would simply append to the "directory" of the base URL: 
+	# no scheme, no leading slash, query or fragment, and no dot segments (checked separately).
+	_simple_relative_re = re.compile(r'^[^/.?#;:][^:]*$')
+	
+	# Something that is left intact by urlencode() and is unlikely to appear in a URL by itself.
+	_placeholder = 'HLSEDURIPLACEHOLDER'
+	
+	def __init__(self, playlist_url, proxy_url = None, name = "url", sign = None, signature_name = "sig"):
+		
+		self.playlist_url = playlist_url
+		
+		parsed = urlparse.urlparse(playlist_url)
+		if parsed.scheme and parsed.netloc:
+			directory = parsed.path[:parsed.path.rfind('/') + 1]
+			if not directory.startswith('/'):
+				directory = '/' + directory
+			self._base_directory = "%s://%s%s" % (parsed.scheme, parsed.netloc, directory)
+		else:
+			# Unusual base URLs are always handled by urljoin().
+			self._base_directory = None
+			
+		# Segment URIs are unique, but the URIs of keys and init sections are repeated a lot.
+		self._absolute = {}
+		
+		self._proxy_url = proxy_url
+		self._name = name
+		self._sign = sign
+		self._signature_name = signature_name
+		self._proxy_template = None
+		if proxy_url is not None:
+			# Instead of replicating the way the URL is re-assembled, let's do it once with a placeholder value 
+			# and then only substitute the (encoded) value for every URI.
+			template = url_overriding_query_param(proxy_url, name, Rebaser._placeholder)
+			marker = urllib.urlencode([(name, Rebaser._placeholder)])
+			if template.count(marker) == 1:
+				prefix, suffix = template.split(marker)
+				self._proxy_template = (prefix + urllib.quote_plus(str(name)) + '=', suffix)
+				
+	def absolute(self, uri):
+		
+		if Rebaser._absolute_re.match(uri):
+			return uri
+			
+		result = self._absolute.get(uri)
+		if result is not None:
+			return result
+		
+		if self._base_directory is not None and Rebaser._simple_relative_re.match(uri) and '/.' not in uri:
+			result = self._base_directory + uri
+		else:
+			result = urlparse.urljoin(self.playlist_url, uri)
+		
+		self._absolute[uri] = result
+		return result
+		
+	def proxied(self, uri):
+		
+		assert(self._proxy_url is not None)
+		
+		absolute_uri = self.absolute(uri)
+		if self._proxy_template:
+			prefix, suffix = self._proxy_template
+			result = prefix + urllib.quote_plus(str(absolute_uri)) + suffix
+		else:
+			result = url_overriding_query_param(self._proxy_url, self._name, absolute_uri)
+		if self._sign is not None:
+			result += '&%s=%s' % (self._signature_name, self._sign(absolute_uri))
+		return result
+	
+def rebase(playlist, playlist_url, proxy_url, segment_proxy_url = None):
+	
+	"""
+	Modifies the given M3U playlist (m3u.Playlist or m3u.View) so:
 	- all relative URIs are becoming absolute relative to `playlist_url`;
 	- all stream variant playlist URIs (in a master playlist) are proxied via `proxy_url` in its 'url' 
-	  query string parameter.
+	  query string parameter;
+	- if `segment_proxy_url` is given, then segments, init sections (EXT-X-MAP) and keys (EXT-X-KEY) 
+	  of a media playlist are proxied via that URL in the same way, signed (see upstream.segment_signature()).
+	
+	See RebaseStage for the version that can be combined with other transformations in a Pipeline.
 	"""
 	
-	def make_absolute(uri):
-		return urlparse.urljoin(playlist_url, uri) 
-			
-	# Let's fix up relative URIs in attributes of most of the tags except the ones that will be proxied.
-	proxied_tags = ['EXT-X-I-FRAME-STREAM-INF', 'EXT-X-MEDIA']
-	for tag in playlist.all_tags():
-		if tag.name not in proxied_tags and tag.attributes:
-			# We could be checking tags by names, but all the valid tags use 'URI' attributes similarly.
-			uri_attr = tag.attributes.get('URI')
-			if uri_attr:
-				uri_attr.value = make_absolute(uri_attr.value)
-	
-	if playlist.is_master_playlist:
-		# All URIs in a master playlist point to media playlists, which we need to proxy via us.
-		# We also need to make original URLs absolute as we are changing the base URL now.
-		for item in playlist.uris:			
-			item.uri = url_overriding_query_param(proxy_url, "url", make_absolute(item.uri))
-		# Some tags refer to playlists as well and we need to proxy them too.
-		for tag in playlist.globals:
-			if tag.name in proxied_tags:
-				uri_attr = tag.attributes.get('URI')
-				if uri_attr:
-					uri_attr.value = url_overriding_query_param(proxy_url, "url", make_absolute(uri_attr.value))
-	else:
-		# For media playlists we need to make sure that all segments use absolute URIs.
-		for item in playlist.uris:
-			item.uri = make_absolute(item.uri)
+	return Pipeline([RebaseStage(playlist_url, proxy_url, segment_proxy_url)]).apply(playlist)
+
+class Stage:
 	
-	return playlist
+	"""
+	A single transformation of a playlist that can be combined with others into a Pipeline, 
+	so all of them are applied in one pass over the segments.
+	
+	Subclasses override start() and set the below fields there as needed:
+	
+	- map_tag_uri: func(tag, uri) returning a new URI attribute for the given tag;
+	- map_uri: func(uri) returning a new URI for the given segment or variant;
+	- uri_tags: func(index) returning a list of tags (or None) to insert before the tags of the segment 
+	  with the given index;
+	- window_duration: if not None, then only the segments ending within this many seconds 
+	  from the beginning of the playlist are kept.
+	
+	The time start() takes is measured under `name` (with the optional `desc`, see metrics.StageTimer).
+	"""
+	
+	name = 'stage'
+	desc = None
+	map_tag_uri = None
+	map_uri = None
+	uri_tags = None
+	window_duration = None
+	
+	def start(self, playlist):
+		"""Called before the pass over the segments, this is where global tags can be changed."""
+		pass
+
+class Pipeline:
+	
+	"""
+	Applies a list of stages (see Stage) to a playlist (m3u.Playlist or m3u.View) in a single pass: 
+	the URIs of every tag and segment are mapped by all the stages at once and the pass stops 
+	as soon as the shortest window of the stages is reached, so nothing is done for the segments beyond it.
+	
+	The URIs of the global tags added by the stages are not mapped (the same as if the stages were applied one by one).
+	
+	With a `timer` (metrics.StageTimer) the start() of every stage is measured under its own name 
+	and the pass over the segments under 'single_pass'.
+	"""
+	
+	def __init__(self, stages):
+		self.stages = stages
+	
+	def apply(self, playlist, timer = None):
+		
+		existing_globals = set(map(id, playlist.globals)) if isinstance(playlist, m3u.Playlist) else None
+		
+		for stage in self.stages:
+			stage.start(playlist)
+			if timer:
+				timer.lap(stage.name, stage.desc)
+		
+		self._walk(playlist, existing_globals)
+		if timer:
+			timer.lap('single_pass', 'single pass')
+		return playlist
+	
+	def _walk(self, playlist, existing_globals):
+		
+		tag_funcs = [s.map_tag_uri for s in self.stages if s.map_tag_uri is not None]
+		uri_funcs = [s.map_uri for s in self.stages if s.map_uri is not None]
+		uri_tag_funcs = [s.uri_tags for s in self.stages if s.uri_tags is not None]
+		durations = [s.window_duration for s in self.stages if s.window_duration is not None]
+		window_duration = min(durations) if durations else None
+		
+		if len(tag_funcs) == 1:
+			map_tag_uri = tag_funcs[0]
+		elif tag_funcs:
+			def map_tag_uri(tag, uri):
+				for func in tag_funcs:
+					uri = func(tag, uri)
+				return uri
+		else:
+			map_tag_uri = None
+		
+		if len(uri_funcs) == 1:
+			map_uri = uri_funcs[0]
+		elif uri_funcs:
+			def map_uri(uri):
+				for func in uri_funcs:
+					uri = func(uri)
+				return uri
+		else:
+			map_uri = None
+		
+		if isinstance(playlist, m3u.View):
+			# Views apply everything in a single pass when rendered anyway, so we only need to record the changes.
+			if window_duration is not None:
+				playlist.set_window(window_length(playlist.segment_ends(), window_duration))
+			if map_tag_uri is not None:
+				playlist.map_tag_uris(map_tag_uri)
+			if map_uri is not None:
+				playlist.map_uris(map_uri)
+			for func in uri_tag_funcs:
+				playlist.insert_uri_tags(func)
+			return
+		
+		# Tags like EXT-X-KEY are shared by all the URIs they apply to, so let's make sure we map them once.
+		seen = set()
+		
+		def map_tags(tags):
+			for tag in tags:
+				if tag.attributes and id(tag) not in seen:
+					seen.add(id(tag))
+					uri_attr = tag.attributes.get('URI')
+					if uri_attr:
+						uri_attr.value = map_tag_uri(tag, uri_attr.value)
+		
+		if map_tag_uri is not None:
+			map_tags(filter(lambda t: id(t) in existing_globals, playlist.globals))
+		
+		if map_tag_uri is None and map_uri is None and not uri_tag_funcs and window_duration is None:
+			return
+		
+		segment_end = 0
+		for index, u in enumerate(playlist.uris):
+			if window_duration is not None:
+				segment_end += u.duration()
+				if segment_end > window_duration:
+					playlist.set_window(index)
+					break
+			if map_tag_uri is not None:
+				map_tags(u.tags)
+			if map_uri is not None:
+				u.uri = map_uri(u.uri)
+			for func in uri_tag_funcs:
+				tags = func(index)
+				if tags:
+					u.tags[0:0] = tags
+
+class RebaseStage(Stage):
+	
+	"""The transformation of rebase() as a Stage."""
+	
+	name = 'rebase'
+	
+	def __init__(self, playlist_url, proxy_url, segment_proxy_url = None):
+		self.playlist_url = playlist_url
+		self.proxy_url = proxy_url
+		self.segment_proxy_url = segment_proxy_url
+	
+	def start(self, playlist):
+		
+		is_master = playlist.is_master_playlist
+		
+		rebaser = Rebaser(self.playlist_url, self.proxy_url)
+		make_absolute = rebaser.absolute
+		
+		if self.segment_proxy_url is not None and not is_master:
+			proxy_segment = Rebaser(self.playlist_url, self.segment_proxy_url, sign = upstream.segment_signature).proxied
+			segment_tags = ['EXT-X-MAP', 'EXT-X-KEY']
+		else:
+			proxy_segment = None
+			segment_tags = []
+		
+		# Some tags in master playlists refer to playlists as well and we need to proxy them too.
+		proxied_tags = ['EXT-X-I-FRAME-STREAM-INF', 'EXT-X-MEDIA']
+		
+		# We could be checking tags by names, but all the valid tags use 'URI' attributes similarly.
+		def tag_uri(tag, uri):
+			if tag.name in proxied_tags:
+				if is_master:
+					return rebaser.proxied(uri)
+				return uri
+			if tag.name in segment_tags and _proxiable_re.match(make_absolute(uri)):
+				return proxy_segment(uri)
+			return make_absolute(uri)
+		self.map_tag_uri = tag_uri
+		
+		if is_master:
+			# All URIs in a master playlist point to media playlists, which we need to proxy via us.
+			# We also need to make original URLs absolute as we are changing the base URL now.
+			self.map_uri = rebaser.proxied
+		elif proxy_segment is not None:
+			self.map_uri = proxy_segment
+		else:
+			# For media playlists we need to make sure that all segments use absolute URIs.
+			self.map_uri = make_absolute
+
+# Only these can be fetched by us, keys can use other schemes, e.g. 'skd://' for FairPlay.
+_proxiable_re = re.compile(r'^https?://', re.IGNORECASE)
 	
 def download_and_rebase(playlist_url, proxy_url):
 	
 	"""
 	Downloads and returns an HLS playlist from `playlist_url` rebasing all the URIs in it along the way (see rebase()).
+	The playlist is cached the same way as the ones of /v1/eventify (see upstream.get_playlist()).
 	"""
 	
-	r = requests.get(playlist_url)
-	r.raise_for_status()
-	content_type = r.headers.get('content-type')
-	if content_type not in ['application/vnd.apple.mpegurl', 'audio/mpegurl', 'vnd.apple.mpegurl', 'application/x-mpegurl']:
-		raise Exception("The playlist has unsupported content type ('%s')" % (content_type,))
-
-	playlist = m3u.Playlist(r.text) 
+	playlist, hit = upstream.get_playlist(playlist_url)
 	rebase(playlist, playlist_url, proxy_url)
 	return playlist
 
@@ -85,7 +327,51 @@ def start_time_and_effective_duration(playlist, event_duration, ref_time, curren
 	return start_time, effective_duration
 
 def time_as_iso8601(t):
-	return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(t))
+	"""The given Unix time as an ISO 8601 string in UTC with milliseconds, e.g. '2021-02-03T09:47:58.123Z'."""
+	ms = int(round(t * 1000))
+	day, ms = divmod(ms, 86400 * 1000)
+	seconds, ms = divmod(ms, 1000)
+	minutes, seconds = divmod(seconds, 60)
+	hours, minutes = divmod(minutes, 60)
+	# Only the date part needs the calendar and it's the same for all the times in a playlist.
+	prefix = _date_prefixes.get(day)
+	if prefix is None:
+		if len(_date_prefixes) >= 1024:
+			_date_prefixes.clear()
+		prefix = _date_prefixes[day] = time.strftime("%Y-%m-%dT", time.gmtime(day * 86400))
+	return "%s%02d:%02d:%02d.%03dZ" % (prefix, hours, minutes, seconds, ms)
+
+_date_prefixes = {}
+
+class ProgramDateTimeIndex:
+	
+	"""
+	Maps the real time to the segments of a media playlist and back, given the real time of the beginning 
+	of the playlist and the end times of its segments relative to it (see m3u.Playlist.segment_ends()).
+	"""
+	
+	def __init__(self, start_time, segment_ends):
+		self.start_time = start_time
+		self.segment_ends = segment_ends
+	
+	def segment_start(self, index):
+		"""The real time of the beginning of the segment with the given index."""
+		if index == 0:
+			return self.start_time
+		return self.start_time + self.segment_ends[index - 1]
+	
+	def segment_at(self, t):
+		"""The index of the segment playing at the real time `t` or None if it's outside of the playlist."""
+		if t < self.start_time:
+			return None
+		index = bisect.bisect_right(self.segment_ends, t - self.start_time)
+		if index >= len(self.segment_ends):
+			return None
+		return index
+	
+	def tag(self, index):
+		"""The EXT-X-PROGRAM-DATE-TIME tag for the segment with the given index."""
+		return m3u.Tag('#EXT-X-PROGRAM-DATE-TIME:' + time_as_iso8601(self.segment_start(index)))
 
 CUE_STYLE_IN_OUT = 0
 CUE_STYLE_BUG_OUT = 1
@@ -111,56 +397,94 @@ def insert_ad_cues(
 	See event_to_vod() for the other parameters.
 	"""
 	
-	assert(isinstance(playlist, m3u.Playlist) and not playlist.is_master_playlist)	
+	Pipeline([AdCuesStage(event_duration, ref_time, current_time, time_between_ads, ad_duration, style)]).apply(playlist)
 
-	start_time, length = start_time_and_effective_duration(playlist, event_duration, ref_time, current_time)
+class AdCuesStage(Stage):
+	
+	"""The transformation of insert_ad_cues() as a Stage."""
+	
+	name = 'insert_ad_cues'
+	desc = 'ad cues'
+	
+	def __init__(self, event_duration, ref_time, current_time, time_between_ads, ad_duration, style = CUE_STYLE_IN_OUT):
+		self.event_duration = event_duration
+		self.ref_time = ref_time
+		self.current_time = current_time
+		self.time_between_ads = time_between_ads
+		self.ad_duration = ad_duration
+		self.style = style
+	
+	def start(self, playlist):
+		
+		assert(isinstance(playlist, (m3u.Playlist, m3u.View)) and not playlist.is_master_playlist)	
 		
+		start_time, length = start_time_and_effective_duration(
+			playlist, self.event_duration, self.ref_time, self.current_time
+		)
+		
+		for t, tag in ad_cues(start_time, self.time_between_ads, self.ad_duration, self.style):
+			if self.current_time < t:
+				break
+			playlist.add_global_tag(tag)
+
+def ad_cues(start_time, time_between_ads, ad_duration, style = CUE_STYLE_IN_OUT):
+	
+	"""
+	Generates all the ad cue tags (see insert_ad_cues()) for the event starting at `start_time` in order, 
+	as tuples with the time of the cue and the tag. The sequence is infinite.
+	"""
+	
 	def tag(index, attrs):
 		# I don't have a non-raw initializer just yet, but it should be safe to concatenate here.
 		return m3u.Tag('#EXT-X-DATERANGE:ID="ad%d",%s' % (index, ','.join(attrs)))
 	
-	def out_tag(index, t, duration):
+	def out_tag(index, t, duration, section):
 		attrs = []
 		attrs.append('START-DATE="%s"' % (time_as_iso8601(t),))
 		attrs.append('PLANNED-DURATION=%.2f' % (duration,))
-		if style == CUE_STYLE_IN_OUT:
-			attrs.append('SCTE35-OUT=0x%s' % (scte35.splice_info_with_splice_insert(index, True, t - start_time)))
-		elif style == CUE_STYLE_BUG_OUT:
-			attrs.append('SCTE35-OUT=0x%s' % (scte35.splice_info_with_splice_insert(index, True, t - start_time, duration, True)))
-		else:
-			assert(False)
+		attrs.append('SCTE35-OUT=0x%s' % (section,))
 		return tag(index, attrs)
 
-	def in_tag(index, t, duration):
+	def in_tag(index, t, duration, section):
 		attrs = []
 		attrs.append('END-DATE="%s"' % (time_as_iso8601(t),))
 		attrs.append('DURATION=%.2f' % (duration,))
+		if section is not None:
+			attrs.append('SCTE35-IN=0x%s' % (section,))
+		return tag(index, attrs)
+	
+	def sections(index, out_time, in_time):
+		"""The arguments of scte35.splice_info_with_splice_insert() for the OUT and IN cues of a single ad."""
 		if style == CUE_STYLE_IN_OUT:
-			attrs.append('SCTE35-IN=0x%s' % (scte35.splice_info_with_splice_insert(index, False, t - start_time)))
+			return [(index, True, out_time - start_time), (index, False, in_time - start_time)]
 		elif style == CUE_STYLE_BUG_OUT:
 			# Elemental does not produce SCTE35 for the IN cue because it's using auto_return in break_duration().
-			pass
+			return [(index, True, out_time - start_time, ad_duration, True)]
 		else:
 			assert(False)
-		return tag(index, attrs)
-
+	
+	# The SCTE-35 sections are encoded in batches, which grow in case many ads are needed.
+	batch_size = 4
 	index = 0
 	t = start_time
 	while True:
-		t += time_between_ads
-		if current_time < t:
-			break
-		playlist.globals.append(out_tag(index, t, ad_duration))
-		# playlist.globals.append(single_tag(index, t, ad_duration))
-
-		t += ad_duration
-		if current_time < t:
-			break
-		playlist.globals.append(in_tag(index, t, ad_duration))
 		
-		index += 1
-	
-	return
+		ads = []
+		splices = []
+		for i in range(batch_size):
+			t += time_between_ads
+			out_time = t
+			t += ad_duration
+			ads.append((index + i, out_time, t))
+			splices += sections(index + i, out_time, t)
+		encoded = iter(scte35.splice_infos_with_splice_insert(splices))
+		
+		for ad_index, out_time, in_time in ads:
+			yield out_time, out_tag(ad_index, out_time, ad_duration, next(encoded))
+			yield in_time, in_tag(ad_index, in_time, ad_duration, next(encoded) if style == CUE_STYLE_IN_OUT else None)
+		
+		index += batch_size
+		batch_size = min(batch_size * 2, 256)
 
 def event_to_vod(
 	playlist, 
@@ -168,14 +492,15 @@ def event_to_vod(
 	ref_time, 
 	current_time, 
 	program_date_time = False,
-	logger = logging.getLogger(__name__)
+	logger = logging.getLogger(__name__),
+	program_date_time_interval = 0
 ):
 	
 	"""
 	This is to turn a regular or EVENT media playlist into a VOD after some time passes. 
 
 	Parameters:
-	- playlist: -
+	- playlist: m3u.Playlist or m3u.View.
 	- event_duration: How long the stream is expected to stay in the EVENT mode, seconds.
 	- ref_time: The real time (Unix timestamp) the streaming started. 
 		This is not the real time of the first sample of the stream, which is calculated to be a bit earlier 
@@ -185,36 +510,144 @@ def event_to_vod(
 	- program_date_time: If True, then the real time information corresponding to ref_time is embedded 
 		into the playlist via a single `EXT-X-PROGRAM-DATE-TIME` tag before the first segment.
 	- logger: -
+	- program_date_time_interval: If positive (and `program_date_time` is True), then every Nth segment 
+		starting from the first one gets its own `EXT-X-PROGRAM-DATE-TIME` tag instead of the single one.
 	"""
 	
-	assert(isinstance(playlist, m3u.Playlist) and not playlist.is_master_playlist)	
+	Pipeline([EventToVODStage(
+		event_duration, ref_time, current_time, program_date_time, logger, program_date_time_interval
+	)]).apply(playlist)
+
+class EventToVODStage(Stage):
+	
+	"""The transformation of event_to_vod() as a Stage."""
+	
+	name = 'event_to_vod'
+	desc = 'window'
 	
-	playlist.remove_global_tag('EXT-X-PLAYLIST-TYPE')
-	playlist.remove_global_tag('EXT-X-ENDLIST')
+	def __init__(
+		self, event_duration, ref_time, current_time, program_date_time = False, logger = logging.getLogger(__name__),
+		program_date_time_interval = 0
+	):
+		self.event_duration = event_duration
+		self.ref_time = ref_time
+		self.current_time = current_time
+		self.program_date_time = program_date_time
+		self.logger = logger
+		self.program_date_time_interval = program_date_time_interval
+	
+	def start(self, playlist):
+		
+		assert(isinstance(playlist, (m3u.Playlist, m3u.View)) and not playlist.is_master_playlist)	
+		
+		playlist.remove_global_tag('EXT-X-PLAYLIST-TYPE')
+		playlist.remove_global_tag('EXT-X-ENDLIST')
+		
+		start_time, effective_duration = start_time_and_effective_duration(
+			playlist, self.event_duration, self.ref_time, self.current_time
+		)
+		
+		# Let's embed the real time tags along the way.
+		if self.program_date_time:
+			interval = self.program_date_time_interval
+			if interval > 0:
+				index = ProgramDateTimeIndex(start_time, playlist.segment_ends())
+				self.uri_tags = lambda i: [index.tag(i)] if i % interval == 0 else None
+			else:
+				playlist.add_global_tag(m3u.Tag('#EXT-X-PROGRAM-DATE-TIME:' + time_as_iso8601(start_time)))
+		
+		# Only the segments fitting the effective duration are left.
+		self.window_duration = effective_duration
+		
+		# Where are we within the period.
+		if self.current_time - start_time <= self.event_duration:
+			# We are within the event's duration. Regular or EVENT mode.
+			self.logger.debug("EVENT mode")	
+			# TODO: allow to use the regular mode (i.e. when no tag is specified)
+			playlist.add_global_tag(m3u.Tag('#EXT-X-PLAYLIST-TYPE:EVENT'))
+		else:
+			# The event is over. VOD mode.
+			self.logger.debug("VOD mode")	
+			playlist.add_global_tag(m3u.Tag('#EXT-X-PLAYLIST-TYPE:VOD'))
+			playlist.add_global_tag(m3u.Tag('#EXT-X-ENDLIST'))
 
-	start_time, effective_duration = start_time_and_effective_duration(playlist, event_duration, ref_time, current_time)
+class UpstreamCuesStage(Stage):
 	
-	# Let's embed the real time tag along the way.
-	playlist.globals.append(m3u.Tag('#EXT-X-PROGRAM-DATE-TIME:' + time_as_iso8601(start_time)))
-			
-	uris = []
-	segment_end = 0
-	for u in playlist.uris:
-		segment_end += u.duration()
-		if segment_end > effective_duration:
-			break
-		uris.append(u)
-
-	playlist.uris = uris
-	
-	# Where are we within the period.
-	if current_time - start_time <= event_duration:
-		# We are within the event's duration. Regular or EVENT mode.
-		logger.debug("EVENT mode")	
-		# TODO: allow to use the regular mode (i.e. when no tag is specified)
-		playlist.globals.append(m3u.Tag('#EXT-X-PLAYLIST-TYPE:EVENT'))
-	else:
-		# The event is over. VOD mode.
-		logger.debug("VOD mode")	
-		playlist.globals.append(m3u.Tag('#EXT-X-PLAYLIST-TYPE:VOD'))
-		playlist.globals.append(m3u.Tag('#EXT-X-ENDLIST'))
+	"""
+	Shifts the dates of the EXT-X-DATERANGE tags of the upstream playlist to the event starting at `ref_time` 
+	(see event_to_vod()), leaving only the ones that have started by `current_time`. This is possible only 
+	when the first segment has a date (EXT-X-PROGRAM-DATE-TIME), otherwise the tags are left as is.
+	
+	The times in their SCTE-35 sections are shifted already when the playlist is parsed, see cues.retime().
+	"""
+	
+	name = 'upstream_cues'
+	desc = 'upstream cues'
+	
+	def __init__(self, event_duration, ref_time, current_time):
+		self.event_duration = event_duration
+		self.ref_time = ref_time
+		self.current_time = current_time
+	
+	def start(self, playlist):
+		
+		assert(isinstance(playlist, (m3u.Playlist, m3u.View)) and not playlist.is_master_playlist)	
+		
+		tags = playlist.global_tags('EXT-X-DATERANGE')
+		if not tags:
+			return
+		try:
+			first_date = cues.program_date_time(playlist.uri_tag_by_name(0, 'EXT-X-PROGRAM-DATE-TIME'))
+		except IndexError:
+			# No segments.
+			return
+		if first_date is None:
+			return
+		
+		start_time, effective_duration = start_time_and_effective_duration(
+			playlist, self.event_duration, self.ref_time, self.current_time
+		)
+		playlist.remove_global_tag('EXT-X-DATERANGE')
+		for tag in redated_dateranges(tags, start_time - first_date, self.current_time):
+			playlist.add_global_tag(tag)
+
+def redated_dateranges(tags, shift, current_time):
+	"""
+	Copies of the given EXT-X-DATERANGE tags with their dates shifted by `shift` seconds, 
+	only the ones starting by `current_time` (or having no start date).
+	"""
+	result = []
+	for tag in tags:
+		start, redated = _redated_daterange(tag, shift)
+		if start is None or start <= current_time:
+			result.append(redated)
+	return result
+
+# The same tags are shifted by the same amount for all the requests of an event.
+_redated_dateranges = {}
+
+def _redated_daterange(tag, shift):
+	key = (tag.text(), shift)
+	result = _redated_dateranges.get(key)
+	if result is None:
+		start, end = cues.daterange_times(tag)
+		redated = new.instance(m3u.Tag, dict(tag.__dict__))
+		redated.attributes = dict(tag.attributes)
+		if start is not None:
+			start += shift
+			redated.attributes['START-DATE'] = m3u.Tag.StringValue(time_as_iso8601(start))
+		if end is not None:
+			redated.attributes['END-DATE'] = m3u.Tag.StringValue(time_as_iso8601(end + shift))
+		result = (start, redated)
+		if len(_redated_dateranges) >= 10000:
+			_redated_dateranges.clear()
+		_redated_dateranges[key] = result
+	return result
+
+def window_length(segment_ends, duration):
+	"""How many segments with the given end times (see m3u.Playlist.segment_ends()) fit the given duration."""
+	n = bisect.bisect_right(segment_ends, duration)
+	# Just in case of segments with negative durations, which would make the end times unordered.
+	while n > 0 and segment_ends[n - 1] > duration:
+		n -= 1
+	return n
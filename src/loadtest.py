@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# A load test simulating many players polling /v1/eventify, to see how many of them a proxy can handle.
+#
+# Every simulated player fetches the master playlist via the proxy, picks a random variant and then reloads
+# the media playlist every target duration (like real players do for live streams), optionally fetching
+# the new segments as well. By default the stream comes from a synthetic stand-in origin running in this process,
+# so nothing else is needed except the proxy being tested, which can be started here as well:
+#
+#	python ./src/loadtest.py --start-proxy --players 500 --time 60
+#
+# The report includes the throughput, latency percentiles and error rates per kind of request, as well as CPU time
+# and memory used by the proxy (when it runs on the same machine), so the capacity per core can be estimated.
+
+from flask import Flask
+import argparse
+import bench
+import json
+import m3u
+import origin
+import os
+import random
+import requests
+import serve
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+def percentile(sorted_values, p):
+	"""The value below which `p` percent of the values fall (nearest rank), None for an empty list."""
+	if not sorted_values:
+		return None
+	index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+	return sorted_values[index]
+
+class Stats:
+
+	"""Latencies and errors of the requests made by all the players, by the kind of request."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.latencies = {}
+		self.errors = {}
+
+	def record(self, kind, seconds, ok):
+		with self._lock:
+			if ok:
+				self.latencies.setdefault(kind, []).append(seconds)
+			else:
+				self.errors[kind] = self.errors.get(kind, 0) + 1
+
+	def summary(self, elapsed):
+		result = {}
+		for kind in sorted(set(self.latencies.keys()) | set(self.errors.keys())):
+			latencies = sorted(self.latencies.get(kind, []))
+			errors = self.errors.get(kind, 0)
+			total = len(latencies) + errors
+			result[kind] = {
+				'requests': total,
+				'errors': errors,
+				'error_rate': float(errors) / total,
+				'per_second': total / elapsed,
+				'p50_ms': _ms(percentile(latencies, 50)),
+				'p95_ms': _ms(percentile(latencies, 95)),
+				'p99_ms': _ms(percentile(latencies, 99)),
+				'max_ms': _ms(latencies[-1] if latencies else None)
+			}
+		return result
+
+def _ms(seconds):
+	if seconds is None:
+		return None
+	return round(seconds * 1000, 2)
+
+class Player:
+
+	"""A simulated player running in its own thread till `deadline`."""
+
+	def __init__(self, master_url, stats, deadline, fetch_segments = False, reload_interval = None):
+		self.master_url = master_url
+		self._proxy = urlparse.urlparse(master_url)
+		self.stats = stats
+		self.deadline = deadline
+		self.fetch_segments = fetch_segments
+		self.reload_interval = reload_interval
+		self.session = requests.Session()
+
+	def via_proxy(self, url):
+		# The proxy forces 'https' for its own URLs as it expects to be behind nginx, 
+		# while we are talking to it directly.
+		parsed = urlparse.urlparse(url)
+		if parsed.netloc == self._proxy.netloc:
+			return urlparse.urlunparse(parsed._replace(scheme = self._proxy.scheme))
+		return url
+
+	def get(self, kind, url):
+		url = self.via_proxy(url)
+		started = time.time()
+		try:
+			r = self.session.get(url, timeout = 10)
+			ok = r.status_code == 200
+		except requests.RequestException:
+			r, ok = None, False
+		self.stats.record(kind, time.time() - started, ok)
+		return r if ok else None
+
+	def run(self):
+
+		# Players retry the master playlist till they get it.
+		while time.time() < self.deadline:
+			r = self.get('master', self.master_url)
+			if r is not None:
+				break
+			time.sleep(1)
+		else:
+			return
+
+		master = m3u.Playlist(r.text)
+		if master.is_master_playlist:
+			media_url = random.choice(master.uris).uri
+		else:
+			media_url = self.master_url
+
+		fetched = set()
+		while True:
+			started = time.time()
+			r = self.get('media', media_url)
+			interval = self.reload_interval
+			if r is not None:
+				playlist = m3u.Playlist(r.text)
+				if interval is None:
+					interval = playlist.target_duration()
+				if self.fetch_segments:
+					# Only the most recent segment, like a player that keeps up with the live edge.
+					if playlist.uris and playlist.uris[-1].uri not in fetched:
+						fetched.add(playlist.uris[-1].uri)
+						self.get('segment', playlist.uris[-1].uri)
+			if interval is None:
+				interval = 1
+			delay = started + interval - time.time()
+			if time.time() + delay >= self.deadline:
+				break
+			if delay > 0:
+				time.sleep(delay)
+
+###
+
+def make_mirror(directory, variants, segment_count, segment_bytes, target_duration):
+
+	"""Creates a synthetic mirror (like the ones from download-hls.py) with the given number of variants."""
+
+	master = ["#EXTM3U"]
+	for v in range(variants):
+		bandwidth = (v + 1) * 1000000
+		master.append("#EXT-X-STREAM-INF:BANDWIDTH=%d" % (bandwidth,))
+		master.append("variants/%d/variant.m3u8" % (v,))
+		variant_dir = os.path.join(directory, "variants", str(v))
+		os.makedirs(os.path.join(variant_dir, "media"))
+		with open(os.path.join(variant_dir, "variant.m3u8"), "w") as f:
+			f.write(bench.large_media_playlist_text(segment_count, target_duration))
+		# The content does not matter, so let's create one file and link it instead of wasting the space.
+		first_path = os.path.join(variant_dir, "media", "segment0.ts")
+		with open(first_path, "wb") as f:
+			f.write(os.urandom(segment_bytes))
+		for i in range(1, segment_count):
+			os.link(first_path, os.path.join(variant_dir, "media", "segment%d.ts" % (i,)))
+	with open(os.path.join(directory, "index.m3u8"), "w") as f:
+		f.write("\n".join(master))
+
+def start_origin(mirrors_dir, port):
+	"""Serves the mirrors in a background thread of this process, returns the server."""
+	origin.aliases.MIRRORS_DIR = mirrors_dir
+	origin_app = Flask(__name__)
+	origin_app.register_blueprint(origin.blueprint)
+	server = serve.PooledWSGIServer('127.0.0.1', port, origin_app, 16, handler = origin.SendfileRequestHandler)
+	t = threading.Thread(target = server.serve_forever, name = 'Origin')
+	t.daemon = True
+	t.start()
+	return server
+
+def start_proxy(port, workers, threads, cache_dir):
+	"""Starts serve.py as a separate process and waits till it is ready."""
+	process = subprocess.Popen([
+		sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py'),
+		'-p', str(port), '-w', str(workers), '-t', str(threads), '-c', cache_dir,
+		# Refreshing the examples in the background would only skew the measurements.
+		'--warm-aliases', ''
+	])
+	for i in range(100):
+		try:
+			requests.get('http://127.0.0.1:%d/' % (port,), timeout = 1)
+			return process
+		except requests.RequestException:
+			time.sleep(0.1)
+	process.terminate()
+	raise Exception("The proxy did not start")
+
+###
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def _proc_stat(pid):
+	# The name can contain spaces and parentheses, so the fields are counted after the last ')'.
+	with open('/proc/%d/stat' % (pid,)) as f:
+		data = f.read()
+	return data[data.rfind(')') + 2:].split()
+
+def process_tree(pid):
+	"""The given process and all its descendants (via /proc, i.e. on Linux only)."""
+	children = {}
+	for name in os.listdir('/proc'):
+		if not name.isdigit():
+			continue
+		try:
+			ppid = int(_proc_stat(int(name))[1])
+		except (IOError, IndexError, ValueError):
+			continue
+		children.setdefault(ppid, []).append(int(name))
+	result = []
+	queue = [pid]
+	while queue:
+		p = queue.pop()
+		result.append(p)
+		queue += children.get(p, [])
+	return result
+
+def resource_usage(pids):
+	"""A tuple with the total CPU time (seconds) and resident memory (bytes) of the given processes."""
+	cpu = 0.0
+	rss = 0
+	for pid in pids:
+		try:
+			fields = _proc_stat(pid)
+		except IOError:
+			continue
+		# utime and stime are the fields 14 and 15, rss is 24 (see proc(5)), we've skipped the first two.
+		cpu += float(int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+		rss += int(fields[21]) * _PAGE_SIZE
+	return cpu, rss
+
+class ResourceMonitor:
+
+	"""Samples the CPU time and memory of the proxy processes every second."""
+
+	def __init__(self, pid):
+		self.pid = pid
+		self.max_rss = 0
+		self._stopped = threading.Event()
+		self._pids = process_tree(pid)
+		self.cpu_started = self._sample()
+		self.cpu_used = 0
+
+	def _sample(self):
+		cpu, rss = resource_usage(self._pids)
+		self.max_rss = max(self.max_rss, rss)
+		return cpu
+
+	def start(self):
+		self._thread = threading.Thread(target = self._run, name = 'ResourceMonitor')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _run(self):
+		while not self._stopped.wait(1):
+			# Workers can be restarted.
+			self._pids = process_tree(self.pid)
+			self._sample()
+
+	def stop(self):
+		self._stopped.set()
+		self._thread.join()
+		self.cpu_used = self._sample() - self.cpu_started
+
+###
+
+def print_report(report):
+	print("")
+	print("%d player(s) for %.1f s:" % (report['players'], report['elapsed']))
+	print("%-10s %10s %10s %8s %10s %10s %10s %10s" % ('', 'requests', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+	for kind, s in sorted(report['requests'].items()):
+		print("%-10s %10d %10.1f %7.2f%% %10s %10s %10s %10s" % (
+			kind, s['requests'], s['per_second'], s['error_rate'] * 100,
+			s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms']
+		))
+	proxy = report.get('proxy')
+	if proxy:
+		print("")
+		print("Proxy CPU: %.2f s (%.2f cores), max RSS: %.1f MB, %.0f requests per CPU second" % (
+			proxy['cpu_seconds'], proxy['cores'], proxy['max_rss_bytes'] / 1048576.0, proxy['requests_per_cpu_second']
+		))
+
+def main():
+
+	parser = argparse.ArgumentParser(description = "Simulates players polling /v1/eventify.")
+	parser.add_argument("-n", "--players", type = int, default = 100, help = "The number of concurrent players.")
+	parser.add_argument("-t", "--time", type = float, default = 60, help = "How long to run the test, seconds.")
+	parser.add_argument("--proxy", default = "http://127.0.0.1:11000", help = "The base URL of the proxy to test.")
+	parser.add_argument(
+		"--start-proxy", action = "store_true",
+		help = "Start serve.py on the port of --proxy and stop it afterwards."
+	)
+	parser.add_argument("--workers", type = int, default = 1, help = "The number of workers for --start-proxy.")
+	parser.add_argument("--threads", type = int, default = 8, help = "The number of threads for --start-proxy.")
+	parser.add_argument(
+		"--proxy-pid", type = int,
+		help = "The process ID of the proxy (running on this machine) to report its CPU and memory."
+	)
+	parser.add_argument(
+		"--url",
+		help = "The playlist to pass via the proxy. A synthetic stream served from this process by default."
+	)
+	parser.add_argument("--origin-port", type = int, default = 11002, help = "The port for the synthetic origin.")
+	parser.add_argument("--variants", type = int, default = 3, help = "The number of variants of the synthetic stream.")
+	parser.add_argument("--segments", type = int, default = 500, help = "The number of segments per variant.")
+	parser.add_argument("--segment-bytes", type = int, default = 100000, help = "The size of synthetic segments.")
+	parser.add_argument("--target-duration", type = int, default = 6, help = "The target duration of the synthetic stream.")
+	parser.add_argument(
+		"--reload-interval", type = float,
+		help = "Reload media playlists this often (seconds) instead of every target duration."
+	)
+	parser.add_argument("--fetch-segments", action = "store_true", help = "Fetch the newest segment after each reload.")
+	parser.add_argument("--params", default = "duration=3600", help = "Additional query parameters for /v1/eventify.")
+	parser.add_argument("--json", help = "Save the report into this file as well, e.g. to compare runs.")
+	args = parser.parse_args()
+
+	temp_dir = tempfile.mkdtemp(prefix = 'hlsed-loadtest-')
+	origin_server = None
+	proxy_process = None
+	try:
+		playlist_url = args.url
+		if not playlist_url:
+			mirrors_dir = os.path.join(temp_dir, 'mirrors')
+			make_mirror(
+				os.path.join(mirrors_dir, 'synthetic'),
+				args.variants, args.segments, args.segment_bytes, args.target_duration
+			)
+			origin_server = start_origin(mirrors_dir, args.origin_port)
+			playlist_url = 'http://127.0.0.1:%d/synthetic/index.m3u8' % (args.origin_port,)
+
+		proxy_pid = args.proxy_pid
+		if args.start_proxy:
+			port = int(args.proxy.rsplit(':', 1)[1].split('/')[0])
+			proxy_process = start_proxy(port, args.workers, args.threads, os.path.join(temp_dir, 'cache'))
+			proxy_pid = proxy_process.pid
+
+		# All players watch the same "event", like during a real broadcast.
+		master_url = "%s/v1/eventify?url=%s&ref_time=%d&%s" % (
+			args.proxy.rstrip('/'), urllib.quote_plus(playlist_url), int(time.time()), args.params
+		)
+
+		stats = Stats()
+		monitor = None
+		if proxy_pid:
+			monitor = ResourceMonitor(proxy_pid)
+			monitor.start()
+
+		print("Starting %d player(s) for %.0f s against %s" % (args.players, args.time, master_url))
+		started = time.time()
+		deadline = started + args.time
+		threads = []
+		# Spreading the start of the players over a reload interval, so they don't poll in sync.
+		ramp_up = args.reload_interval or args.target_duration
+		for i in range(args.players):
+			player = Player(master_url, stats, deadline, args.fetch_segments, args.reload_interval)
+			t = threading.Timer(float(ramp_up) * i / args.players, player.run)
+			t.daemon = True
+			t.start()
+			threads.append(t)
+		for t in threads:
+			t.join()
+		elapsed = time.time() - started
+
+		report = {
+			'players': args.players,
+			'elapsed': elapsed,
+			'requests': stats.summary(elapsed)
+		}
+		if monitor:
+			monitor.stop()
+			total = sum(map(lambda s: s['requests'], report['requests'].values()))
+			report['proxy'] = {
+				'cpu_seconds': monitor.cpu_used,
+				'cores': monitor.cpu_used / elapsed,
+				'max_rss_bytes': monitor.max_rss,
+				'requests_per_cpu_second': total / monitor.cpu_used if monitor.cpu_used > 0 else 0
+			}
+
+		print_report(report)
+		if args.json:
+			with open(args.json, 'w') as f:
+				json.dump(report, f, indent = 2, sort_keys = True)
+
+	finally:
+		if proxy_process:
+			proxy_process.terminate()
+			proxy_process.wait()
+		if origin_server:
+			origin_server.shutdown()
+		shutil.rmtree(temp_dir, ignore_errors = True)
+
+if __name__ == '__main__':
+	main()
@@ -1,6 +1,9 @@
 # HLS tools.
 # Copyright (C) 2021, MediaMonks B.V. All rights reserved.
 
+import array
+import marshal
+import new
 import re
 
 class Playlist:
@@ -19,6 +22,9 @@ class Playlist:
 	
 	The changes in the above lists would be taken into account when the playlist is re-assembled 
 	via text() method.	
+	
+	The lists of tags are TagList objects, so looking up tags by names does not have to scan them. 
+	Plain lists can be assigned as well, they are turned into TagList objects on the first lookup.
 	"""
 		
 	def __init__(self, text):
@@ -28,7 +34,7 @@ class Playlist:
 		The parsed content can be accessed and modified via 'globals' and 'uris' fields.
 		"""
 				
-		self.globals = []
+		self.globals = TagList()
 		self.uris = []
 
 		# Tags that are applied to the next URI only.
@@ -81,7 +87,7 @@ class Playlist:
 		# Let's figure out if this is a Master or a Media Playlist.
 		is_master = False
 		is_media = False
-		for tag in self.all_tags():
+		for tag in self.iter_tags():
 			info = _TagInfo.get(tag.name)
 			if info.playlist == _TagInfo.MEDIA_ONLY:
 				is_media = True
@@ -94,52 +100,111 @@ class Playlist:
 		# I don't want to introduce a pseudo-enum here, a boolean should be OK.
 		self.is_master_playlist = is_master
 
+	def _globals(self):
+		if self.globals.__class__ is not TagList:
+			self.globals = TagList(self.globals)
+		return self.globals
+	
 	def global_tag_by_name(self, name):
-		for t in self.globals:
-			if t.name == name:
-				return t
-		return None
+		return self._globals().first(name)
 		
 	def remove_global_tag(self, name):
-		self.globals = filter(lambda t: t.name != name, self.globals)
+		self._globals().remove_all(name)
 		
 	def playlist_type(self):
 		"""
 		The value of EXT-X-PLAYLIST-TYPE tag, if there is one; '' otherwise.
 		See https://tools.ietf.org/html/rfc8216#section-4.3.3.5
 		"""
-		tag = self.global_tag_by_name('EXT-X-PLAYLIST-TYPE')
-		if tag:
-			return tag.values[0]
-		else:
-			return ''
+		return self._globals().derived('playlist_type', _playlist_type)
 			
 	def target_duration(self):
 		"""The target segment duration in seconds from EXT-X-TARGETDURATION tag, if there is one; 0 otherwise."""
-		tag = self.global_tag_by_name('EXT-X-TARGETDURATION')
-		if tag:
-			return float(tag.values[0])
-		return 0		
+		return self._globals().derived('target_duration', _target_duration)
+	
+	# The below are the lookups and modifications that are also supported by views of snapshots (see View), 
+	# so the code using only these can work with both.
+	
+	def global_tags(self, name):
+		"""All the global tags with the given name."""
+		if not self._globals().has(name):
+			return []
+		return filter(lambda t: t.name == name, self.globals)
+	
+	def uri_tag_by_name(self, index, name):
+		"""The first tag with the given name of the URI with the given index."""
+		return self.uris[index].tag_by_name(name)
+	
+	def add_global_tag(self, tag):
+		self.globals.append(tag)
+	
+	def map_uris(self, func):
+		"""Replaces every URI with what `func(uri)` returns for it."""
+		for u in self.uris:
+			u.uri = func(u.uri)
+	
+	def map_tag_uris(self, func):
+		"""Replaces the URI attribute of every tag having it with what `func(tag, uri)` returns for it."""
+		# Tags like EXT-X-KEY are shared by all the URIs they apply to, so let's make sure we do it once.
+		seen = set()
+		for tag in self.iter_tags():
+			if tag.attributes and id(tag) not in seen:
+				seen.add(id(tag))
+				uri_attr = tag.attributes.get('URI')
+				if uri_attr:
+					uri_attr.value = func(tag, uri_attr.value)
+	
+	def segment_ends(self):
+		"""A list with the end time of every URI relative to the beginning of the playlist, see URI.duration()."""
+		result = []
+		segment_end = 0
+		for u in self.uris:
+			segment_end += u.duration()
+			result.append(segment_end)
+		return result
+	
+	def set_window(self, count):
+		"""Leaves only the first `count` URIs."""
+		self.uris = self.uris[:count]
+	
+	def insert_uri_tags(self, func):
+		"""Inserts the tags returned by `func(index)` (a list or None) before the tags of every URI."""
+		for index, u in enumerate(self.uris):
+			tags = func(index)
+			if tags:
+				u.tags[0:0] = tags
 			
+	def iter_items(self):
+		"""All tags and URIs (Tag and URI objects) one by one, see items()."""
+		for t in self.globals:
+			yield t
+		for u in self.uris:
+			# TODO: skip repeating tags that work for their next occurrence
+			for t in u.tags:
+				yield t
+			yield u
+	
+	def iter_tags(self):
+		"""All tags one by one, see all_tags()."""
+		for t in self.globals:
+			yield t
+		for u in self.uris:
+			for t in u.tags:
+				yield t
+	
 	def items(self):
 		"""
 		The list of all tags and URIs (Tag and URI objects).
 		The changes in this list per se DO NOT affect the playlist, but changes in its elements do.
 		"""
-		result = []
-		result += self.globals
-		for u in self.uris:
-			# TODO: skip repeating tags that work for their next occurrence
-			result += u.tags
-			result.append(u)
-		return result
+		return list(self.iter_items())
 	
 	def all_tags(self):
 		"""
 		A list of tags only, both global and URI-specific, in the order they would appear in the saved playlist.
 		The changes in this list per se DO NOT affect the playlist, but changes in its elements do.
 		"""
-		return filter(lambda x: isinstance(x, Tag), self.items())
+		return list(self.iter_tags())
 	
 	def text(self):
 		"""A textual representation of this (possibly modified) playlist ready to be saved to a file."""
@@ -161,6 +226,134 @@ class Playlist:
 		with open(path, 'wb') as f:
 			f.write(self.text())
 				
+def _playlist_type(tags):
+	tag = tags.first('EXT-X-PLAYLIST-TYPE')
+	if tag:
+		return tag.values[0]
+	else:
+		return ''
+
+def _target_duration(tags):
+	tag = tags.first('EXT-X-TARGETDURATION')
+	if tag:
+		return float(tag.values[0])
+	return 0
+
+def _duration(tags):
+	extinf = tags.first('EXTINF')
+	if not extinf:
+		return 0
+	return float(extinf.values[0])
+
+class TagList(list):
+	
+	"""
+	A list of tags that can find them by names without scanning the list.
+	
+	The index of names is built on the first lookup and dropped whenever the list changes, 
+	so it stays consistent with the list regardless of how it's modified. The same goes for the values 
+	derived from the tags (see derived()), though these are not tracking the changes in the tags themselves, 
+	so tags should be replaced rather than edited in place if their values matter.
+	"""
+	
+	# Not overriding __init__(), so creating lists is as cheap as for plain ones.
+	_index = None
+	_derived = None
+	
+	def _changed(self):
+		self._index = None
+		self._derived = None
+	
+	def _names(self):
+		index = self._index
+		if index is None:
+			index = {}
+			for t in self:
+				# The first occurrence wins.
+				index.setdefault(t.name, t)
+			self._index = index
+		return index
+	
+	def first(self, name):
+		"""The first tag with the given name or None."""
+		return self._names().get(name)
+	
+	def has(self, name):
+		return name in self._names()
+	
+	def remove_all(self, name):
+		"""Removes all tags with the given name."""
+		if name in self._names():
+			self[:] = [t for t in self if t.name != name]
+	
+	def derived(self, key, func):
+		"""The value of `func(self)` cached till the next change of the list."""
+		derived = self._derived
+		if derived is None:
+			derived = self._derived = {}
+		try:
+			return derived[key]
+		except KeyError:
+			value = derived[key] = func(self)
+			return value
+	
+	# All the methods changing the list.
+	
+	def append(self, tag):
+		list.append(self, tag)
+		self._changed()
+	
+	def extend(self, tags):
+		list.extend(self, tags)
+		self._changed()
+	
+	def insert(self, index, tag):
+		list.insert(self, index, tag)
+		self._changed()
+	
+	def remove(self, tag):
+		list.remove(self, tag)
+		self._changed()
+	
+	def pop(self, *args):
+		result = list.pop(self, *args)
+		self._changed()
+		return result
+	
+	def sort(self, *args, **kwargs):
+		list.sort(self, *args, **kwargs)
+		self._changed()
+	
+	def reverse(self):
+		list.reverse(self)
+		self._changed()
+	
+	def __setitem__(self, index, value):
+		list.__setitem__(self, index, value)
+		self._changed()
+	
+	def __delitem__(self, index):
+		list.__delitem__(self, index)
+		self._changed()
+	
+	def __setslice__(self, i, j, value):
+		list.__setslice__(self, i, j, value)
+		self._changed()
+	
+	def __delslice__(self, i, j):
+		list.__delslice__(self, i, j)
+		self._changed()
+	
+	def __iadd__(self, tags):
+		list.extend(self, tags)
+		self._changed()
+		return self
+	
+	def __imul__(self, n):
+		list.__imul__(self, n)
+		self._changed()
+		return self
+
 class ParsingError(Exception):
 	pass
 
@@ -249,7 +442,14 @@ class _TagInfo:
 		# TODO: This ones does not seem to fit our parsing model, check.
 		Info('EXT-X-PART', 						NEXT_OCCURRENCE,	MEDIA_ONLY,			ATTR_LIST),	
 		# Seems like something outdated?
-		Info('EXT-X-ALLOWCACHE', 				GLOBAL,				MEDIA_ONLY,			SINGLE_VALUE)		
+		Info('EXT-X-ALLOWCACHE', 				GLOBAL,				MEDIA_ONLY,			SINGLE_VALUE),
+		
+		# Non-standard ad cues used by many encoders and ad insertion services, see the `cues` module.
+		# Their values differ a lot between vendors, so let's keep them as plain lists.
+		Info('EXT-X-CUE-OUT', 					NEXT_URI,			MEDIA_ONLY,			VALUE_LIST),
+		Info('EXT-X-CUE-OUT-CONT', 				NEXT_URI,			MEDIA_ONLY,			VALUE_LIST),
+		Info('EXT-X-CUE-IN', 					NEXT_URI,			MEDIA_ONLY,			NO_VALUE),
+		Info('EXT-OATCLS-SCTE35', 				NEXT_URI,			MEDIA_ONLY,			SINGLE_VALUE)
 	]
 	_known_tags_by_name = dict(map(lambda t: (t.name, t), _known_tags))
 	
@@ -274,26 +474,33 @@ class URI:
 		
 	def __str__(self):
 		return "URI: '%s', tags: %s" % (self.uri, self.tags)
+	
+	def _tags(self):
+		# The list is turned into a TagList on the first lookup, as most URIs never need one.
+		if self.tags.__class__ is not TagList:
+			self.tags = TagList(self.tags)
+		return self.tags
 		
 	def tag_by_name(self, name):
-		for t in self.tags:
-			if t.name == name:
-				return t
-		return None
+		return self._tags().first(name)
 		
 	def duration(self):
 		"""A floating-point duration of a media segment URI from its EXTINF tag; 0 if not applicable."""
-		extinf = self.tag_by_name('EXTINF')
-		if not extinf:
-			return 0
-		return float(extinf.values[0])
+		tags = self.tags
+		if tags.__class__ is TagList:
+			return tags.derived('duration', _duration)
+		# A single lookup is not worth building a TagList.
+		for t in tags:
+			if t.name == 'EXTINF':
+				return float(t.values[0])
+		return 0
 
 	def text(self):
 		return self.uri
 		
 	def remove_tag(self, name):
 		"""Removes all tags with the given name from this URI."""
-		self.tags = filter(lambda t: t.name != name, self.tags)
+		self._tags().remove_all(name)
 
 class Tag:
 	
@@ -459,3 +666,400 @@ class Tag:
 		
 	def text(self):
 		return "#%s%s" % (self.name, self._raw_value())
+
+# A compact binary form of parsed playlists, so they can be cached (see upstream), shared between processes or used
+# as fixtures (see bench) and loaded much faster than parsing them again. It's _SERIALIZED_MAGIC and the version
+# (a byte) followed by a marshalled tuple with:
+#
+# - a table of distinct strings: tag names and values, URIs, etc.;
+# - a table of distinct tag contents with already parsed values (the values are indexes in the string table);
+# - a column with the content of every tag object (the ones applying till their next occurrence, like EXT-X-KEY,
+#   are the same object for many URIs and are stored once);
+# - a table of distinct durations of the URIs;
+# - the columns of the URIs: the string, the duration and the end of its tags in a column of references to tag objects.
+#
+# The columns are arrays of the smallest unsigned numbers fitting them (see the `array` module) stored as raw bytes
+# in the native byte order, so these are meant for the same kind of machine. The objects are re-created bypassing the parsing.
+
+_SERIALIZED_MAGIC = 'M3UB'
+_SERIALIZED_VERSION = 2
+
+_value_classes = [Tag.NumberValue, Tag.HexValue, Tag.StringValue, Tag.EnumValue, Tag.ResolutionValue]
+_value_kinds = dict(map(lambda p: (p[1], p[0]), enumerate(_value_classes)))
+_numeric_kinds = frozenset([_value_kinds[Tag.NumberValue], _value_kinds[Tag.ResolutionValue]])
+
+def dumps(playlist):
+	
+	"""The given playlist serialized into a string that can be loaded via loads()."""
+	
+	strings = []
+	string_indexes = {}
+	def string(s):
+		index = string_indexes.get(s)
+		if index is None:
+			index = string_indexes[s] = len(strings)
+			strings.append(s)
+		return index
+	
+	def value(name, v):
+		if isinstance(v, Tag.ResolutionValue):
+			return (string(name), _value_kinds[Tag.ResolutionValue], v.width, v.height)
+		elif isinstance(v, Tag.NumberValue):
+			return (string(name), _value_kinds[Tag.NumberValue], v.value)
+		elif isinstance(v, Tag.Value):
+			return (string(name), _value_kinds[v.__class__], string(v.value))
+		else:
+			# Plain strings are allowed in the attributes as well.
+			return (string(name), -1, string(v))
+	
+	contents = []
+	content_indexes = {}
+	tag_contents = []
+	tag_indexes = {}
+	
+	def tag_index(tag):
+		index = tag_indexes.get(id(tag))
+		if index is None:
+			if tag.attributes is not None:
+				# The raw text of the tags without attributes can be re-created from the values.
+				content = (
+					string(tag.name), tag.value_type, None, string(tag.raw), 
+					tuple(sorted(map(lambda (name, v): value(name, v), tag.attributes.items())))
+				)
+			elif tag.values is not None:
+				content = (string(tag.name), tag.value_type, tuple(map(string, tag.values)), -1, None)
+			else:
+				content = (string(tag.name), tag.value_type, None, -1, None)
+			content_index = content_indexes.get(content)
+			if content_index is None:
+				content_index = content_indexes[content] = len(contents)
+				contents.append(content)
+			index = tag_indexes[id(tag)] = len(tag_contents)
+			tag_contents.append(content_index)
+		return index
+	
+	globals = map(tag_index, playlist.globals)
+	
+	# Durations are repeated a lot as well.
+	durations = []
+	duration_indexes = {}
+	def duration(d):
+		index = duration_indexes.get(d)
+		if index is None:
+			index = duration_indexes[d] = len(durations)
+			durations.append(d)
+		return index
+	
+	uris = []
+	uri_durations = []
+	tag_ends = []
+	tag_refs = []
+	for u in playlist.uris:
+		uris.append(string(u.uri))
+		uri_durations.append(duration(u.duration()))
+		tag_refs.extend(map(tag_index, u.tags))
+		tag_ends.append(len(tag_refs))
+	
+	return _SERIALIZED_MAGIC + chr(_SERIALIZED_VERSION) + marshal.dumps((
+		playlist.is_master_playlist, 
+		strings, 
+		contents, 
+		durations,
+		_column(tag_contents), 
+		_column(globals), 
+		_column(uris), 
+		_column(uri_durations), 
+		_column(tag_ends), 
+		_column(tag_refs)
+	), 2)
+
+def _column(values):
+	# The smallest unsigned type fitting all the values and the values as bytes.
+	top = max(values) if values else 0
+	for typecode in ['B', 'H', 'I', 'L']:
+		if top < 1 << (8 * array.array(typecode).itemsize):
+			return (typecode, array.array(typecode, values).tostring())
+	raise ValueError("Too large values to serialize")
+
+def _loaded_column((typecode, data)):
+	result = array.array(typecode)
+	result.fromstring(data)
+	return result
+
+def is_serialized(data):
+	"""True if the given string looks like a playlist serialized via dumps() rather than the text of a playlist."""
+	return data.startswith(_SERIALIZED_MAGIC) or data.startswith('(')
+
+def loads(data):
+	
+	"""A playlist serialized via dumps()."""
+	
+	if not data.startswith(_SERIALIZED_MAGIC):
+		# The format of the previous version, which can still be in the caches.
+		return _loads_v1(data)
+	version = ord(data[len(_SERIALIZED_MAGIC)])
+	if version != _SERIALIZED_VERSION:
+		raise ParsingError("Unsupported version of a serialized playlist: %s" % (version,))
+	
+	(
+		is_master, strings, contents, durations, tag_contents, globals, uris, uri_durations, tag_ends, tag_refs
+	) = marshal.loads(buffer(data, len(_SERIALIZED_MAGIC) + 1))
+	
+	# Every distinct content turns into a function creating a new tag object with it.
+	def tag_factory(content):
+		
+		name, value_type, values, raw, attributes = content
+		name = strings[name]
+		
+		if attributes is not None:
+			raw = strings[raw]
+			# Numbers and resolutions are stored as they are, everything else as strings.
+			attributes = map(
+				lambda a: (strings[a[0]], a[1], a[2] if a[1] in _numeric_kinds else strings[a[2]], a[3:]), 
+				attributes
+			)
+			def attribute_value(kind, v, rest):
+				if kind < 0:
+					return v
+				cls = _value_classes[kind]
+				if cls is Tag.ResolutionValue:
+					return new.instance(cls, { 'width': v, 'height': rest[0] })
+				else:
+					return new.instance(cls, { 'value': v })
+			return lambda: new.instance(Tag, {
+				'raw': raw, 'name': name, 'value_type': value_type, 'values': None, 
+				'attributes': dict(map(lambda (n, kind, v, rest): (n, attribute_value(kind, v, rest)), attributes))
+			})
+		
+		if values is not None:
+			values = map(lambda i: strings[i], values)
+			raw = '#%s:%s' % (name, ','.join(values))
+			return lambda: new.instance(Tag, {
+				'raw': raw, 'name': name, 'value_type': value_type, 'values': list(values), 'attributes': None
+			})
+		
+		raw = '#' + name
+		return lambda: new.instance(Tag, {
+			'raw': raw, 'name': name, 'value_type': value_type, 'values': None, 'attributes': None
+		})
+	
+	factories = map(tag_factory, contents)
+	tags = map(lambda i: factories[i](), _loaded_column(tag_contents))
+	
+	# The tags of every URI are a slice of this.
+	uri_tags = map(tags.__getitem__, _loaded_column(tag_refs))
+	tag_ends = _loaded_column(tag_ends)
+	tag_starts = [0]
+	tag_starts.extend(tag_ends[:-1])
+	
+	uri_objects = []
+	uri_class = URI
+	instance = new.instance
+	for uri, duration, start, end in zip(
+		map(strings.__getitem__, _loaded_column(uris)), 
+		map(durations.__getitem__, _loaded_column(uri_durations)), 
+		tag_starts, 
+		tag_ends
+	):
+		tags_of_uri = TagList(uri_tags[start:end])
+		# The durations are known already.
+		tags_of_uri._derived = { 'duration': duration }
+		uri_objects.append(instance(uri_class, { 'uri': uri, 'tags': tags_of_uri }))
+	
+	return new.instance(Playlist, {
+		'globals': map(tags.__getitem__, _loaded_column(globals)),
+		'uris': uri_objects,
+		'is_master_playlist': is_master
+	})
+
+def _loads_v1(data):
+	
+	version, is_master, serialized_tags, globals, uris = marshal.loads(data)
+	if version != 1:
+		raise ParsingError("Unsupported version of a serialized playlist: %s" % (version,))
+		
+	def value(a):
+		kind = a[1]
+		if kind < 0:
+			return a[2]
+		cls = _value_classes[kind]
+		if cls is Tag.ResolutionValue:
+			return new.instance(cls, { 'width': a[2], 'height': a[3] })
+		else:
+			return new.instance(cls, { 'value': a[2] })
+	
+	tags = []
+	for name, value_type, values, raw, attributes in serialized_tags:
+		if attributes is not None:
+			attributes = dict(map(lambda a: (a[0], value(a)), attributes))
+		elif values is not None:
+			raw = '#%s:%s' % (name, ','.join(values))
+		else:
+			raw = '#' + name
+		tags.append(new.instance(Tag, {
+			'raw': raw, 'name': name, 'value_type': value_type, 'values': values, 'attributes': attributes
+		}))
+	
+	return new.instance(Playlist, {
+		'globals': map(lambda i: tags[i], globals),
+		'uris': map(lambda u: URI(u[0], map(lambda i: tags[i], u[1])), uris),
+		'is_master_playlist': is_master
+	})
+
+class Snapshot:
+	
+	"""
+	An immutable version of a parsed playlist that can be shared by many threads, each transforming it 
+	in its own way via a lightweight View, which does not copy the tags or URIs.
+	
+	The given playlist is taken over by the snapshot and must not be modified afterwards.
+	"""
+	
+	# Something that cannot appear in URIs and is left intact when tags are rendered.
+	_placeholder = u'\u0000HLSEDURI\u0000'
+	
+	def __init__(self, playlist):
+		
+		self.is_master_playlist = playlist.is_master_playlist
+		self.globals = tuple(playlist.globals)
+		self.uris = tuple(map(lambda u: (u.uri, tuple(u.tags)), playlist.uris))
+		
+		self._target_duration = playlist.target_duration()
+		self._segment_ends = tuple(playlist.segment_ends())
+		
+		# Every tag is rendered once, those with URIs as a prefix and a suffix around the URI that can be changed.
+		self._rendered = {}
+		for tag in playlist.iter_tags():
+			if id(tag) not in self._rendered:
+				self._rendered[id(tag)] = Snapshot._render(tag)
+	
+	@staticmethod
+	def _render(tag):
+		uri_attr = tag.attributes.get('URI') if tag.attributes else None
+		if not uri_attr or not isinstance(uri_attr, Tag.StringValue):
+			return tag.text()
+		template = new.instance(Tag, dict(tag.__dict__))
+		template.attributes = dict(tag.attributes)
+		template.attributes['URI'] = Tag.StringValue(Snapshot._placeholder)
+		prefix, suffix = template.text().split(Snapshot._placeholder)
+		return (prefix, uri_attr.value, suffix)
+	
+	def target_duration(self):
+		return self._target_duration
+	
+	def segment_ends(self):
+		return self._segment_ends
+	
+	def view(self):
+		return View(self)
+	
+	def text(self):
+		return self.view().text()
+
+class View:
+	
+	"""
+	A modified version of a Snapshot. All the modifications are recorded and applied only when the text is rendered,
+	so creating and modifying a view costs almost nothing regardless of the size of the playlist.
+	
+	Supports the same modifications as Playlist does: remove_global_tag(), add_global_tag(), map_uris(), 
+	map_tag_uris(), insert_uri_tags() and set_window(). Note that the URIs of the added tags are not mapped.
+	"""
+	
+	def __init__(self, snapshot):
+		self.snapshot = snapshot
+		self.is_master_playlist = snapshot.is_master_playlist
+		self._removed_globals = set()
+		self._added_globals = []
+		self._uri_funcs = []
+		self._tag_uri_funcs = []
+		self._uri_tag_funcs = []
+		self._window = None
+	
+	def target_duration(self):
+		return self.snapshot.target_duration()
+	
+	def segment_ends(self):
+		ends = self.snapshot.segment_ends()
+		if self._window is not None:
+			ends = ends[:self._window]
+		return ends
+	
+	def global_tags(self, name):
+		result = []
+		if name not in self._removed_globals:
+			result += filter(lambda t: t.name == name, self.snapshot.globals)
+		result += filter(lambda t: t.name == name, self._added_globals)
+		return result
+	
+	def uri_tag_by_name(self, index, name):
+		for t in self.snapshot.uris[index][1]:
+			if t.name == name:
+				return t
+		return None
+	
+	def remove_global_tag(self, name):
+		self._removed_globals.add(name)
+		self._added_globals = filter(lambda t: t.name != name, self._added_globals)
+	
+	def add_global_tag(self, tag):
+		self._added_globals.append(tag)
+	
+	def map_uris(self, func):
+		self._uri_funcs.append(func)
+	
+	def map_tag_uris(self, func):
+		self._tag_uri_funcs.append(func)
+	
+	def insert_uri_tags(self, func):
+		self._uri_tag_funcs.insert(0, func)
+	
+	def set_window(self, count):
+		if self._window is not None:
+			count = min(count, self._window)
+		self._window = count
+	
+	def text(self):
+		
+		"""The same as Playlist.text() would return for a playlist modified in the same way."""
+		
+		snapshot = self.snapshot
+		rendered = snapshot._rendered
+		tag_uri_funcs = self._tag_uri_funcs
+		uri_funcs = self._uri_funcs
+		
+		def tag_text(tag):
+			r = rendered[id(tag)]
+			if r.__class__ is not tuple:
+				return r
+			prefix, uri, suffix = r
+			for func in tag_uri_funcs:
+				uri = func(tag, uri)
+			return prefix + uri + suffix
+		
+		nl = "\n"
+		removed = self._removed_globals
+		globals = map(tag_text, filter(lambda t: t.name not in removed, snapshot.globals))
+		globals += map(lambda t: t.text(), self._added_globals)
+		
+		parts = [nl.join(globals), nl]
+		uris = snapshot.uris if self._window is None else snapshot.uris[:self._window]
+		uri_tag_funcs = self._uri_tag_funcs
+		for index, (uri, tags) in enumerate(uris):
+			for func in uri_funcs:
+				uri = func(uri)
+			parts.append(nl)
+			if uri_tag_funcs:
+				texts = []
+				for func in uri_tag_funcs:
+					inserted = func(index)
+					if inserted:
+						texts += map(lambda t: t.text(), inserted)
+				texts += map(tag_text, tags)
+				parts.append(nl.join(texts))
+			else:
+				parts.append(nl.join(map(tag_text, tags)))
+			parts.append(nl)
+			parts.append(uri)
+			parts.append(nl)
+		return u"".join(parts).encode('utf_8')
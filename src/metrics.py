@@ -0,0 +1,383 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Minimal Prometheus-compatible metrics, so we don't depend on the client library.
+# See https://prometheus.io/docs/instrumenting/exposition_formats/ for the text format.
+#
+# When the app is served by several worker processes, then every process periodically saves a snapshot
+# of its own metrics into METRICS_DIR and the exposition merges the snapshots of all the processes.
+
+import glob
+import json
+import os
+import threading
+import time
+
+# A directory shared by all the worker processes, None for a single-process setup.
+METRICS_DIR = os.environ.get('HLSED_METRICS_DIR')
+
+# How often (seconds) each process saves its snapshot for other processes to see.
+FLUSH_INTERVAL = 1.0
+
+# Buckets (seconds) suitable for both the stages of a request and the whole request.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+_lock = threading.Lock()
+
+class _Metric:
+
+	"""
+	A family of time series with the same name differing by values of the labels.
+	Label values are passed as tuples in the same order as `label_names`.
+	"""
+
+	def __init__(self, name, help, label_names = ()):
+		self.name = name
+		self.help = help
+		self.label_names = tuple(label_names)
+		self._values = {}
+		_registry.append(self)
+
+	def _labels_text(self, labels, extra = None):
+		pairs = zip(self.label_names, labels)
+		if extra:
+			pairs.append(extra)
+		if not pairs:
+			return ''
+		return '{%s}' % (','.join(map(lambda p: '%s="%s"' % (p[0], _escape(p[1])), pairs)),)
+
+class Counter(_Metric):
+
+	type = 'counter'
+
+	def inc(self, labels = (), amount = 1):
+		with _lock:
+			self._values[labels] = self._values.get(labels, 0) + amount
+
+	def _merge(self, values, other):
+		for labels, v in other.items():
+			values[labels] = values.get(labels, 0) + v
+
+	def _lines(self, values):
+		for labels in sorted(values.keys()):
+			yield '%s%s %s' % (self.name, self._labels_text(labels), _number(values[labels]))
+
+class Histogram(_Metric):
+
+	"""Every time series is stored as a list of per-bucket counts (non-cumulative) followed by the sum."""
+
+	type = 'histogram'
+
+	def __init__(self, name, help, label_names = (), buckets = LATENCY_BUCKETS):
+		_Metric.__init__(self, name, help, label_names)
+		self.buckets = tuple(buckets)
+
+	def observe(self, value, labels = ()):
+		# The number of buckets is small, a linear scan is faster than bisect here.
+		index = 0
+		for b in self.buckets:
+			if value <= b:
+				break
+			index += 1
+		with _lock:
+			counts = self._values.get(labels)
+			if counts is None:
+				# The last bucket is +Inf, then the sum.
+				counts = [0] * (len(self.buckets) + 2)
+				self._values[labels] = counts
+			counts[index] += 1
+			counts[-1] += value
+
+	def _merge(self, values, other):
+		for labels, counts in other.items():
+			existing = values.get(labels)
+			if existing is None:
+				values[labels] = list(counts)
+			else:
+				for i, c in enumerate(counts):
+					existing[i] += c
+
+	def _lines(self, values):
+		for labels in sorted(values.keys()):
+			counts = values[labels]
+			total = 0
+			for bound, c in zip(self.buckets + ('+Inf',), counts[:-1]):
+				total += c
+				yield '%s_bucket%s %d' % (self.name, self._labels_text(labels, ('le', _number(bound))), total)
+			yield '%s_sum%s %s' % (self.name, self._labels_text(labels), _number(counts[-1]))
+			yield '%s_count%s %d' % (self.name, self._labels_text(labels), total)
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _number(value):
+	if isinstance(value, float):
+		return repr(value)
+	else:
+		return str(value)
+
+###
+
+REQUESTS = Counter(
+	'hlsed_requests_total',
+	'Requests served by endpoint and HTTP status.',
+	('endpoint', 'status')
+)
+REQUEST_SECONDS = Histogram(
+	'hlsed_request_duration_seconds',
+	'Time spent serving requests by endpoint.',
+	('endpoint',)
+)
+STAGE_SECONDS = Histogram(
+	'hlsed_stage_duration_seconds',
+	'Time spent in every stage of transforming a playlist.',
+	('stage',)
+)
+UPSTREAM_RESPONSES = Counter(
+	'hlsed_upstream_responses_total',
+	"Responses from upstream hosts by HTTP status ('error' when no response).",
+	('host', 'status')
+)
+UPSTREAM_SECONDS = Histogram(
+	'hlsed_upstream_duration_seconds',
+	'Time spent waiting for upstream hosts.',
+	('host',)
+)
+UPSTREAM_RETRIES = Counter(
+	'hlsed_upstream_retries_total',
+	'Requests to upstream hosts retried after errors.',
+	('host',)
+)
+UPSTREAM_HEDGES = Counter(
+	'hlsed_upstream_hedged_requests_total',
+	'Second requests sent to upstream hosts when the first ones took too long.',
+	('host',)
+)
+UPSTREAM_STALE = Counter(
+	'hlsed_upstream_stale_total',
+	"Expired upstream playlists used while revalidating them ('revalidate') or when the upstream failed ('error').",
+	('host', 'reason')
+)
+UPSTREAM_REJECTED = Counter(
+	'hlsed_upstream_rejected_total',
+	"Requests to upstream hosts not sent because of the concurrency limits ('queue_full' or 'queue_timeout').",
+	('host', 'reason')
+)
+UPSTREAM_QUEUE_SECONDS = Histogram(
+	'hlsed_upstream_queue_seconds',
+	'Time requests to upstream hosts waited for their turn, when they had to.',
+	('host',)
+)
+SHED_REQUESTS = Counter(
+	'hlsed_shed_requests_total',
+	"Requests answered with 503 right away because the server was saturated ('queue_full' or 'queue_timeout').",
+	('reason',)
+)
+QUEUE_SECONDS = Histogram(
+	'hlsed_queue_seconds',
+	'Time requests waited for a free thread of the server.'
+)
+WARM_REFRESHES = Counter(
+	'hlsed_warm_refreshes_total',
+	"Refreshes of the playlists of the aliases kept warm by alias and result ('ok' or 'error'), see warmup.py.",
+	('alias', 'result')
+)
+UPSTREAM_BYTES_IN = Counter(
+	'hlsed_upstream_received_bytes_total',
+	'Bytes received from upstream hosts.',
+	('host',)
+)
+UPSTREAM_BYTES_OUT = Counter(
+	'hlsed_upstream_served_bytes_total',
+	'Bytes of transformed playlists served by upstream host.',
+	('host',)
+)
+CACHE_REQUESTS = Counter(
+	'hlsed_cache_requests_total',
+	"Cache lookups by cache and result ('hit' or 'miss').",
+	('cache', 'result')
+)
+
+def record_cache(cache, hit):
+	if hit:
+		CACHE_REQUESTS.inc((cache, 'hit'))
+	else:
+		CACHE_REQUESTS.inc((cache, 'miss'))
+
+def _monotonic_clock():
+
+	"""
+	A monotonic high-resolution clock (seconds): time.monotonic() where available (Python 3), 
+	clock_gettime(CLOCK_MONOTONIC) via ctypes on Linux, or time.time() as the last resort.
+	"""
+
+	if hasattr(time, 'monotonic'):
+		return time.monotonic
+
+	try:
+		import ctypes
+		import ctypes.util
+		
+		class timespec(ctypes.Structure):
+			_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+		librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno = True)
+		clock_gettime = librt.clock_gettime
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+		
+		CLOCK_MONOTONIC = 1
+		
+		def monotonic():
+			t = timespec()
+			if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+				errno = ctypes.get_errno()
+				raise OSError(errno, os.strerror(errno))
+			return t.tv_sec + t.tv_nsec * 1e-9
+		
+		# Making sure it works before relying on it.
+		monotonic()
+		return monotonic
+		
+	except (ImportError, OSError, AttributeError):
+		return time.time
+
+# All the durations should be measured using this.
+clock = _monotonic_clock()
+
+class StageTimer:
+
+	"""
+	Measures consecutive stages of processing a single request: every call of lap() records the time
+	passed since the previous one (or since the timer was created) under the given name.
+	"""
+
+	def __init__(self):
+		self.stages = []
+		self._last = clock()
+
+	def lap(self, name, desc = None):
+		now = clock()
+		self.stages.append((name, now - self._last, desc))
+		self._last = now
+
+	def observe(self):
+		"""Records all the stages measured so far into STAGE_SECONDS."""
+		for name, seconds, desc in self.stages:
+			STAGE_SECONDS.observe(seconds, (name,))
+
+	def server_timing(self, total = None):
+		"""
+		The stages measured so far in the format of the Server-Timing header (https://www.w3.org/TR/server-timing/), 
+		optionally followed by the `total` duration of the request in seconds.
+		"""
+		metrics = []
+		for name, seconds, desc in self.stages:
+			if desc:
+				metrics.append('%s;desc="%s";dur=%.3f' % (name, desc, seconds * 1000))
+			else:
+				metrics.append('%s;dur=%.3f' % (name, seconds * 1000))
+		if total is not None:
+			metrics.append('total;dur=%.3f' % (total * 1000,))
+		return ', '.join(metrics)
+
+###
+
+def snapshot():
+	"""Values of all metrics of this process in a form that can be serialized and merged."""
+	with _lock:
+		return dict(map(
+			lambda m: (m.name, map(lambda item: [list(item[0]), _copy(item[1])], m._values.items())),
+			_registry
+		))
+
+def _copy(value):
+	if isinstance(value, list):
+		return list(value)
+	else:
+		return value
+
+_process_id = "%d-%d" % (os.getpid(), int(time.time() * 1000))
+_last_flush = [0]
+_flush_lock = threading.Lock()
+_flush_scheduled = []
+
+def maybe_flush(force = False):
+
+	"""
+	Saves the snapshot of this process into METRICS_DIR, unless it was done less than FLUSH_INTERVAL ago.
+	Does nothing when METRICS_DIR is not set.
+	"""
+
+	global _process_id
+
+	if not METRICS_DIR:
+		return
+
+	now = time.time()
+	if not force and now - _last_flush[0] < FLUSH_INTERVAL:
+		# The process might not get any requests for a while, so let's make sure the latest changes are saved.
+		with _flush_lock:
+			if not _flush_scheduled:
+				_flush_scheduled.append(True)
+				timer = threading.Timer(FLUSH_INTERVAL, _scheduled_flush)
+				timer.daemon = True
+				timer.start()
+		return
+
+	with _flush_lock:
+		
+		_last_flush[0] = now
+
+		# The module can be imported before the workers are forked, so the ID assigned on import can be inherited.
+		if not _process_id.startswith("%d-" % (os.getpid(),)):
+			_process_id = "%d-%d" % (os.getpid(), int(now * 1000))
+
+		path = os.path.join(METRICS_DIR, _process_id + '.json')
+		temp_path = path + '.tmp'
+		with open(temp_path, 'w') as f:
+			json.dump(snapshot(), f)
+		# Renaming is atomic, so readers never see a partially written file.
+		os.rename(temp_path, path)
+
+def _scheduled_flush():
+	del _flush_scheduled[:]
+	maybe_flush(force = True)
+
+def exposition():
+
+	"""The metrics of all processes in the Prometheus text format."""
+
+	snapshots = []
+	if METRICS_DIR:
+		maybe_flush(force = True)
+		for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+			try:
+				with open(path) as f:
+					snapshots.append(json.load(f))
+			except (IOError, ValueError):
+				# Could be removed in the meantime, let's skip it.
+				pass
+	else:
+		snapshots.append(snapshot())
+
+	lines = []
+	for m in _registry:
+		values = {}
+		for s in snapshots:
+			m._merge(values, dict(map(lambda item: (tuple(item[0]), item[1]), s.get(m.name, []))))
+		lines.append('# HELP %s %s' % (m.name, m.help))
+		lines.append('# TYPE %s %s' % (m.name, m.type))
+		lines.extend(m._lines(values))
+
+		if m is CACHE_REQUESTS:
+			# The ratio can be calculated from the counter, but it's handy to have it right here.
+			lines.append('# HELP hlsed_cache_hit_ratio The share of cache lookups that were hits.')
+			lines.append('# TYPE hlsed_cache_hit_ratio gauge')
+			caches = sorted(set(map(lambda labels: labels[0], values.keys())))
+			for cache in caches:
+				hits = values.get((cache, 'hit'), 0)
+				total = hits + values.get((cache, 'miss'), 0)
+				lines.append('hlsed_cache_hit_ratio{cache="%s"} %s' % (_escape(cache), repr(float(hits) / total)))
+
+	return '\n'.join(lines) + '\n'
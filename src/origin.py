@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# A static origin serving local mirrors of HLS streams (as produced by download-hls.py) for offline and load tests.
+#
+# Every subdirectory of aliases.MIRRORS_DIR containing 'index.m3u8' is a mirror available as
+# `<prefix>/<name>/index.m3u8`; see aliases.resolve_hls() on how to refer to mirrors by their names.
+#
+# Files are sent via sendfile() when the server supports it: gunicorn does this for 'wsgi.file_wrapper',
+# and our own servers do it with SendfileRequestHandler below. Otherwise they are read in chunks.
+# Range requests are supported in both cases.
+
+from flask import Blueprint, Flask, Response, abort, jsonify, request
+from werkzeug.security import safe_join
+from werkzeug.serving import WSGIRequestHandler
+import aliases
+import argparse
+import errno
+import os
+
+blueprint = Blueprint('origin', __name__)
+
+CONTENT_TYPES = {
+	'.m3u8': 'application/vnd.apple.mpegurl',
+	'.ts': 'video/mp2t',
+	'.aac': 'audio/aac',
+	'.mp3': 'audio/mpeg',
+	'.mp4': 'video/mp4',
+	'.m4s': 'video/iso.segment',
+	'.m4a': 'audio/mp4',
+	'.vtt': 'text/vtt',
+	'.webvtt': 'text/vtt',
+	'.key': 'application/octet-stream'
+}
+
+# The size of chunks used when sendfile() is not available.
+CHUNK_SIZE = 64 * 1024
+
+@blueprint.route('/')
+def index():
+	return jsonify(mirrors = aliases.mirrors())
+
+@blueprint.route('/<name>/<path:path>')
+def serve(name, path):
+
+	if not aliases.MIRRORS_DIR:
+		abort(404)
+	local_path = safe_join(aliases.MIRRORS_DIR, name, path)
+	if local_path is None:
+		abort(404)
+	try:
+		f = open(local_path, 'rb')
+	except IOError as e:
+		if e.errno in (errno.ENOENT, errno.EISDIR, errno.EACCES):
+			abort(404)
+		raise
+
+	extension = os.path.splitext(local_path)[1].lower()
+	response = file_response(
+		f, f.tell(), os.fstat(f.fileno()).st_size, CONTENT_TYPES.get(extension, 'application/octet-stream')
+	)
+	# Playlists of the mirrors are static, but players should not cache them forever still.
+	if extension == '.m3u8':
+		response.headers['Cache-Control'] = 'max-age=2'
+	else:
+		response.headers['Cache-Control'] = 'max-age=3600'
+	return response
+
+def file_response(f, offset, size, mimetype):
+
+	"""
+	A response with `size` bytes of the file `f` starting at `offset` (e.g. after a header), which supports
+	byte ranges and is sent via sendfile() when possible. The file is closed when the response is done.
+	"""
+
+	status = 200
+	start, length = 0, size
+
+	byte_range = request.range
+	if byte_range is not None:
+		r = byte_range.range_for_length(size)
+		if r is None or len(byte_range.ranges) != 1:
+			f.close()
+			return Response(status = 416, headers = { 'Content-Range': 'bytes */%d' % (size,) })
+		start, length = r[0], r[1] - r[0]
+		status = 206
+
+	body = FileRange(f, offset + start, length)
+	file_wrapper = request.environ.get('wsgi.file_wrapper')
+	if file_wrapper:
+		iterable = file_wrapper(body, CHUNK_SIZE)
+	else:
+		iterable = body.chunks(CHUNK_SIZE)
+
+	response = Response(iterable, status = status, mimetype = mimetype, direct_passthrough = True)
+	response.headers['Content-Length'] = str(length)
+	response.headers['Accept-Ranges'] = 'bytes'
+	if status == 206:
+		response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, start + length - 1, size)
+	return response
+
+class FileRange:
+
+	"""
+	A file-like object exposing `length` bytes of the file `f` starting at `start`.
+	Positioned at `start`, which is what sendfile-based file wrappers (e.g. gunicorn's) use as the offset
+	along with Content-Length.
+	"""
+
+	def __init__(self, f, start, length):
+		self._f = f
+		self.start = start
+		self.length = length
+		self._remaining = length
+		f.seek(start)
+
+	def fileno(self):
+		return self._f.fileno()
+
+	def tell(self):
+		return self._f.tell()
+
+	def read(self, size = -1):
+		if size < 0 or size > self._remaining:
+			size = self._remaining
+		data = self._f.read(size)
+		self._remaining -= len(data)
+		return data
+
+	def chunks(self, size):
+		try:
+			while True:
+				data = self.read(size)
+				if not data:
+					break
+				yield data
+		finally:
+			self.close()
+
+	def close(self):
+		self._f.close()
+
+###
+
+def _sendfile_function():
+
+	"""os.sendfile() where available (Python 3) or the one from libc via ctypes, None if neither works."""
+
+	if hasattr(os, 'sendfile'):
+		return os.sendfile
+	try:
+		import ctypes
+		import ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+		c_sendfile = libc.sendfile
+		c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+		c_sendfile.restype = ctypes.c_ssize_t
+	except (ImportError, OSError, AttributeError):
+		return None
+
+	def sendfile(out_fd, in_fd, offset, count):
+		o = ctypes.c_int64(offset)
+		sent = c_sendfile(out_fd, in_fd, ctypes.byref(o), count)
+		if sent < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e))
+		return sent
+
+	return sendfile
+
+_sendfile = _sendfile_function()
+
+class SendfileWrapper:
+
+	"""
+	Our 'wsgi.file_wrapper' sending the file right into the socket of the connection via sendfile().
+	The headers are sent first by yielding an empty string to the server.
+	"""
+
+	def __init__(self, connection, filelike, block_size = CHUNK_SIZE):
+		self.connection = connection
+		self.filelike = filelike
+		self.block_size = block_size
+
+	def __iter__(self):
+		try:
+			if _sendfile is None or not hasattr(self.filelike, 'fileno'):
+				while True:
+					data = self.filelike.read(self.block_size)
+					if not data:
+						break
+					yield data
+				return
+
+			# This makes the server send the headers.
+			yield b''
+
+			offset = self.filelike.tell()
+			remaining = getattr(self.filelike, 'length', None)
+			if remaining is None:
+				remaining = os.fstat(self.filelike.fileno()).st_size - offset
+			out_fd = self.connection.fileno()
+			in_fd = self.filelike.fileno()
+			while remaining > 0:
+				try:
+					sent = _sendfile(out_fd, in_fd, offset, remaining)
+				except OSError as e:
+					if e.errno == errno.EAGAIN:
+						continue
+					raise
+				if sent == 0:
+					break
+				offset += sent
+				remaining -= sent
+		finally:
+			self.close()
+
+	def close(self):
+		if hasattr(self.filelike, 'close'):
+			self.filelike.close()
+
+class SendfileRequestHandler(WSGIRequestHandler):
+
+	"""Werkzeug's request handler providing SendfileWrapper as 'wsgi.file_wrapper'."""
+
+	def make_environ(self):
+		environ = WSGIRequestHandler.make_environ(self)
+		connection = self.connection
+		environ['wsgi.file_wrapper'] = lambda filelike, block_size = CHUNK_SIZE: SendfileWrapper(
+			connection, filelike, block_size
+		)
+		return environ
+
+###
+
+if __name__ == '__main__':
+
+	import serve
+
+	parser = argparse.ArgumentParser(description = "Serves local mirrors of HLS streams.")
+	parser.add_argument("directory", help = "The directory with mirrors, each in its own subdirectory.")
+	parser.add_argument("-b", "--host", default = "127.0.0.1", help = "The address to listen on.")
+	parser.add_argument("-p", "--port", type = int, default = 11001, help = "The port to listen on.")
+	parser.add_argument("-t", "--threads", type = int, default = 16, help = "The number of threads handling requests.")
+	args = parser.parse_args()
+
+	aliases.MIRRORS_DIR = os.path.abspath(args.directory)
+
+	origin_app = Flask(__name__)
+	origin_app.register_blueprint(blueprint)
+
+	server = serve.PooledWSGIServer(args.host, args.port, origin_app, args.threads, handler = SendfileRequestHandler)
+	print("Serving %s on http://%s:%d/" % (", ".join(aliases.mirrors()) or "no mirrors", args.host, args.port))
+	server.serve_forever()
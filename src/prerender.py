@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Pre-renders everything /v1/eventify would return for an event, so it can be served as static files (e.g. by nginx)
+# without any work per request.
+#
+# The playlists returned for an event only change at known times: when a new segment fits the window, when an ad cue
+# or an upstream date range starts and when the event turns into a VOD. So the whole event is a sequence of states,
+# each of them rendered once (the same way as sessions.Session.render() does) and written compressed as
+# `<variant>/<state>.m3u8.gz`, along with an index of the times the states start at (`index.json`) and a map
+# for nginx choosing the state by the current time (`nginx.conf`). The master playlist does not change,
+# it is written as `index.m3u8.gz` with its variants pointing to `<variant>.m3u8` next to it.
+#
+# The parameters are the same as the ones of /v1/eventify, given as its URL or just the query string:
+#
+#	prerender.py 'url=apple1&ref_time=1612345678&duration=3600&ad_interval=300' -o ./static/apple1
+#
+# The timeline ends when the event turns into a VOD, the ad cues (and upstream date ranges) starting later
+# are not added to the VOD.
+
+import aliases
+import app
+import argparse
+import bisect
+import collections
+import cues
+import gzip
+import hlsed
+import json
+import math
+import os
+import re
+import sessions
+import shutil
+import sys
+import upstream
+import urlparse
+
+INDEX_FILE = 'index.json'
+MASTER_FILE = 'index.m3u8'
+NGINX_FILE = 'nginx.conf'
+
+# The times of the states are in milliseconds, like the ones in the playlists (see hlsed.time_as_iso8601()).
+RESOLUTION = 0.001
+
+class StaticVariantsStage(hlsed.Stage):
+
+	"""
+	Points the variants (and renditions) of a master playlist to the pre-rendered playlists next to it,
+	named 'v0', 'v1', etc. in the order of their appearance. Their absolute URLs are collected in `variants`
+	(an ordered dictionary of the names by the URLs).
+	"""
+
+	def __init__(self, playlist_url):
+		self.playlist_url = playlist_url
+		self.variants = collections.OrderedDict()
+
+	def start(self, playlist):
+
+		rebaser = hlsed.Rebaser(self.playlist_url)
+
+		def variant_uri(uri):
+			url = rebaser.absolute(uri)
+			name = self.variants.get(url)
+			if name is None:
+				name = self.variants[url] = 'v%d' % (len(self.variants),)
+			return name + '.m3u8'
+		self.map_uri = variant_uri
+
+		def tag_uri(tag, uri):
+			if tag.name in ['EXT-X-I-FRAME-STREAM-INF', 'EXT-X-MEDIA']:
+				return variant_uri(uri)
+			return rebaser.absolute(uri)
+		self.map_tag_uri = tag_uri
+
+def change_times(session, timeline):
+
+	"""
+	The times (not sorted) when the window of the given media sessions.Timeline rendered for the session changes,
+	rounded up to RESOLUTION, up to the moment the event turns into a VOD.
+	"""
+
+	p = session.params
+	start_time = p.start_time - 3 * timeline.target_duration
+	end_time = start_time + p.event_duration
+
+	times = [start_time + e for e in timeline.segment_ends if e <= p.event_duration]
+	# The window includes the segments ending by the current time, but it turns into a VOD right after the end.
+	times.append(end_time + RESOLUTION)
+	if timeline.first_date is not None:
+		shift = start_time - timeline.first_date
+		for tag in timeline.dateranges:
+			start, end = cues.daterange_times(tag)
+			if start is not None and start + shift <= end_time:
+				times.append(start + shift)
+	if p.ad_interval > 0 and p.ad_duration > 0:
+		schedule = session.ad_schedule(start_time)
+		schedule.tags_till(end_time)
+		times += filter(lambda t: t <= end_time, schedule.times)
+
+	return map(_rounded_up, times)
+
+def _rounded_up(t):
+	# The state is rendered at the rounded time, so it must be after the actual one despite the rounding errors
+	# (Unix times have only about 7 significant digits after the point).
+	return math.ceil(t / RESOLUTION + 0.5) * RESOLUTION
+
+def state_at(times, t):
+	"""The index of the state at time `t`, given the times of the states after the first one (see prerender())."""
+	return bisect.bisect_right(times, t)
+
+def state_file(name, state):
+	"""The path of the given state of the variant with the given name, relative to the output directory."""
+	return '%s/%05d.m3u8' % (name, state)
+
+def lookup(index, name, t):
+	"""The path of the playlist of the variant with the given name at time `t` (see prerender()), relative to the output."""
+	return state_file(name, state_at(index['times'], t))
+
+def _write_compressed(path, text, compress_level):
+	# The modification time is not stored, so the same playlists result in the same files.
+	with open(path + '.gz', 'wb') as f:
+		with gzip.GzipFile('', 'wb', compress_level, f, 0) as z:
+			z.write(text)
+
+def prerender(playlist_url, params, output_dir, segment_proxy_url = None, compress_level = 6, nginx_name = 'hlsed'):
+
+	"""
+	Writes all the states of the event with the given parameters (app.EventifyParams) of the playlist at `playlist_url`
+	into `output_dir` replacing whatever is there, see the top of the file. Returns the index: a dictionary with
+	'variants' (their names), 'master' (the file of the master playlist or None), 'times' (the times the states start at:
+	the first state is before the first of them, the second one is till the second one, etc.) and 'states'.
+	"""
+
+	playlist, hit = upstream.get_playlist(playlist_url)
+	master_text = None
+	if playlist.is_master_playlist:
+		stage = StaticVariantsStage(playlist_url)
+		hlsed.Pipeline([stage]).apply(playlist)
+		master_text = playlist.text()
+		variants = stage.variants.items()
+	else:
+		variants = [(playlist_url, 'v0')]
+
+	session = sessions.Session('prerender', {}, params)
+	timelines = []
+	times = set()
+	for url, name in variants:
+		variant, hit = upstream.get_playlist(url)
+		if variant.is_master_playlist:
+			raise Exception("The variant '%s' is a master playlist" % (url,))
+		hlsed.rebase(variant, url, None, segment_proxy_url)
+		timeline = sessions.Timeline(variant, None)
+		timelines.append((name, timeline))
+		times.update(change_times(session, timeline))
+	times = sorted(times)
+
+	# Everything is written next to the output first, so it can be swapped with the previous version at once.
+	output_dir = os.path.abspath(output_dir)
+	temp_dir = '%s.tmp%d' % (output_dir, os.getpid())
+	if os.path.exists(temp_dir):
+		shutil.rmtree(temp_dir)
+	for name, timeline in timelines:
+		os.makedirs(os.path.join(temp_dir, name))
+	if master_text is not None:
+		_write_compressed(os.path.join(temp_dir, MASTER_FILE), master_text.encode('utf_8'), compress_level)
+
+	# The first state is the one before anything happens, then the ones at every change that makes a difference.
+	state_times = []
+	previous = [None] * len(timelines)
+	for t in [times[0] - 1 if times else params.start_time] + times:
+		texts = map(lambda (name, timeline): session.render(timeline, t), timelines)
+		if texts == previous:
+			continue
+		state = len(state_times)
+		for i, (name, timeline) in enumerate(timelines):
+			path = os.path.join(temp_dir, state_file(name, state))
+			if texts[i] == previous[i]:
+				# Unchanged variants share the file of the previous state.
+				os.link(os.path.join(temp_dir, state_file(name, state - 1)) + '.gz', path + '.gz')
+			else:
+				_write_compressed(path, texts[i], compress_level)
+		state_times.append(t)
+		previous = texts
+
+	index = {
+		'variants': map(lambda (name, timeline): name, timelines),
+		'master': MASTER_FILE if master_text is not None else None,
+		'times': state_times[1:],
+		'states': len(state_times)
+	}
+	with open(os.path.join(temp_dir, INDEX_FILE), 'wb') as f:
+		json.dump(index, f, separators = (',', ':'))
+	with open(os.path.join(temp_dir, NGINX_FILE), 'wb') as f:
+		f.write(nginx_map(index, nginx_name))
+
+	if os.path.exists(output_dir):
+		old_dir = '%s.old%d' % (output_dir, os.getpid())
+		os.rename(output_dir, old_dir)
+		os.rename(temp_dir, output_dir)
+		shutil.rmtree(old_dir)
+	else:
+		os.rename(temp_dir, output_dir)
+
+	return index
+
+def nginx_map(index, name):
+
+	"""
+	The configuration of nginx setting `$<name>_state` to the name of the current state (see state_file()).
+	nginx maps cannot compare numbers, so it has an entry for every second between the first and the last change
+	(the state is the one at the beginning of the second).
+	"""
+
+	times = index['times']
+	lines = [
+		"# The state of the pre-rendered event by the current time, see prerender.py.",
+		"# Long events may need larger map_hash_max_size.",
+		"map $msec $%s_second {" % (name,),
+		"\t\"~^(?<second>\\d+)\\.\" $second;",
+		"}",
+		"map $%s_second $%s_state {" % (name, name),
+		"\tdefault %05d;" % (0,)
+	]
+	if times:
+		first = int(math.floor(times[0]))
+		last = int(math.floor(times[-1]))
+		for second in range(first, last + 1):
+			lines.append("\t%d %05d;" % (second, state_at(times, second)))
+		lines.append("\t\"~%s\" %05d;" % (_greater_than_re(last), len(times)))
+	lines.append("}")
+	return "\n".join(lines) + "\n"
+
+def _greater_than_re(n):
+	# A regular expression matching non-negative integers (without leading zeros) greater than `n`.
+	digits = str(n)
+	alternatives = []
+	for i, d in enumerate(digits):
+		if d != '9':
+			rest = len(digits) - i - 1
+			alternatives.append('%s[%d-9]%s' % (digits[:i], int(d) + 1, '\\d{%d}' % (rest,) if rest else ''))
+	alternatives.append('[1-9]\\d{%d,}' % (len(digits),))
+	return '^(%s)$' % ('|'.join(alternatives),)
+
+def main():
+
+	parser = argparse.ArgumentParser(description = "Pre-renders all the playlists of an event as static files.")
+	parser.add_argument(
+		"params",
+		help = "The URL of /v1/eventify or just its query string, e.g. 'url=apple1&ref_time=1612345678&duration=3600'."
+	)
+	parser.add_argument("-o", "--output", required = True, help = "The directory to write the files to (replaced).")
+	parser.add_argument(
+		"--segment-proxy-url",
+		help = "The URL of /v1/segment of the proxy, when the parameters include proxy_segments=1."
+	)
+	parser.add_argument(
+		"--compress-level", type = int, default = 6, choices = range(1, 10), help = "The gzip level, 6 by default."
+	)
+	parser.add_argument(
+		"--nginx-name", default = None,
+		help = "The prefix of the variables set in nginx.conf, derived from the output directory by default."
+	)
+	args = parser.parse_args()
+
+	query = urlparse.urlparse(args.params).query if '?' in args.params else args.params
+	params = app.EventifyParams(dict(urlparse.parse_qsl(query)))
+	if not params.clock.is_real():
+		parser.error("The states are switched by the real time, the clock parameters are not supported")
+	if params.proxy_segments and not args.segment_proxy_url:
+		parser.error("proxy_segments=1 needs --segment-proxy-url")
+	playlist_url = aliases.resolve_hls(params.url)
+
+	nginx_name = args.nginx_name or re.sub(r'\W', '_', 'hlsed_' + os.path.basename(os.path.abspath(args.output)))
+	index = prerender(
+		playlist_url, params, args.output,
+		segment_proxy_url = args.segment_proxy_url if params.proxy_segments else None,
+		compress_level = args.compress_level,
+		nginx_name = nginx_name
+	)
+	sys.stderr.write(
+		"%d states of %d variants from %s to %s (ref_time=%d)\n" % (
+			index['states'], len(index['variants']),
+			hlsed.time_as_iso8601(index['times'][0]) if index['times'] else '-',
+			hlsed.time_as_iso8601(index['times'][-1]) if index['times'] else '-',
+			params.start_time
+		)
+	)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,90 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Profiling of single calls, so we can see where the time goes for a particular request.
+#
+# Two formats are supported:
+# - "folded" stacks produced by the sampling profiler, one stack per line followed by the number of samples,
+#   which is what flamegraph.pl, speedscope and similar tools read;
+# - "pstats", the binary format of cProfile/pstats modules readable by snakeviz, flameprof, gprof2dot, etc.
+
+import cProfile
+import marshal
+import os
+import sys
+import threading
+import time
+
+SAMPLING = 'sample'
+DETERMINISTIC = 'cprofile'
+
+MODES = [SAMPLING, DETERMINISTIC]
+
+class SamplingProfiler:
+
+	"""
+	Periodically records the stack of the given thread from another (background) thread.
+	Unlike signal-based samplers this works for any thread, not only the main one.
+	"""
+
+	def __init__(self, thread_id = None, interval = 0.001):
+		if thread_id is None:
+			thread_id = threading.current_thread().ident
+		self.thread_id = thread_id
+		self.interval = interval
+		self.stacks = {}
+		self._stopped = threading.Event()
+		self._thread = None
+
+	def start(self):
+		self._thread = threading.Thread(target = self._run, name = 'SamplingProfiler')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		self._thread.join()
+
+	def _run(self):
+		while not self._stopped.is_set():
+			frame = sys._current_frames().get(self.thread_id)
+			if frame is not None:
+				stack = []
+				while frame is not None:
+					stack.append(_frame_name(frame))
+					frame = frame.f_back
+				key = ';'.join(reversed(stack))
+				self.stacks[key] = self.stacks.get(key, 0) + 1
+			time.sleep(self.interval)
+
+	def folded(self):
+		"""The collected samples in the "folded stacks" format."""
+		return ''.join(map(lambda item: "%s %d\n" % item, sorted(self.stacks.items())))
+
+def _frame_name(frame):
+	code = frame.f_code
+	return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+def profile_call(mode, func, *args, **kwargs):
+
+	"""
+	Runs `func` under the profiler of the given type (SAMPLING or DETERMINISTIC).
+	Returns a tuple with the result of the call, the profile data, and a suggested file name extension for the data.
+	"""
+
+	if mode == SAMPLING:
+		profiler = SamplingProfiler()
+		profiler.start()
+		try:
+			result = func(*args, **kwargs)
+		finally:
+			profiler.stop()
+		return result, profiler.folded(), '.folded'
+	elif mode == DETERMINISTIC:
+		profiler = cProfile.Profile()
+		result = profiler.runcall(func, *args, **kwargs)
+		# This is the same as what pstats.Stats.dump_stats() writes.
+		profiler.create_stats()
+		return result, marshal.dumps(profiler.stats), '.pstats'
+	else:
+		raise ValueError("Unsupported profiling mode: '%s'" % (mode,))
@@ -186,3 +186,423 @@ def _splice_insert(
 		)
 		
 	return 0x05, r
+
+# Batch encoding of many splice_insert() commands wrapped into splice_info() at once. The layouts of the whole sections
+# (without and with break_duration()) are precompiled and all of them are packed into one preallocated buffer.
+# The results are the same as splice_info_with_splice_insert() returns for the same arguments.
+
+_splice_info_prefix = ">BHBBLBBHB"
+_splice_insert_head = "LBBBL"
+_splice_insert_tail = "HBBH"
+_splice_insert_layout = struct.Struct(_splice_info_prefix + _splice_insert_head + _splice_insert_tail)
+_splice_insert_with_break_layout = struct.Struct(_splice_info_prefix + _splice_insert_head + "BL" + _splice_insert_tail)
+_crc_layout = struct.Struct(">l")
+
+# The arguments of splice_info_with_splice_insert() with their default values.
+_splice_insert_defaults = (None, None, None, None, False, 0xa1e, 0, 0, 0)
+
+def splice_infos_with_splice_insert(cues):
+	
+	"""
+	Hex-encoded splice_info() sections with splice_insert() commands for all the given cues at once. 
+	
+	Every cue is a tuple with the arguments of splice_info_with_splice_insert() in the same order, 
+	the trailing ones can be omitted, e.g. `(event_id, out_of_network_indicator, pts_time_seconds)`.
+	"""
+	
+	defaults = _splice_insert_defaults
+	cues = [c if len(c) == 9 else tuple(c) + defaults[len(c):] for c in cues]
+	
+	short_size = _splice_insert_layout.size
+	long_size = _splice_insert_with_break_layout.size
+	crc_size = _crc_layout.size
+	
+	sizes = [short_size if c[3] is None else long_size for c in cues]
+	data = bytearray(sum(sizes) + crc_size * len(sizes))
+	
+	pack_short = _splice_insert_layout.pack_into
+	pack_long = _splice_insert_with_break_layout.pack_into
+	pack_crc = _crc_layout.pack_into
+	crc32 = binascii.crc32
+	# Note that section_length does not include the table_id and itself, and the CRC is not counted.
+	short_length = short_size - 3
+	short_command = 0xF000 | (short_size - 3 - 11 - 2)
+	long_length = long_size - 3
+	long_command = 0xF000 | (long_size - 3 - 11 - 2)
+	
+	offset = 0
+	offsets = []
+	for c in cues:
+		
+		(
+			event_id, out_of_network_indicator, pts_time_seconds, break_duration_seconds, auto_return,
+			unique_program_id, avail_num, avails_expected, pts_adjustment_seconds
+		) = c
+		
+		pts_adjustment = int(pts_adjustment_seconds * 90000)
+		pts_time = int(pts_time_seconds * 90000)
+		# See _splice_insert(): program_splice_flag is always set.
+		flags = 0xC0 if out_of_network_indicator else 0x40
+		
+		if break_duration_seconds is None:
+			size = short_size
+			pack_short(
+				data, offset,
+				0xFC, short_length,
+				0, (pts_adjustment >> 32) & 1, pts_adjustment & 0xFFFFFFFF, 0, 0xFF, short_command, 0x05,
+				event_id, 0, flags, 0x80 | (pts_time >> 32), pts_time & 0xFFFFFFFF,
+				unique_program_id, avail_num, avails_expected, 
+				0
+			)
+		else:
+			size = long_size
+			break_duration = int(break_duration_seconds * 90000)
+			pack_long(
+				data, offset,
+				0xFC, long_length,
+				0, (pts_adjustment >> 32) & 1, pts_adjustment & 0xFFFFFFFF, 0, 0xFF, long_command, 0x05,
+				event_id, 0, flags | 0x20, 0x80 | (pts_time >> 32), pts_time & 0xFFFFFFFF,
+				(0x80 if auto_return else 0) | (break_duration >> 32), break_duration & 0xFFFFFFFF,
+				unique_program_id, avail_num, avails_expected, 
+				0
+			)
+		pack_crc(data, offset + size, crc32(buffer(data, offset, size)))
+		
+		offsets.append(offset)
+		offset += size + crc_size
+	
+	encoded = binascii.hexlify(data).upper()
+	offsets.append(offset)
+	return [encoded[offsets[i] * 2:offsets[i + 1] * 2] for i in range(len(cues))]
+
+# Decoding of splice_info_section(), see SCTE 35 2019, section 9.
+
+class DecodingError(Exception):
+	pass
+
+# PTS are 33-bit numbers counting 90kHz ticks.
+PTS_TICKS_PER_SECOND = 90000
+PTS_MODULO = 1 << 33
+
+SPLICE_NULL = 0x00
+SPLICE_SCHEDULE = 0x04
+SPLICE_INSERT = 0x05
+TIME_SIGNAL = 0x06
+BANDWIDTH_RESERVATION = 0x07
+PRIVATE_COMMAND = 0xFF
+
+SEGMENTATION_DESCRIPTOR = 0x02
+
+def _mpeg2_crc_table():
+	table = []
+	for i in range(256):
+		crc = i << 24
+		for j in range(8):
+			if crc & 0x80000000:
+				crc = ((crc << 1) ^ 0x04C11DB7) & 0xFFFFFFFF
+			else:
+				crc = (crc << 1) & 0xFFFFFFFF
+		table.append(crc)
+	return table
+
+_crc_table = _mpeg2_crc_table()
+
+def mpeg2_crc32(data):
+	"""CRC-32/MPEG-2 of the given bytes, the one used by splice_info_section()."""
+	crc = 0xFFFFFFFF
+	table = _crc_table
+	for c in bytearray(data):
+		crc = ((crc << 8) & 0xFFFFFFFF) ^ table[(crc >> 24) ^ c]
+	return crc
+
+class _BitReader:
+	
+	"""Reads big-endian fields of arbitrary bit lengths from a byte string."""
+	
+	def __init__(self, data):
+		self.data = data
+		self._value = int(binascii.hexlify(data), 16) if data else 0
+		self._length = len(data) * 8
+		self.pos = 0
+	
+	def bits(self, count):
+		end = self.pos + count
+		if end > self._length:
+			raise DecodingError("Unexpected end of data at bit %d" % (self.pos,))
+		self.pos = end
+		return (self._value >> (self._length - end)) & ((1 << count) - 1)
+	
+	def flag(self):
+		return self.bits(1) == 1
+	
+	def bytes(self, count):
+		assert(self.pos % 8 == 0)
+		start = self.pos // 8
+		if start + count > len(self.data):
+			raise DecodingError("Unexpected end of data at byte %d" % (start,))
+		self.pos += count * 8
+		return self.data[start:start + count]
+	
+	def byte_pos(self):
+		assert(self.pos % 8 == 0)
+		return self.pos // 8
+
+class SpliceInfo:
+	"""
+	A decoded splice_info_section(). Times are in 90kHz ticks (see pts_seconds()).
+	
+	- command: a SpliceInsert or TimeSignal object for these types of commands, 
+	  a byte string with the raw command for other types (see `command_type`);
+	- descriptors: a list of SegmentationDescriptor objects for segmentation descriptors 
+	  and SpliceDescriptor objects for all other ones.
+	"""
+	
+	def splice_time(self):
+		"""The pts_time of the splice_insert() or time_signal() command, None if there is none."""
+		if isinstance(self.command, (SpliceInsert, TimeSignal)):
+			return self.command.pts_time
+		return None
+
+class SpliceInsert:
+	"""A decoded splice_insert() command."""
+	pass
+
+class TimeSignal:
+	"""A decoded time_signal() command."""
+	pass
+
+class SpliceDescriptor:
+	"""A splice descriptor that is not decoded (`data` has its raw bytes after the identifier)."""
+	pass
+
+class SegmentationDescriptor:
+	"""A decoded segmentation_descriptor()."""
+	pass
+
+def pts_seconds(ticks):
+	return float(ticks) / PTS_TICKS_PER_SECOND
+
+def decode(data, check_crc = True):
+	
+	"""
+	Decodes the given splice_info_section() (binary or hex-encoded, with or without '0x') into a SpliceInfo object.
+	
+	Note that the encoder above uses the CRC-32 of zlib instead of the MPEG-2 one (and does not count it 
+	in section_length), so its results can be decoded only with `check_crc` set to False.
+	"""
+	
+	if data[:2] in ('0x', '0X'):
+		data = data[2:]
+	if data[:2].upper() == 'FC':
+		try:
+			data = binascii.unhexlify(data)
+		except TypeError as e:
+			raise DecodingError("Invalid hex: %s" % (e,))
+	
+	r = _BitReader(data)
+	info = SpliceInfo()
+	
+	info.table_id = r.bits(8)
+	if info.table_id != 0xFC:
+		raise DecodingError("Unexpected table_id: 0x%02X" % (info.table_id,))
+	info.section_syntax_indicator = r.bits(1)
+	info.private_indicator = r.bits(1)
+	info.sap_type = r.bits(2)
+	section_length = r.bits(12)
+	# The encoder above does not count the CRC, let's accept that as well.
+	if 3 + section_length != len(data) and 3 + section_length + 4 != len(data):
+		raise DecodingError("Unexpected section_length: %d for %d bytes" % (section_length, len(data)))
+	
+	if check_crc:
+		crc = struct.unpack(">L", data[-4:])[0]
+		if crc != mpeg2_crc32(data[:-4]):
+			raise DecodingError("CRC mismatch")
+	
+	info.protocol_version = r.bits(8)
+	info.encrypted_packet = r.flag()
+	info.encryption_algorithm = r.bits(6)
+	info.pts_adjustment = r.bits(33)
+	info.cw_index = r.bits(8)
+	info.tier = r.bits(12)
+	splice_command_length = r.bits(12)
+	info.command_type = r.bits(8)
+	
+	if info.encrypted_packet:
+		raise DecodingError("Encrypted sections are not supported")
+	
+	start = r.byte_pos()
+	if info.command_type == SPLICE_INSERT:
+		info.command = _decode_splice_insert(r)
+	elif info.command_type == TIME_SIGNAL:
+		info.command = TimeSignal()
+		info.command.pts_time = _decode_splice_time(r)
+	elif info.command_type == SPLICE_NULL:
+		info.command = ''
+	elif splice_command_length != 0xFFF:
+		info.command = r.bytes(splice_command_length)
+	else:
+		# The legacy "unknown length" can be used only with the commands we can parse.
+		raise DecodingError("Unknown length of a command of type 0x%02X" % (info.command_type,))
+	if splice_command_length != 0xFFF and r.byte_pos() - start != splice_command_length:
+		raise DecodingError("Unexpected splice_command_length: %d" % (splice_command_length,))
+	
+	descriptor_loop_length = r.bits(16)
+	end = r.byte_pos() + descriptor_loop_length
+	info.descriptors = []
+	while r.byte_pos() < end:
+		info.descriptors.append(_decode_descriptor(r))
+	if r.byte_pos() != end:
+		raise DecodingError("Unexpected descriptor_loop_length: %d" % (descriptor_loop_length,))
+	
+	# Some encoders add stuffing before the CRC even for unencrypted sections.
+	info.crc32 = struct.unpack(">L", data[-4:])[0]
+	
+	return info
+
+def _decode_splice_time(r):
+	if r.flag():
+		r.bits(6)
+		return r.bits(33)
+	else:
+		r.bits(7)
+		return None
+
+def _decode_splice_insert(r):
+	
+	c = SpliceInsert()
+	c.splice_event_id = r.bits(32)
+	c.splice_event_cancel_indicator = r.flag()
+	r.bits(7)
+	
+	c.out_of_network_indicator = False
+	c.program_splice_flag = True
+	c.splice_immediate_flag = False
+	c.pts_time = None
+	c.components = []
+	c.auto_return = False
+	c.break_duration = None
+	c.unique_program_id = 0
+	c.avail_num = 0
+	c.avails_expected = 0
+	
+	if c.splice_event_cancel_indicator:
+		return c
+	
+	c.out_of_network_indicator = r.flag()
+	c.program_splice_flag = r.flag()
+	duration_flag = r.flag()
+	c.splice_immediate_flag = r.flag()
+	r.bits(4)
+	
+	if c.program_splice_flag:
+		if not c.splice_immediate_flag:
+			c.pts_time = _decode_splice_time(r)
+	else:
+		for i in range(r.bits(8)):
+			component_tag = r.bits(8)
+			pts_time = None if c.splice_immediate_flag else _decode_splice_time(r)
+			c.components.append((component_tag, pts_time))
+	
+	if duration_flag:
+		c.auto_return = r.flag()
+		r.bits(6)
+		c.break_duration = r.bits(33)
+	
+	c.unique_program_id = r.bits(16)
+	c.avail_num = r.bits(8)
+	c.avails_expected = r.bits(8)
+	
+	return c
+
+# The types of segmentation descriptors having sub_segment_num and sub_segments_expected fields.
+_sub_segment_types = frozenset([0x34, 0x36, 0x38, 0x3A, 0x44, 0x46])
+
+def _decode_descriptor(r):
+	
+	tag = r.bits(8)
+	length = r.bits(8)
+	end = r.byte_pos() + length
+	identifier = r.bits(32)
+	
+	if tag != SEGMENTATION_DESCRIPTOR:
+		d = SpliceDescriptor()
+		d.tag = tag
+		d.identifier = identifier
+		d.data = r.bytes(end - r.byte_pos())
+		return d
+	
+	d = SegmentationDescriptor()
+	d.tag = tag
+	d.identifier = identifier
+	d.segmentation_event_id = r.bits(32)
+	d.segmentation_event_cancel_indicator = r.flag()
+	r.bits(7)
+	
+	d.program_segmentation_flag = True
+	d.delivery_not_restricted_flag = True
+	d.web_delivery_allowed_flag = None
+	d.no_regional_blackout_flag = None
+	d.archive_allowed_flag = None
+	d.device_restrictions = None
+	d.components = []
+	d.segmentation_duration = None
+	d.upid_type = 0
+	d.upid = ''
+	d.type_id = 0
+	d.segment_num = 0
+	d.segments_expected = 0
+	d.sub_segment_num = None
+	d.sub_segments_expected = None
+	
+	if not d.segmentation_event_cancel_indicator:
+		
+		d.program_segmentation_flag = r.flag()
+		duration_flag = r.flag()
+		d.delivery_not_restricted_flag = r.flag()
+		if not d.delivery_not_restricted_flag:
+			d.web_delivery_allowed_flag = r.flag()
+			d.no_regional_blackout_flag = r.flag()
+			d.archive_allowed_flag = r.flag()
+			d.device_restrictions = r.bits(2)
+		else:
+			r.bits(5)
+		
+		if not d.program_segmentation_flag:
+			for i in range(r.bits(8)):
+				component_tag = r.bits(8)
+				r.bits(7)
+				d.components.append((component_tag, r.bits(33)))
+		
+		if duration_flag:
+			d.segmentation_duration = r.bits(40)
+		
+		d.upid_type = r.bits(8)
+		d.upid = r.bytes(r.bits(8))
+		d.type_id = r.bits(8)
+		d.segment_num = r.bits(8)
+		d.segments_expected = r.bits(8)
+		# These are optional for the older versions of the standard.
+		if d.type_id in _sub_segment_types and end - r.byte_pos() >= 2:
+			d.sub_segment_num = r.bits(8)
+			d.sub_segments_expected = r.bits(8)
+	
+	if r.byte_pos() > end:
+		raise DecodingError("Unexpected length of a segmentation descriptor: %d" % (length,))
+	# Skipping anything we don't know about.
+	r.bytes(end - r.byte_pos())
+	
+	return d
+
+def with_pts_adjustment(data, pts_adjustment):
+	
+	"""
+	The given binary splice_info_section() with its pts_adjustment field replaced (modulo 2^33) 
+	and the CRC updated accordingly, which is how all the times in the section can be shifted at once.
+	"""
+	
+	pts_adjustment %= PTS_MODULO
+	data = bytearray(data)
+	data[4] = (data[4] & 0xFE) | (pts_adjustment >> 32)
+	data[5:9] = struct.pack(">L", pts_adjustment & 0xFFFFFFFF)
+	data[-4:] = struct.pack(">L", mpeg2_crc32(data[:-4]))
+	return str(data)
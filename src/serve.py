@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# The production entry point: the app is served by several pre-forked worker processes all accepting connections
+# on the same listening socket, each handling requests with a pool of threads.
+#
+# The workers share a cache directory for upstream playlists and transformed responses, so adding workers
+# does not multiply the traffic to the origins, and a directory for metrics, so each of them can expose
+# the metrics of the whole server. The cache is kept across restarts, so they start warm.
+#
+# (Any other WSGI server can be used as well, e.g. `gunicorn --chdir src -w 4 --threads 8 app:app`,
+# just make sure to set HLSED_CACHE_DIR and HLSED_METRICS_DIR for it, see README.)
+
+import argparse
+import errno
+import multiprocessing
+import os
+import Queue
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import BaseWSGIServer
+
+class PooledWSGIServer(BaseWSGIServer):
+
+	"""
+	Werkzeug's server handling requests in a fixed pool of threads instead of a new thread per request.
+
+	Up to `max_queued` connections (4 per thread by default) wait for a free thread. With `queue_timeout` the server
+	sheds load when it's saturated: connections that would not fit the queue or have waited for longer than that
+	(seconds) are answered with 503 and Retry-After right away, instead of everyone waiting longer and longer.
+	Otherwise new connections are not accepted till there is room in the queue.
+	"""
+
+	multithread = True
+	daemon_threads = True
+
+	def __init__(
+		self, host, port, app, threads, handler = None, fd = None, max_queued = None, queue_timeout = None, retry_after = 1
+	):
+		BaseWSGIServer.__init__(self, host, port, app, handler = handler, fd = fd)
+		self.queue_timeout = queue_timeout
+		self.retry_after = retry_after
+		self._requests = Queue.Queue(max_queued or threads * 4)
+		for i in range(threads):
+			t = threading.Thread(target = self._handle_requests, name = 'Worker-%d' % (i,))
+			t.daemon = True
+			t.start()
+
+	def process_request(self, request, client_address):
+		if self.queue_timeout is None:
+			self._requests.put((request, client_address, time.time()))
+			return
+		try:
+			self._requests.put_nowait((request, client_address, time.time()))
+		except Queue.Full:
+			self._shed(request, 'queue_full')
+
+	def _handle_requests(self):
+		# Importing here as the configuration is taken from the environment on import (see run_worker()).
+		import metrics
+		while True:
+			request, client_address, queued = self._requests.get()
+			waited = time.time() - queued
+			metrics.QUEUE_SECONDS.observe(waited)
+			if self.queue_timeout is not None and waited > self.queue_timeout:
+				self._shed(request, 'queue_timeout')
+				continue
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+
+	def _shed(self, request, reason):
+		import metrics
+		metrics.SHED_REQUESTS.inc((reason,))
+		body = "The server is too busy, please try again later.\n"
+		try:
+			# Reading what the client has sent so far, closing the socket with unread data would reset the connection.
+			request.setblocking(0)
+			try:
+				request.recv(65536)
+			except socket.error:
+				pass
+			request.setblocking(1)
+			request.sendall(
+				"HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Type: text/plain\r\n"
+				"Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (self.retry_after, len(body), body)
+			)
+		except socket.error:
+			pass
+		self.shutdown_request(request)
+
+def make_dirs(path):
+	try:
+		os.makedirs(path)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+
+def run_worker(listening_socket, host, port, threads, max_queued, queue_timeout):
+
+	# The parent is handling these.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+	# Importing here as the configuration is taken from the environment on import.
+	import app
+	import origin
+	import upstream
+	import warmup
+
+	# The aliases are loaded before accepting requests, so the first sessions using them don't wait for the origins.
+	warmup.start(warm_up = True)
+
+	# This one sends the files of local mirrors via sendfile().
+	server = PooledWSGIServer(
+		host, port, app.app, threads, 
+		handler = origin.SendfileRequestHandler, 
+		fd = listening_socket.fileno(),
+		max_queued = max_queued,
+		queue_timeout = queue_timeout if queue_timeout > 0 else None,
+		retry_after = upstream.RETRY_AFTER
+	)
+	server.serve_forever()
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-b", "--host", default = "127.0.0.1", help = "The address to listen on.")
+	parser.add_argument("-p", "--port", type = int, default = 11000, help = "The port to listen on.")
+	parser.add_argument(
+		"-w", "--workers", type = int, default = multiprocessing.cpu_count(),
+		help = "The number of worker processes, the number of CPUs by default."
+	)
+	parser.add_argument(
+		"-t", "--threads", type = int, default = 8,
+		help = "The number of threads handling requests in each worker."
+	)
+	parser.add_argument(
+		"-c", "--cache-dir",
+		default = os.path.join(tempfile.gettempdir(), 'hlsed-cache'),
+		help = "The directory for the caches shared by the workers and kept across restarts."
+	)
+	parser.add_argument(
+		"-m", "--mirrors-dir",
+		help = "The directory with local mirrors of streams (see download-hls.py) to serve under /origin/."
+	)
+	parser.add_argument(
+		"--max-queued", type = int,
+		help = "The number of connections waiting for a free thread in each worker, 4 per thread by default."
+	)
+	parser.add_argument(
+		"--queue-timeout", type = float, default = 2,
+		help = "Connections waiting for longer than that (seconds) or not fitting the queue get 503 right away, "
+			"0 to make them wait instead. 2 by default."
+	)
+	parser.add_argument(
+		"--warm-aliases", default = "all",
+		help = "The aliases of example streams (comma-separated) to keep in the caches, all of them by default."
+	)
+	args = parser.parse_args()
+
+	cache_dir = args.cache_dir
+	make_dirs(cache_dir)
+
+	# Metrics of the previous runs should not be mixed with the new ones.
+	metrics_dir = os.path.join(cache_dir, 'metrics')
+	shutil.rmtree(metrics_dir, ignore_errors = True)
+	make_dirs(metrics_dir)
+
+	os.environ['HLSED_CACHE_DIR'] = cache_dir
+	os.environ['HLSED_METRICS_DIR'] = metrics_dir
+	os.environ['HLSED_WARM_ALIASES'] = args.warm_aliases
+	if args.mirrors_dir:
+		os.environ['HLSED_MIRRORS_DIR'] = os.path.abspath(args.mirrors_dir)
+
+	listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listening_socket.bind((args.host, args.port))
+	listening_socket.listen(128)
+
+	print("Serving on http://%s:%d/ with %d worker(s), %d thread(s) each, caching in '%s'" % (
+		args.host, args.port, args.workers, args.threads, cache_dir
+	))
+
+	workers = {}
+
+	def spawn():
+		pid = os.fork()
+		if pid == 0:
+			try:
+				run_worker(listening_socket, args.host, args.port, args.threads, args.max_queued, args.queue_timeout)
+			finally:
+				os._exit(1)
+		workers[pid] = time.time()
+
+	stopping = []
+
+	def stop(signum, frame):
+		stopping.append(signum)
+
+	signal.signal(signal.SIGINT, stop)
+	signal.signal(signal.SIGTERM, stop)
+
+	for i in range(args.workers):
+		spawn()
+
+	while not stopping:
+		try:
+			pid, status = os.wait()
+		except OSError as e:
+			if e.errno == errno.EINTR:
+				continue
+			raise
+		started = workers.pop(pid, None)
+		if started is None or stopping:
+			continue
+		print("Worker %d has exited (status %d), restarting" % (pid, status))
+		# Let's not spin if workers crash right away.
+		if time.time() - started < 1:
+			time.sleep(1)
+		spawn()
+
+	print("Stopping...")
+	for pid in workers.keys():
+		try:
+			os.kill(pid, signal.SIGTERM)
+		except OSError:
+			pass
+	for pid in workers.keys():
+		try:
+			os.waitpid(pid, 0)
+		except OSError:
+			pass
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,254 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Server-side sessions, an alternative to passing all the parameters of /v1/eventify with every request.
+#
+# A session is identified by a short ID derived from its parameters, so the same parameters always result
+# in the same session and any worker process can restore it by the ID alone (the parameters are kept in the cache
+# shared by the workers). Besides the parameters, a session keeps everything that does not depend on the current time
+# and is shared by all the variants of the stream: the rebased source playlists prepared for rendering of their windows
+# (Timeline) and the schedule of ad cues (AdSchedule), so a request only needs to find the current window.
+
+import bisect
+import cache
+import collections
+import cues
+import hashlib
+import hlsed
+import m3u
+import metrics
+import os
+import threading
+import time
+import upstream
+import urllib
+
+# How long (seconds) sessions are kept after they are created.
+SESSION_TTL = float(os.environ.get('HLSED_SESSION_TTL', 24 * 3600))
+# How many sessions each process keeps in memory.
+SESSION_MEMORY_ITEMS = int(os.environ.get('HLSED_SESSION_MEMORY_ITEMS', 1000))
+
+# How many different playlists a single session can keep (sessions normally refer to a master and its variants).
+MAX_TIMELINES = 32
+
+def session_id(args):
+	"""A short ID for a session with the given parameters (a dictionary of strings)."""
+	query = urllib.urlencode(sorted(map(lambda (k, v): (k, unicode(v).encode('utf_8')), args.items())))
+	return hashlib.sha1(query).hexdigest()[:16]
+
+class Timeline:
+
+	"""
+	A rebased source playlist prepared for cheap rendering of its windows: the text of every segment is rendered once,
+	so a window is a prefix of them found via the cumulative durations of the segments.
+	"""
+
+	def __init__(self, playlist, digest):
+
+		self.digest = digest
+		self.is_master_playlist = playlist.is_master_playlist
+
+		if self.is_master_playlist:
+			self.master_text = playlist.text()
+			return
+
+		self.target_duration = playlist.target_duration()
+
+		# These are replaced for every window, see hlsed.event_to_vod().
+		playlist.remove_global_tag('EXT-X-PLAYLIST-TYPE')
+		playlist.remove_global_tag('EXT-X-ENDLIST')
+		
+		# The upstream cues are re-dated for every window as well, see hlsed.UpstreamCuesStage.
+		self.dateranges = playlist.global_tags('EXT-X-DATERANGE')
+		self.first_date = None
+		if self.dateranges and playlist.uris:
+			self.first_date = cues.program_date_time(playlist.uri_tag_by_name(0, 'EXT-X-PROGRAM-DATE-TIME'))
+		if self.first_date is not None:
+			playlist.remove_global_tag('EXT-X-DATERANGE')
+		
+		self.header = map(lambda t: t.text(), playlist.globals)
+
+		# The same as m3u.Playlist.text() renders every URI.
+		nl = "\n"
+		self.segments = []
+		self.segment_ends = []
+		# Segments with program date time tags, see with_program_date_time().
+		self._dated_segments = {}
+		segment_end = 0
+		for u in playlist.uris:
+			self.segments.append((nl + nl.join(map(lambda t: t.text(), u.tags)) + nl + u.text() + nl).encode('utf_8'))
+			segment_end += u.duration()
+			self.segment_ends.append(segment_end)
+
+	def window_length(self, effective_duration):
+		"""How many segments fit the given duration, as hlsed.event_to_vod() counts them."""
+		return hlsed.window_length(self.segment_ends, effective_duration)
+	
+	def with_program_date_time(self, start_time, interval):
+		"""
+		The rendered segments with every `interval`-th of them having an EXT-X-PROGRAM-DATE-TIME tag, 
+		as hlsed.event_to_vod() does when the playlist starts at `start_time`.
+		"""
+		key = (start_time, interval)
+		segments = self._dated_segments.get(key)
+		if segments is None:
+			index = hlsed.ProgramDateTimeIndex(start_time, self.segment_ends)
+			segments = list(self.segments)
+			for i in range(0, len(segments), interval):
+				# Every segment starts with a new line followed by its tags.
+				segments[i] = "\n" + index.tag(i).text().encode('utf_8') + segments[i]
+			# Normally there is only one start time per playlist of a session, but let's not keep too many.
+			if len(self._dated_segments) >= 4:
+				self._dated_segments.clear()
+			self._dated_segments[key] = segments
+		return segments
+
+class AdSchedule:
+
+	"""The ad cues (see hlsed.ad_cues()) of an event, rendered once and extended as the time goes."""
+
+	def __init__(self, start_time, time_between_ads, ad_duration, style):
+		self._cues = hlsed.ad_cues(start_time, time_between_ads, ad_duration, style)
+		self._lock = threading.Lock()
+		self.times = []
+		self.tags = []
+
+	def tags_till(self, current_time):
+		"""The text of all the cue tags up to `current_time` inclusive."""
+		with self._lock:
+			while not self.times or self.times[-1] <= current_time:
+				t, tag = next(self._cues)
+				self.times.append(t)
+				self.tags.append(tag.text())
+			return self.tags[:bisect.bisect_right(self.times, current_time)]
+
+_PLAYLIST_TYPE_EVENT = m3u.Tag('#EXT-X-PLAYLIST-TYPE:EVENT').text()
+_PLAYLIST_TYPE_VOD = m3u.Tag('#EXT-X-PLAYLIST-TYPE:VOD').text()
+_ENDLIST = m3u.Tag('#EXT-X-ENDLIST').text()
+
+class Session:
+
+	"""
+	The state of a session. The `params` are the same as the ones used for /v1/eventify, i.e. an object with
+	`url`, `start_time`, `event_duration`, `ad_interval`, `ad_duration`, `ad_style`, `proxy_segments` 
+	and `pdt_interval` fields.
+	"""
+
+	def __init__(self, id, args, params):
+		self.id = id
+		self.args = args
+		self.params = params
+		self._lock = threading.Lock()
+		self._timelines = collections.OrderedDict()
+		self._ad_schedules = {}
+
+	def timeline(self, playlist_url, proxy_url, segment_proxy_url = None, timer = None):
+
+		"""
+		The Timeline of the playlist from `playlist_url` rebased the same way as hlsed.rebase() does.
+		It's prepared once and then only checked for changes upstream, which is cheap.
+		"""
+
+		key = (playlist_url, proxy_url, segment_proxy_url)
+		digest, hit = upstream.get_digest(playlist_url, timer)
+		with self._lock:
+			timeline = self._timelines.get(key)
+		metrics.record_cache('timeline', timeline is not None and timeline.digest == digest)
+		if timeline is not None and timeline.digest == digest:
+			return timeline
+
+		playlist, hit = upstream.get_playlist(playlist_url, timer)
+		hlsed.rebase(playlist, playlist_url, proxy_url, segment_proxy_url)
+		timeline = Timeline(playlist, digest)
+		with self._lock:
+			self._timelines.pop(key, None)
+			self._timelines[key] = timeline
+			while len(self._timelines) > MAX_TIMELINES:
+				self._timelines.popitem(last = False)
+		return timeline
+
+	def ad_schedule(self, start_time):
+		# Variants with different target durations have slightly different start times.
+		with self._lock:
+			schedule = self._ad_schedules.get(start_time)
+			if schedule is None:
+				p = self.params
+				schedule = AdSchedule(start_time, p.ad_interval, p.ad_duration, p.ad_style)
+				self._ad_schedules[start_time] = schedule
+			return schedule
+
+	def render(self, timeline, current_time):
+
+		"""
+		The text of the window of the given timeline at `current_time`, the same as what hlsed.event_to_vod()
+		followed by hlsed.insert_ad_cues() would produce.
+		"""
+
+		if timeline.is_master_playlist:
+			return timeline.master_text
+
+		p = self.params
+		start_time = p.start_time - 3 * timeline.target_duration
+		effective_duration = min(current_time - start_time, p.event_duration)
+
+		header = list(timeline.header)
+		if timeline.first_date is not None:
+			header += map(
+				lambda t: t.text(), 
+				hlsed.redated_dateranges(timeline.dateranges, start_time - timeline.first_date, current_time)
+			)
+		if p.pdt_interval > 0:
+			segments = timeline.with_program_date_time(start_time, p.pdt_interval)
+		else:
+			segments = timeline.segments
+			header.append(m3u.Tag('#EXT-X-PROGRAM-DATE-TIME:' + hlsed.time_as_iso8601(start_time)).text())
+		if current_time - start_time <= p.event_duration:
+			header.append(_PLAYLIST_TYPE_EVENT)
+		else:
+			header.append(_PLAYLIST_TYPE_VOD)
+			header.append(_ENDLIST)
+		if p.ad_interval > 0 and p.ad_duration > 0:
+			header += self.ad_schedule(start_time).tags_till(current_time)
+
+		n = timeline.window_length(effective_duration)
+		return ("\n".join(header) + "\n").encode('utf_8') + "".join(segments[:n])
+
+class Registry:
+
+	"""
+	Sessions by their IDs: the most recently used ones are kept in memory, while the parameters of all of them
+	are kept in the given disk cache, if any, so they can be restored by other processes or after a restart.
+	The parameters are turned into the `params` of sessions via `params_from_args`.
+	"""
+
+	def __init__(self, params_from_args, disk = None):
+		self.params_from_args = params_from_args
+		self.memory = cache.MemoryCache(max_items = SESSION_MEMORY_ITEMS)
+		self.disk = disk
+
+	def create(self, args):
+		"""Returns a session with the given parameters (a dictionary of strings), a new or an existing one."""
+		id = session_id(args)
+		session = self._lookup(id)
+		if session is None:
+			session = Session(id, args, self.params_from_args(args))
+			self.memory.set(id, session, SESSION_TTL)
+			if self.disk is not None:
+				self.disk.set(id, args, SESSION_TTL)
+		return session
+
+	def get(self, id):
+		"""The session with the given ID or None, if there is no such session or it has expired."""
+		session = self._lookup(id)
+		metrics.record_cache('session', session is not None)
+		return session
+
+	def _lookup(self, id):
+		session = self.memory.get(id)
+		if session is None and self.disk is not None:
+			entry = self.disk.get_entry(id)
+			if entry is not None:
+				expires, args = entry
+				session = Session(id, args, self.params_from_args(args))
+				self.memory.set(id, session, expires - time.time())
+		return session
@@ -0,0 +1,112 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+import analyze
+import inspect
+import m3u
+import os
+import shutil
+import tempfile
+import unittest
+
+MEDIA = inspect.cleandoc(
+	"""
+	#EXTM3U
+	#EXT-X-TARGETDURATION:6
+	#EXTINF:6.0,
+	s0.ts
+	#EXT-X-KEY:METHOD=AES-128,URI="k0"
+	#EXTINF:6.6,
+	s1.ts
+	#EXTINF:2.0,
+	s2.ts
+	#EXT-X-KEY:METHOD=AES-128,URI="k1"
+	#EXTINF:1.0,
+	s3.ts
+	#EXT-X-DISCONTINUITY
+	#EXT-X-KEY:METHOD=NONE
+	#EXTINF:6.0,
+	s4.ts
+	#EXTINF:1.0,
+	s5.ts
+	#EXT-X-ENDLIST
+	"""
+)
+
+MASTER = inspect.cleandoc(
+	"""
+	#EXTM3U
+	#EXT-X-STREAM-INF:BANDWIDTH=500000,RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2"
+	low.m3u8
+	#EXT-X-STREAM-INF:BANDWIDTH=3000000,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"
+	high.m3u8
+	"""
+)
+
+@unittest.skipIf(analyze.numpy is None, "NumPy is not installed")
+class AnalyzeTestCase(unittest.TestCase):
+
+	def test_media_stats(self):
+		playlist = m3u.Playlist(MEDIA)
+		segments = analyze.Segments(playlist)
+		self.assertEqual(list(segments.durations), [6.0, 6.6, 2.0, 1.0, 6.0, 1.0])
+		self.assertEqual(list(segments.discontinuities), [False] * 4 + [True, False])
+		# Two rotations and one switch to no encryption.
+		self.assertEqual(list(segments.key_changes), [False, True, False, True, True, False])
+
+		stats = analyze.media_stats('media', playlist, segments)
+		self.assertEqual(stats['segments'], 6)
+		self.assertEqual(stats['target_duration'], 6)
+		self.assertAlmostEqual(stats['total_duration'], 22.6)
+		self.assertEqual(stats['over_target'], 1)
+		self.assertAlmostEqual(stats['max_over_target'], 0.6)
+		self.assertEqual(stats['discontinuities'], 1)
+		self.assertEqual(stats['key_rotations'], 3)
+		self.assertEqual(stats['keys'], 2)
+		self.assertIsNone(stats['mean_bitrate'])
+
+	def test_media_outliers(self):
+		playlist = m3u.Playlist(MEDIA)
+		outliers = analyze.media_outliers('media', playlist, analyze.Segments(playlist), 0.5)
+		# s3 is followed by a discontinuity and s5 is the last one.
+		self.assertEqual(map(lambda o: (o['uri'], o['reason']), outliers), [('s1.ts', 'long'), ('s2.ts', 'short')])
+
+	def test_ladder_stats(self):
+		stats = analyze.ladder_stats('master', m3u.Playlist(MASTER))
+		self.assertEqual(stats['variants'], 2)
+		self.assertEqual(stats['min_bandwidth'], 500000)
+		self.assertEqual(stats['max_bandwidth'], 3000000)
+		self.assertEqual(stats['max_step_ratio'], 6)
+		self.assertEqual(stats['resolutions'], '1280x720 640x360')
+
+	def test_analyze(self):
+		directory = tempfile.mkdtemp()
+		try:
+			for name, text in [('a/media.m3u8', MEDIA), ('b/media.m3u8', MEDIA), ('master.m3u8', MASTER)]:
+				path = os.path.join(directory, name)
+				if not os.path.isdir(os.path.dirname(path)):
+					os.makedirs(os.path.dirname(path))
+				with open(path, 'wb') as f:
+					f.write(text)
+			missing = os.path.join(directory, 'missing.m3u8')
+
+			sources = analyze.find_sources([directory])
+			self.assertEqual(len(sources), 3)
+			report = analyze.analyze(sources + [missing], processes = 2, max_outliers = 3)
+		finally:
+			shutil.rmtree(directory)
+
+		summary = report['summary']
+		self.assertEqual(summary['playlists'], 2)
+		self.assertEqual(summary['master_playlists'], 1)
+		self.assertEqual(summary['segments'], 12)
+		self.assertEqual(summary['outliers'], 4)
+		self.assertEqual(summary['errors'], 1)
+		self.assertEqual(summary['max_duration'], 6.6)
+		self.assertEqual(len(report['outliers']), 3)
+		# The biggest differences from the target duration first.
+		self.assertEqual(report['outliers'][0]['uri'], 's2.ts')
+		self.assertEqual(report['errors'][0]['source'], missing)
+
+if __name__ == '__main__':
+	unittest.main()
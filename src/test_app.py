@@ -0,0 +1,238 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
+import aliases
+import app
+import bench
+import json
+import m3u
+import origin
+import os
+import serve
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import upstream
+import urllib
+
+class BatchTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		os.makedirs(os.path.join(self.dir, 'test', 'low'))
+		with open(os.path.join(self.dir, 'test', 'index.m3u8'), 'w') as f:
+			f.write("#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1000000\nlow/variant.m3u8\n")
+		with open(os.path.join(self.dir, 'test', 'low', 'variant.m3u8'), 'w') as f:
+			f.write(bench.large_media_playlist_text(100))
+
+		self.saved_mirrors_dir = aliases.MIRRORS_DIR
+		aliases.MIRRORS_DIR = self.dir
+		origin_app = Flask(__name__)
+		origin_app.register_blueprint(origin.blueprint)
+		self.origin = serve.PooledWSGIServer('127.0.0.1', 0, origin_app, 4)
+		t = threading.Thread(target = self.origin.serve_forever)
+		t.daemon = True
+		t.start()
+		self.master_url = 'http://127.0.0.1:%d/test/index.m3u8' % (self.origin.server_port,)
+
+		self.client = app.app.test_client()
+
+	def tearDown(self):
+		self.origin.shutdown()
+		self.origin.server_close()
+		aliases.MIRRORS_DIR = self.saved_mirrors_dir
+		shutil.rmtree(self.dir)
+
+	def post(self, body):
+		r = self.client.post('/v1/batch', data = json.dumps(body), content_type = 'application/json')
+		self.assertEqual(r.status_code, 200)
+		return json.loads(r.data)['sessions']
+
+	def test_sessions(self):
+		session = { 'url': self.master_url, 'ref_time': 1612345678, 'duration': 600 }
+		results = self.post({ 'sessions': [session, session, { 'duration': 1 }, 'x'], 'variants': True })
+		self.assertEqual(len(results), 4)
+		self.assertEqual(results[0], results[1])
+		self.assertIn('error', results[2])
+		self.assertIn('error', results[3])
+
+		master = m3u.Playlist(results[0]['playlist'])
+		self.assertTrue(master.is_master_playlist)
+		self.assertEqual(len(results[0]['variants']), 1)
+		variant = results[0]['variants'][0]
+		self.assertEqual(variant['url'], master.uris[0].uri)
+		self.assertFalse(m3u.Playlist(variant['playlist']).is_master_playlist)
+
+		# The same as what the regular endpoint returns for the same URL.
+		r = self.client.get(results[0]['url'].replace('https://localhost', ''))
+		self.assertEqual(r.data, results[0]['playlist'])
+
+	def test_urls_only(self):
+		results = self.post({ 'sessions': [{ 'url': self.master_url, 'ref_time': 1612345678 }], 'playlists': False })
+		self.assertEqual(results[0].keys(), ['url'])
+		self.assertIn('ref_time=1612345678', results[0]['url'])
+
+	def test_overloaded(self):
+		saved = upstream.limits
+		upstream.limits = upstream.HostLimits(1, 0, 0.1)
+		try:
+			# Someone else is waiting for the origin already.
+			upstream.limits.acquire(upstream.host_of(self.master_url))
+			r = self.client.get('/v1/eventify?duration=600&url=' + urllib.quote(self.master_url + '?overloaded'))
+			self.assertEqual(r.status_code, 503)
+			self.assertEqual(r.headers['Retry-After'], str(upstream.RETRY_AFTER))
+		finally:
+			upstream.limits = saved
+
+	def test_clock(self):
+		# 100 seconds into a 60 second event at 10x.
+		url = '/v1/eventify?duration=60&ref_time=%d&url=%s' % (int(time.time()) - 10, urllib.quote(self.master_url))
+		variant_url = url.replace('index.m3u8', 'low/variant.m3u8')
+		r = self.client.get(variant_url + '&speed=10')
+		self.assertIn('#EXT-X-ENDLIST', r.data)
+		self.assertEqual(r.headers['Cache-Control'], 'max-age=0')
+
+		r = self.client.get(variant_url)
+		self.assertNotIn('#EXT-X-ENDLIST', r.data)
+		self.assertEqual(r.headers['Cache-Control'], 'max-age=2')
+
+		# Stopped before that, and a minute ahead.
+		r = self.client.get(variant_url + '&speed=10&pause_at=30')
+		self.assertNotIn('#EXT-X-ENDLIST', r.data)
+		self.assertIn('#EXT-X-ENDLIST', self.client.get(variant_url + '&time_offset=60').data)
+
+		# The same for sessions.
+		r = self.client.post('/v1/sessions', data = { 'url': self.master_url, 'duration': 60, 'speed': 10 })
+		session_url = json.loads(r.data)['url'].replace('https://localhost', '')
+		master = m3u.Playlist(self.client.get(session_url).data)
+		r = self.client.get(master.uris[0].uri.replace('https://localhost', ''))
+		self.assertNotIn('#EXT-X-ENDLIST', r.data)
+		self.assertEqual(r.headers['Cache-Control'], 'max-age=0')
+
+		for speed in ['nan', 'inf', '1e308', '0']:
+			self.assertEqual(self.client.get(variant_url + '&speed=' + speed).status_code, 400)
+			r = self.client.post('/v1/sessions', data = { 'url': self.master_url, 'duration': 60, 'speed': speed })
+			self.assertEqual(r.status_code, 400)
+
+	def test_segment(self):
+		with open(os.path.join(self.dir, 'test', 'low', 'segment.ts'), 'wb') as f:
+			f.write('x' * 1000)
+		segment_url = self.master_url.replace('index.m3u8', 'low/segment.ts')
+
+		def get(url, **kwargs):
+			query = urllib.urlencode({ 'url': url, 'sig': upstream.segment_signature(url) })
+			return self.client.get('/v1/segment?' + query, **kwargs)
+
+		r = get(segment_url, headers = { 'Range': 'bytes=10-19' })
+		self.assertEqual(r.status_code, 206)
+		self.assertEqual(r.data, 'x' * 10)
+		self.assertEqual(get(segment_url).headers['X-Hlsed-Cache'], 'hit')
+
+		# Not signed by us, or signed for another URL.
+		r = self.client.get('/v1/segment?url=' + urllib.quote(segment_url))
+		self.assertEqual(r.status_code, 403)
+		other_url = segment_url + '?other'
+		r = self.client.get('/v1/segment?' + urllib.urlencode({ 'url': other_url, 'sig': upstream.segment_signature(segment_url) }))
+		self.assertEqual(r.status_code, 403)
+
+		# Only HTTP(S), even when signed.
+		self.assertEqual(get('file:///etc/passwd').status_code, 400)
+
+		saved = upstream.SEGMENT_MAX_SIZE
+		upstream.SEGMENT_MAX_SIZE = 100
+		try:
+			self.assertEqual(get(segment_url + '?large').status_code, 502)
+		finally:
+			upstream.SEGMENT_MAX_SIZE = saved
+
+	def test_segment_from_disk(self):
+		cache_dir = tempfile.mkdtemp()
+		saved = (
+			upstream.playlist_digests, upstream.playlist_contents, upstream.segments, upstream.segment_secret,
+			upstream.SEGMENT_MEMORY_MAX_SIZE
+		)
+		try:
+			upstream.configure_cache(cache_dir)
+			upstream.SEGMENT_MEMORY_MAX_SIZE = 100
+			with open(os.path.join(self.dir, 'test', 'low', 'segment.ts'), 'wb') as f:
+				f.write(''.join(map(chr, range(256))) * 4)
+			segment_url = self.master_url.replace('index.m3u8', 'low/segment.ts')
+
+			for hit in [False, True]:
+				(content_type, body, size), was_hit = upstream.get_segment(segment_url)
+				self.assertEqual(was_hit, hit)
+				self.assertEqual(size, 1024)
+				# Too large to keep in memory, so served right from the file.
+				self.assertFalse(isinstance(body, str))
+				self.assertEqual(body.read(), ''.join(map(chr, range(256))) * 4)
+				body.close()
+
+			query = urllib.urlencode({ 'url': segment_url, 'sig': upstream.segment_signature(segment_url) })
+			r = self.client.get('/v1/segment?' + query, headers = { 'Range': 'bytes=256-259' })
+			self.assertEqual(r.status_code, 206)
+			self.assertEqual(r.data, '\x00\x01\x02\x03')
+			r.close()
+		finally:
+			(
+				upstream.playlist_digests, upstream.playlist_contents, upstream.segments, upstream.segment_secret,
+				upstream.SEGMENT_MEMORY_MAX_SIZE
+			) = saved
+			shutil.rmtree(cache_dir)
+
+	def test_invalid(self):
+		r = self.client.post('/v1/batch', data = 'not json')
+		self.assertEqual(r.status_code, 400)
+
+class ProfilingTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.saved = (app.PROFILE_ALLOWED_ADDRS, app.app.wsgi_app)
+		app.PROFILE_ALLOWED_ADDRS = ['10.1.2.3']
+
+	def tearDown(self):
+		app.PROFILE_ALLOWED_ADDRS, app.app.wsgi_app = self.saved
+
+	def get(self, remote_addr, forwarded_for = None):
+		# An unsupported mode, so it's either 403 (not allowed) or 400.
+		headers = { 'X-Forwarded-For': forwarded_for } if forwarded_for else {}
+		r = app.app.test_client().get(
+			'/v1/eventify?url=x&profile=unknown', headers = headers, environ_base = { 'REMOTE_ADDR': remote_addr }
+		)
+		return r.status_code
+
+	def test_allowed_addrs(self):
+		self.assertEqual(self.get('10.1.2.3'), 400)
+		self.assertEqual(self.get('127.0.0.1'), 403)
+		# The header is not trusted by default...
+		self.assertEqual(self.get('127.0.0.1', '10.1.2.3'), 403)
+		# ...but it is with a proxy in front of us (see TRUSTED_PROXIES), taking the address it added.
+		app.app.wsgi_app = ProxyFix(self.saved[1], x_for = 1)
+		self.assertEqual(self.get('127.0.0.1', '10.1.2.3'), 400)
+		self.assertEqual(self.get('127.0.0.1', '10.1.2.3, 127.0.0.2'), 403)
+
+	def test_token(self):
+		saved = app.PROFILE_TOKEN
+		app.PROFILE_TOKEN = 'secret'
+		try:
+			get = lambda token: app.app.test_client().get(
+				'/v1/eventify?url=x&profile=unknown', headers = { app.PROFILE_TOKEN_HEADER: token }
+			).status_code
+			self.assertEqual(get('secret'), 400)
+			self.assertEqual(get('secreT'), 403)
+			self.assertEqual(get(''), 403)
+			self.assertEqual(get(u'\u00e9'), 403)
+		finally:
+			app.PROFILE_TOKEN = saved
+
+class EventifyParamsTestCase(unittest.TestCase):
+
+	def test_event_duration(self):
+		# It used to be a tuple when taken from the query string.
+		with app.app.test_request_context('/v1/eventify?duration=600&url=x'):
+			self.assertEqual(app.EventifyParams().event_duration, 600)
+		self.assertEqual(app.EventifyParams({ 'url': 'x' }).event_duration, 60)
+		self.assertEqual(app.EventifyParams({ 'url': 'x', 'duration': 30 }).event_duration, 30)
@@ -0,0 +1,232 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+import cache
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+class MemoryCacheTestCase(unittest.TestCase):
+
+	def test_lru(self):
+		c = cache.MemoryCache(max_items = 2)
+		c.set('a', 1, 10)
+		c.set('b', 2, 10)
+		self.assertEqual(c.get('a'), 1)
+		c.set('c', 3, 10)
+		# 'b' was the least recently used one.
+		self.assertIsNone(c.get('b'))
+		self.assertEqual(c.get('a'), 1)
+		self.assertEqual(c.get('c'), 3)
+
+	def test_ttl(self):
+		c = cache.MemoryCache()
+		c.set('a', 1, -1)
+		self.assertIsNone(c.get('a'))
+
+class DiskCacheTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_basics(self):
+		c = cache.DiskCache(self.dir)
+		c.set('a', u'text', 10)
+		self.assertEqual(c.get('a'), u'text')
+		# Another instance (or process) using the same directory sees the same entries.
+		self.assertEqual(cache.DiskCache(self.dir).get('a'), u'text')
+		c.set('b', 'expired', -1)
+		self.assertIsNone(c.get('b'))
+		self.assertIsNone(c.get('c'))
+
+	def test_prune(self):
+		c = cache.DiskCache(self.dir, max_bytes = 3000)
+		for i in range(5):
+			c.set(str(i), 'x' * 1000, 10)
+			# Making sure the modification times differ.
+			os.utime(c._path(str(i)), (i, i))
+		c.prune()
+		self.assertIsNone(c.get('0'))
+		self.assertIsNone(c.get('1'))
+		self.assertIsNone(c.get('2'))
+		self.assertIsNotNone(c.get('3'))
+		self.assertIsNotNone(c.get('4'))
+
+	def test_lock_files(self):
+		c = cache.DiskCache(self.dir)
+		lock_path = lambda key: os.path.join(c._locks_dir(), c._name(key))
+		with c.lock('old'):
+			pass
+		with c.lock('new'):
+			pass
+		os.utime(lock_path('old'), (0, 0))
+
+		# Only the old lock files that are not held are removed.
+		held = c.lock('held')
+		held.acquire()
+		os.utime(lock_path('held'), (0, 0))
+		c.prune()
+		self.assertFalse(os.path.exists(lock_path('old')))
+		self.assertTrue(os.path.exists(lock_path('new')))
+		self.assertTrue(os.path.exists(lock_path('held')))
+
+		# Whoever was waiting for a lock whose file is removed meanwhile gets a new one.
+		waiting = c.lock('held')
+		t = threading.Thread(target = waiting.acquire)
+		t.start()
+		time.sleep(0.1)
+		os.remove(lock_path('held'))
+		held.release()
+		t.join()
+		self.assertFalse(c.lock('held').acquire(blocking = False))
+		waiting.release()
+		other = c.lock('held')
+		self.assertTrue(other.acquire(blocking = False))
+		other.release()
+
+class TieredCacheTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_coalescing(self):
+
+		c = cache.TieredCache(cache.MemoryCache(), cache.DiskCache(self.dir))
+		calls = []
+		def compute():
+			calls.append(1)
+			time.sleep(0.1)
+			return 'value'
+
+		results = []
+		def get():
+			results.append(c.get_or_compute('key', 10, compute))
+
+		threads = [threading.Thread(target = get) for i in range(5)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(sorted(results), [('value', False)] + [('value', True)] * 4)
+
+	def test_disk_tier(self):
+		c1 = cache.TieredCache(cache.MemoryCache(), cache.DiskCache(self.dir))
+		c2 = cache.TieredCache(cache.MemoryCache(), cache.DiskCache(self.dir))
+		c1.set('key', 'value', 10)
+		self.assertEqual(c2.get_or_compute('key', 10, lambda: 'other'), ('value', True))
+
+	def test_stale_while_revalidate(self):
+
+		c = cache.TieredCache(cache.MemoryCache(), cache.DiskCache(self.dir))
+		values = iter(['v1', 'v2', 'v3'])
+		calls = []
+		def compute():
+			calls.append(1)
+			time.sleep(0.1)
+			return next(values)
+
+		get = lambda: c.get_or_revalidate('key', 0.2, compute, max_stale = 10, max_stale_if_error = 10)
+		self.assertEqual(get(), ('v1', False, None))
+		self.assertEqual(get(), ('v1', True, None))
+		time.sleep(0.25)
+
+		# Served right away while a single background thread computes the new value.
+		started = time.time()
+		for i in range(5):
+			self.assertEqual(get(), ('v1', True, 'revalidate'))
+		self.assertLess(time.time() - started, 0.05)
+		time.sleep(0.2)
+		self.assertEqual(len(calls), 2)
+		self.assertEqual(get(), ('v2', True, None))
+
+	def test_stale_if_error(self):
+
+		c = cache.TieredCache(cache.MemoryCache())
+		def fail():
+			raise Exception("Down")
+
+		self.assertEqual(c.get_or_revalidate('key', 0.1, lambda: 'v1', max_stale_if_error = 0.3), ('v1', False, None))
+		time.sleep(0.15)
+		self.assertEqual(c.get_or_revalidate('key', 0.1, fail, max_stale_if_error = 0.3), ('v1', True, 'error'))
+		time.sleep(0.3)
+		self.assertRaises(Exception, c.get_or_revalidate, 'key', 0.1, fail, max_stale_if_error = 0.3)
+
+	def test_concurrent_errors(self):
+
+		c = cache.TieredCache(cache.MemoryCache())
+		calls = []
+		def fail():
+			calls.append(1)
+			time.sleep(0.2)
+			raise Exception("Down")
+
+		def get_concurrently(key, count):
+			results = [None] * count
+			def get(i):
+				started = time.time()
+				try:
+					results[i] = c.get_or_revalidate(key, 0.1, fail, max_stale_if_error = 10, error_ttl = 0.5)
+				except Exception as e:
+					results[i] = e
+				results[i] = (results[i], time.time() - started)
+			threads = map(lambda i: threading.Thread(target = get, args = (i,)), range(count))
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+			return results
+
+		# The others don't wait for the one trying to compute it with a stale value at hand...
+		c.get_or_revalidate('key', 0.1, lambda: 'v1', max_stale_if_error = 10)
+		time.sleep(0.15)
+		results = get_concurrently('key', 5)
+		self.assertEqual(map(lambda (result, seconds): result, results), [('v1', True, 'error')] * 5)
+		self.assertEqual(len(filter(lambda (result, seconds): seconds < 0.1, results)), 4)
+		self.assertEqual(len(calls), 1)
+		# ...and nobody tries again for a while after it failed.
+		self.assertEqual(get_concurrently('key', 1)[0][0], ('v1', True, 'error'))
+		self.assertEqual(len(calls), 1)
+
+		# Without one they wait, but get the same error.
+		results = get_concurrently('other', 3)
+		self.assertEqual(len(set(map(lambda (result, seconds): id(result), results))), 1)
+		self.assertEqual(len(calls), 2)
+		time.sleep(0.5)
+		get_concurrently('other', 1)
+		self.assertEqual(len(calls), 3)
+
+	def test_refresh(self):
+
+		# Two processes sharing the directory.
+		c1 = cache.TieredCache(cache.MemoryCache(), cache.DiskCache(self.dir))
+		c2 = cache.TieredCache(cache.MemoryCache(), cache.DiskCache(self.dir))
+		values = iter(['v1', 'v2', 'v3'])
+		fail = lambda: self.fail("Should not be computed")
+
+		self.assertEqual(c1.get_or_revalidate('key', 0.2, lambda: next(values), max_stale = 1), ('v1', False, None))
+		self.assertEqual(c1.refresh('key', 0.2, fail, max_stale = 1), 'v1')
+		time.sleep(0.15)
+		self.assertEqual(c1.refresh('key', 0.2, lambda: next(values), max_stale = 1), 'v2')
+		# The other one has just done it.
+		self.assertEqual(c2.refresh('key', 0.2, fail, max_stale = 1), 'v2')
+		self.assertEqual(c2.get_or_revalidate('key', 0.2, fail, max_stale = 1), ('v2', True, None))
+
+		time.sleep(0.15)
+		self.assertEqual(c2.refresh('key', 0.2, lambda: next(values), max_stale = 1), 'v3')
+		# The memory of the first one is updated from the disk.
+		self.assertEqual(c1.refresh('key', 0.2, fail, max_stale = 1), 'v3')
+		self.assertEqual(c1.get_or_revalidate('key', 0.2, fail, max_stale = 1), ('v3', True, None))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,32 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+import clock
+import unittest
+
+class ClockTestCase(unittest.TestCase):
+
+	def test_real(self):
+		c = clock.Clock(1000)
+		self.assertTrue(c.is_real())
+		self.assertEqual(c.now(1234.5), 1234.5)
+		self.assertEqual(c.real_seconds(2), 2)
+
+	def test_virtual(self):
+		c = clock.Clock(1000, speed = 16, offset = 60)
+		self.assertFalse(c.is_real())
+		# The event starts at the same moment, then 4 hours take 15 minutes.
+		self.assertEqual(c.now(1000), 1060)
+		self.assertEqual(c.now(1000 + 15 * 60), 1000 + 4 * 3600 + 60)
+		self.assertEqual(c.real_seconds(2), 0.125)
+
+		c = clock.Clock(1000, speed = 2, pause_at = 100)
+		self.assertEqual(c.now(1040), 1080)
+		self.assertEqual(c.now(1050), 1100)
+		self.assertEqual(c.now(2000), 1100)
+
+		for speed in [0, -1, float('nan'), float('inf'), 1e308]:
+			self.assertRaises(Exception, clock.Clock, 1000, speed = speed)
+
+if __name__ == '__main__':
+	unittest.main()
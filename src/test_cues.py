@@ -0,0 +1,66 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+import base64
+import binascii
+import cues
+import inspect
+import m3u
+import scte35
+import unittest
+
+class CuesTestCase(unittest.TestCase):
+
+	splice_insert = "/DAvAAAAAAAA///wFAVIAACPf+/+c2nALv4AUsz1AAAAAAAKAAhDVUVJAAABNWLbowo="
+
+	def test_parse_iso8601(self):
+		self.assertEqual(cues.parse_iso8601("2021-02-03T09:47:58Z"), 1612345678)
+		self.assertEqual(cues.parse_iso8601("2021-02-03T09:47:58.250Z"), 1612345678.25)
+		self.assertEqual(cues.parse_iso8601("2021-02-03T10:47:58+01:00"), 1612345678)
+		self.assertEqual(cues.parse_iso8601("2021-02-03T04:47:58-0500"), 1612345678)
+		self.assertRaises(ValueError, cues.parse_iso8601, "yesterday")
+
+	def splice_time(self, section):
+		info = scte35.decode(section)
+		return (info.pts_adjustment + info.splice_time()) % scte35.PTS_MODULO
+
+	def test_retime(self):
+		hex_section = binascii.hexlify(base64.b64decode(self.splice_insert)).upper()
+		playlist = cues.retime(m3u.Playlist(inspect.cleandoc(
+			"""
+			#EXTM3U
+			#EXT-X-TARGETDURATION:6
+			#EXT-X-DATERANGE:ID="1",START-DATE="2021-02-03T09:48:10Z",SCTE35-OUT=0x%s
+			#EXT-X-PROGRAM-DATE-TIME:2021-02-03T09:47:58Z
+			#EXTINF:6,
+			0.ts
+			#EXT-OATCLS-SCTE35:%s
+			#EXT-X-CUE-OUT:30
+			#EXTINF:6,
+			1.ts
+			#EXT-X-CUE-OUT-CONT:ElapsedTime=6,Duration=30,SCTE35=%s
+			#EXTINF:6,
+			2.ts
+			#EXT-X-CUE-IN
+			#EXTINF:6,
+			3.ts
+			"""
+		) % (hex_section, self.splice_insert, self.splice_insert)))
+
+		daterange = playlist.global_tag_by_name('EXT-X-DATERANGE')
+		self.assertEqual(self.splice_time(binascii.unhexlify(daterange.attributes['SCTE35-OUT'].value)), 12 * 90000)
+		oatcls = playlist.uris[1].tag_by_name('EXT-OATCLS-SCTE35')
+		self.assertEqual(self.splice_time(base64.b64decode(oatcls.values[0])), 6 * 90000)
+		cont = playlist.uris[2].tag_by_name('EXT-X-CUE-OUT-CONT')
+		self.assertEqual(self.splice_time(base64.b64decode(cont.values[2][len('SCTE35='):])), 6 * 90000)
+		# Everything else is the same.
+		self.assertEqual(cont.values[:2], ['ElapsedTime=6', 'Duration=30'])
+		self.assertEqual(scte35.decode(base64.b64decode(oatcls.values[0])).command.splice_event_id, 0x4800008F)
+		self.assertIn('#EXT-X-CUE-IN\n#EXTINF:6,\n3.ts', playlist.text())
+
+	def test_invalid(self):
+		text = "#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXT-OATCLS-SCTE35:notscte35\n#EXTINF:6,\n0.ts\n"
+		self.assertEqual(cues.retime(m3u.Playlist(text)).text(), m3u.Playlist(text).text())
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,10 +1,14 @@
 # HLS tools.
 # Copyright (C) 2021, MediaMonks B.V. All rights reserved.
 
+import bench
 import hlsed
 import inspect
 import m3u
+import metrics
+import time
 import unittest
+import upstream
 import urlparse
 
 class MiscTestCase(unittest.TestCase):
@@ -316,5 +320,247 @@ class RebaseTestCase(unittest.TestCase):
 			)
 		)
 
+	def test_media_with_segment_proxy(self):
+		self.playlist = m3u.Playlist(inspect.cleandoc(
+			"""
+			#EXTM3U
+			#EXT-X-VERSION:6
+			#EXT-X-TARGETDURATION:8
+			#EXT-X-MAP:URI="init.mp4"
+			#EXT-X-KEY:METHOD=AES-128,URI="keys/1.key"
+
+			#EXTINF:7.975,
+			fileSequence2680.m4s
+			#EXT-X-KEY:METHOD=SAMPLE-AES,URI="skd://key",KEYFORMAT="com.apple.streamingkeydelivery"
+			#EXTINF:7.941,
+			https://priv.example.com/fileSequence2681.m4s
+			"""
+		))
+		def signed(url):
+			segment_url = urlparse.parse_qs(urlparse.urlsplit(url).query)['url'][0]
+			return url + "&sig=" + upstream.segment_signature(segment_url)
+		hlsed.rebase(
+			self.playlist,
+			"https://another.example.com/playlist/index.m3u8",
+			"http://example.com:11000/hlsed?something=value",
+			"http://example.com:11000/segment"
+		)
+		# (Note that the tags like EXT-X-MAP are shared by all the URIs they apply to.)
+		map_tag = self.playlist.uris[1].tag_by_name('EXT-X-MAP')
+		self.assertEqual(
+			map_tag.attributes['URI'].value,
+			signed("http://example.com:11000/segment?url=https%3A%2F%2Fanother.example.com%2Fplaylist%2Finit.mp4")
+		)
+		keys = map(lambda item: filter(lambda t: t.name == 'EXT-X-KEY', item.tags)[-1], self.playlist.uris)
+		self.assertEqual(
+			map(lambda t: t.attributes['URI'].value, keys),
+			[
+				signed("http://example.com:11000/segment?url=https%3A%2F%2Fanother.example.com%2Fplaylist%2Fkeys%2F1.key"),
+				# We cannot fetch this one.
+				"skd://key"
+			]
+		)
+		self.assertEqual(
+			map(lambda item: item.uri, self.playlist.uris),
+			[
+				signed("http://example.com:11000/segment?url=https%3A%2F%2Fanother.example.com%2Fplaylist%2FfileSequence2680.m4s"),
+				signed("http://example.com:11000/segment?url=https%3A%2F%2Fpriv.example.com%2FfileSequence2681.m4s")
+			]
+		)
+
+class ViewTestCase(unittest.TestCase):
+	
+	"""The transformations should produce the same results for views of snapshots as they do for playlists."""
+	
+	def check(self, text, transform):
+		playlist = m3u.Playlist(text)
+		transform(playlist)
+		view = m3u.Snapshot(m3u.Playlist(text)).view()
+		transform(view)
+		self.assertEqual(view.text(), playlist.text())
+	
+	def test_master(self):
+		text = inspect.cleandoc(
+			"""
+			#EXTM3U
+			#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aac",NAME="English",URI="audio/en.m3u8"
+			#EXT-X-STREAM-INF:BANDWIDTH=1280000,AUDIO="aac"
+			http://example.com/low.m3u8
+			#EXT-X-I-FRAME-STREAM-INF:BANDWIDTH=86000,URI="low/iframe.m3u8"
+			#EXT-X-STREAM-INF:BANDWIDTH=2560000,AUDIO="aac"
+			mid.m3u8
+			"""
+		)
+		self.check(text, lambda p: hlsed.rebase(p, "https://another.example.com/index.m3u8", "http://example.com/v1/eventify?x=1"))
+	
+	def test_media(self):
+		text = bench.large_media_playlist_text(100).replace(
+			"#EXT-X-MEDIA-SEQUENCE:0", '#EXT-X-MEDIA-SEQUENCE:0\n#EXT-X-MAP:URI="init.mp4"\n#EXT-X-KEY:METHOD=AES-128,URI="k"'
+		)
+		for current_time in [1000, 1100, 1500, 9999]:
+			for segment_proxy_url in [None, "http://example.com/v1/segment"]:
+				def transform(p):
+					hlsed.rebase(p, "https://another.example.com/index.m3u8", "http://example.com/", segment_proxy_url)
+					hlsed.event_to_vod(p, 300, 1000, current_time, True)
+					hlsed.insert_ad_cues(p, 300, 1000, current_time, 40, 20)
+				self.check(text, transform)
+
+class ProgramDateTimeTestCase(unittest.TestCase):
+	
+	def test_time_as_iso8601(self):
+		for t in [0, 59, 86399, 86400, 951782400, 1612345678, 4102444799]:
+			self.assertEqual(hlsed.time_as_iso8601(t), time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(t)))
+		self.assertEqual(hlsed.time_as_iso8601(1612345678.1234), "2021-02-03T09:47:58.123Z")
+		self.assertEqual(hlsed.time_as_iso8601(1612345678.9996), "2021-02-03T09:47:59.000Z")
+		self.assertEqual(hlsed.time_as_iso8601(86399.9999), "1970-01-02T00:00:00.000Z")
+	
+	def test_index(self):
+		index = hlsed.ProgramDateTimeIndex(1000, [5, 15, 25.5])
+		self.assertEqual(map(index.segment_start, range(3)), [1000, 1005, 1015])
+		self.assertEqual(map(index.segment_at, [999, 1000, 1004.9, 1005, 1025.4, 1025.5]), [None, 0, 0, 1, 2, None])
+		for i in range(3):
+			self.assertEqual(index.segment_at(index.segment_start(i)), i)
+		self.assertEqual(index.tag(1).text(), "#EXT-X-PROGRAM-DATE-TIME:1970-01-01T00:16:45.000Z")
+	
+	def test_every_nth_segment(self):
+		text = bench.large_media_playlist_text(100)
+		for interval in [1, 3]:
+			playlist = m3u.Playlist(text)
+			hlsed.event_to_vod(playlist, 3600, 1000, 1100, True, program_date_time_interval = interval)
+			self.assertIsNone(playlist.global_tag_by_name('EXT-X-PROGRAM-DATE-TIME'))
+			index = hlsed.ProgramDateTimeIndex(1000 - 3 * 6, playlist.segment_ends())
+			for i, u in enumerate(playlist.uris):
+				tag = u.tag_by_name('EXT-X-PROGRAM-DATE-TIME')
+				if i % interval == 0:
+					self.assertEqual(tag.values[0], hlsed.time_as_iso8601(index.segment_start(i)))
+				else:
+					self.assertIsNone(tag)
+			# The same for views.
+			view = m3u.Snapshot(m3u.Playlist(text)).view()
+			hlsed.event_to_vod(view, 3600, 1000, 1100, True, program_date_time_interval = interval)
+			self.assertEqual(view.text(), playlist.text())
+	
+	def test_no_program_date_time(self):
+		playlist = m3u.Playlist(bench.large_media_playlist_text(10))
+		hlsed.event_to_vod(playlist, 3600, 1000, 1100)
+		self.assertNotIn('EXT-X-PROGRAM-DATE-TIME', playlist.text())
+
+class UpstreamCuesTestCase(unittest.TestCase):
+	
+	text = inspect.cleandoc(
+		"""
+		#EXTM3U
+		#EXT-X-TARGETDURATION:5
+		#EXT-X-DATERANGE:ID="a",START-DATE="2021-01-01T00:00:05Z",END-DATE="2021-01-01T00:00:10.500Z"
+		#EXT-X-DATERANGE:ID="b",START-DATE="2021-01-01T00:00:20Z",DURATION=5
+		#EXT-X-PROGRAM-DATE-TIME:2021-01-01T00:00:00Z
+		#EXTINF:5,
+		0.ts
+		#EXTINF:5,
+		1.ts
+		#EXTINF:5,
+		2.ts
+		#EXTINF:5,
+		3.ts
+		#EXTINF:5,
+		4.ts
+		"""
+	)
+	
+	def test_redated(self):
+		# The event starts at 1000 - 3 * 5.
+		stage = hlsed.UpstreamCuesStage(60, 1000, 1000)
+		playlist = hlsed.Pipeline([stage]).apply(m3u.Playlist(self.text))
+		tags = playlist.global_tags('EXT-X-DATERANGE')
+		self.assertEqual(len(tags), 1)
+		self.assertEqual(tags[0].attributes['START-DATE'].value, "1970-01-01T00:16:30.000Z")
+		self.assertEqual(tags[0].attributes['END-DATE'].value, "1970-01-01T00:16:35.500Z")
+		for current_time in [1000, 1005, 1100]:
+			stage = hlsed.UpstreamCuesStage(60, 1000, current_time)
+			playlist = hlsed.Pipeline([stage]).apply(m3u.Playlist(self.text))
+			view = hlsed.Pipeline([stage]).apply(m3u.Snapshot(m3u.Playlist(self.text)).view())
+			self.assertEqual(view.text(), playlist.text())
+		self.assertEqual(len(playlist.global_tags('EXT-X-DATERANGE')), 2)
+	
+	def test_without_dates(self):
+		text = self.text.replace("#EXT-X-PROGRAM-DATE-TIME:2021-01-01T00:00:00Z\n", "")
+		playlist = hlsed.Pipeline([hlsed.UpstreamCuesStage(60, 1000, 1000)]).apply(m3u.Playlist(text))
+		self.assertEqual(playlist.text(), m3u.Playlist(text).text())
+
+class PipelineTestCase(unittest.TestCase):
+	
+	playlist_url = "https://another.example.com/index.m3u8"
+	
+	text = bench.large_media_playlist_text(100).replace(
+		"#EXT-X-MEDIA-SEQUENCE:0", 
+		'#EXT-X-MEDIA-SEQUENCE:0\n#EXT-X-MAP:URI="init.mp4"\n#EXT-X-KEY:METHOD=AES-128,URI="k"'
+	)
+	
+	def stages(self, current_time):
+		return [
+			hlsed.RebaseStage(self.playlist_url, "http://example.com/", "http://example.com/v1/segment"),
+			hlsed.EventToVODStage(300, 1000, current_time, True),
+			hlsed.AdCuesStage(300, 1000, current_time, 40, 20)
+		]
+	
+	def test_same_as_unfused(self):
+		for current_time in [1000, 1100, 1500, 9999]:
+			expected = m3u.Playlist(self.text)
+			for stage in self.stages(current_time):
+				hlsed.Pipeline([stage]).apply(expected)
+			fused = hlsed.Pipeline(self.stages(current_time)).apply(m3u.Playlist(self.text))
+			self.assertEqual(fused.text(), expected.text())
+			view = hlsed.Pipeline(self.stages(current_time)).apply(m3u.Snapshot(m3u.Playlist(self.text)).view())
+			self.assertEqual(view.text(), expected.text())
+	
+	def test_early_stop(self):
+		playlist = m3u.Playlist(self.text)
+		uris = list(playlist.uris)
+		hlsed.Pipeline(self.stages(1100)).apply(playlist)
+		self.assertTrue(0 < len(playlist.uris) < len(uris))
+		# The segments beyond the window were not touched.
+		self.assertTrue(uris[len(playlist.uris) - 1].uri.startswith("http://example.com/v1/segment?"))
+		self.assertEqual(uris[len(playlist.uris)].uri, "media/segment%d.ts" % (len(playlist.uris),))
+	
+	def test_laps(self):
+		timer = metrics.StageTimer()
+		hlsed.Pipeline(self.stages(1100)).apply(m3u.Snapshot(m3u.Playlist(self.text)).view(), timer)
+		self.assertEqual(
+			map(lambda (name, seconds, desc): (name, desc), timer.stages),
+			[('rebase', None), ('event_to_vod', 'window'), ('insert_ad_cues', 'ad cues'), ('single_pass', 'single pass')]
+		)
+
+class RebaserTestCase(unittest.TestCase):
+	
+	def test_same_as_urljoin(self):
+		bases = [
+			"https://another.example.com/playlist/index.m3u8?token=1",
+			"https://another.example.com",
+			"https://another.example.com/playlist;params/index.m3u8"
+		]
+		uris = [
+			"fileSequence2680.ts", "fileSequence2680.ts?x=1#y", "sub/dir/segment.ts", "../segment.ts", "./segment.ts", 
+			"/segment.ts", "//cdn.example.com/segment.ts", "https://priv.example.com/segment.ts", "?x=1", "a;p/b.ts"
+		]
+		for base in bases:
+			rebaser = hlsed.Rebaser(base)
+			for uri in uris:
+				self.assertEqual(rebaser.absolute(uri), urlparse.urljoin(base, uri))
+	
+	def test_same_as_overriding_query_param(self):
+		proxy_urls = [
+			"http://example.com:11000/hlsed?something=value",
+			"http://example.com/v1/eventify?url=old&ref_time=1&z=2",
+			"http://example.com/",
+			"http://example.com/#fragment"
+		]
+		for proxy_url in proxy_urls:
+			rebaser = hlsed.Rebaser("https://another.example.com/playlist/index.m3u8", proxy_url)
+			for uri in ["mid.m3u8", "http://example.com/low.m3u8?a=b&c=d"]:
+				self.assertEqual(
+					rebaser.proxied(uri), 
+					hlsed.url_overriding_query_param(proxy_url, "url", rebaser.absolute(uri))
+				)
+
 if __name__ == '__main__':
 	unittest.main()
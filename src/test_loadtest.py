@@ -0,0 +1,60 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+import loadtest
+import unittest
+
+class PercentileTestCase(unittest.TestCase):
+
+	def test_basics(self):
+		values = range(1, 101)
+		self.assertEqual(loadtest.percentile(values, 0), 1)
+		self.assertEqual(loadtest.percentile(values, 50), 51)
+		self.assertEqual(loadtest.percentile(values, 95), 95)
+		self.assertEqual(loadtest.percentile(values, 99), 99)
+		self.assertEqual(loadtest.percentile(values, 100), 100)
+
+	def test_edge_cases(self):
+		self.assertIsNone(loadtest.percentile([], 50))
+		for p in [0, 50, 99, 100]:
+			self.assertEqual(loadtest.percentile([0.25], p), 0.25)
+		self.assertEqual(loadtest.percentile([1, 2], 50), 2)
+		self.assertEqual(loadtest.percentile([1, 2], 49), 1)
+
+class StatsTestCase(unittest.TestCase):
+
+	def test_empty(self):
+		self.assertEqual(loadtest.Stats().summary(10.0), {})
+
+	def test_summary(self):
+		stats = loadtest.Stats()
+		for i in range(100):
+			stats.record('media', (100 - i) / 1000.0, True)
+		stats.record('media', 5, False)
+		stats.record('segment', 0.5, True)
+		stats.record('master', 1, False)
+
+		summary = stats.summary(10.0)
+		self.assertEqual(sorted(summary.keys()), ['master', 'media', 'segment'])
+		self.assertEqual(summary['media'], {
+			'requests': 101,
+			'errors': 1,
+			'error_rate': 1 / 101.0,
+			'per_second': 10.1,
+			# Only the successful requests count for the latencies.
+			'p50_ms': 51,
+			'p95_ms': 95,
+			'p99_ms': 99,
+			'max_ms': 100
+		})
+		# A single sample is every percentile.
+		self.assertEqual(
+			map(lambda name: summary['segment'][name], ['requests', 'errors', 'p50_ms', 'p99_ms', 'max_ms']),
+			[1, 0, 500, 500, 500]
+		)
+		# Nothing but errors.
+		self.assertEqual(summary['master']['error_rate'], 1)
+		self.assertEqual(map(lambda name: summary['master'][name], ['p50_ms', 'max_ms']), [None, None])
+
+if __name__ == '__main__':
+	unittest.main()
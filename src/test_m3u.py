@@ -1,8 +1,10 @@
 # HLS tools.
 # Copyright (C) 2021, MediaMonks B.V. All rights reserved.
 
+import bench
 import inspect
 import m3u
+import marshal
 import unittest
 
 class TagTestCase(unittest.TestCase):
@@ -113,5 +115,176 @@ class PlaylistTestCase(unittest.TestCase):
 		self.assertEqual(len(l.globals), 1)
 		self.assertEqual(len(l.uris), 4)
 
+class SerializationTestCase(unittest.TestCase):
+
+	def test_roundtrip(self):
+		l = m3u.Playlist(inspect.cleandoc("""
+			#EXTM3U
+			#EXT-X-TARGETDURATION:10
+			#EXT-X-VERSION:3
+			#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x1234
+			#EXT-X-DATERANGE:ID="ad0",START-DATE="2021-01-01T00:00:00.000Z",PLANNED-DURATION=30
+			#EXTINF:9.009,
+			http://media.example.com/first.ts
+			#EXT-X-DISCONTINUITY
+			#EXTINF:3.003,
+			http://media.example.com/second.ts
+			#EXT-X-ENDLIST
+	   		"""
+		))
+		loaded = m3u.loads(m3u.dumps(l))
+		self.assertFalse(loaded.is_master_playlist)
+		self.assertEqual(loaded.text(), l.text())
+		self.assertEqual(map(lambda t: t.raw, loaded.all_tags()), map(lambda t: t.raw, l.all_tags()))
+		self.assertEqual(loaded.uris[1].duration(), 3.003)
+		# The key applies to both URIs and is still shared by them.
+		self.assertIs(loaded.uris[0].tag_by_name('EXT-X-KEY'), loaded.uris[1].tag_by_name('EXT-X-KEY'))
+		self.assertEqual(loaded.uris[0].tag_by_name('EXT-X-KEY').attributes['URI'].value, 'key.bin')
+
+	def test_master(self):
+		l = m3u.Playlist(inspect.cleandoc("""
+		   #EXTM3U
+		   #EXT-X-STREAM-INF:BANDWIDTH=1280000,RESOLUTION=640x360
+		   http://example.com/low.m3u8
+		   """
+		))
+		loaded = m3u.loads(m3u.dumps(l))
+		self.assertTrue(loaded.is_master_playlist)
+		self.assertEqual(loaded.uris[0].tags[0].attributes['RESOLUTION'].width, 640)
+		self.assertEqual(loaded.text(), l.text())
+
+	def test_columns(self):
+		text = bench.large_media_playlist_text(1000).replace(
+			"#EXTINF:6.000,\nmedia/segment500.ts",
+			'#EXT-X-KEY:METHOD=AES-128,URI="key.bin",KEYFORMAT=identity\n#EXTINF:6.000,\nmedia/segment500.ts'
+		)
+		l = m3u.Playlist(text)
+		data = m3u.dumps(l)
+		self.assertTrue(m3u.is_serialized(data))
+		self.assertFalse(m3u.is_serialized(text))
+		self.assertLess(len(data), len(text))
+
+		loaded = m3u.loads(data)
+		self.assertEqual(loaded.text(), l.text())
+		self.assertEqual(loaded.segment_ends(), l.segment_ends())
+		self.assertIs(loaded.uris[500].tag_by_name('EXT-X-KEY'), loaded.uris[999].tag_by_name('EXT-X-KEY'))
+		# Every tag is a separate object, the same as when parsed.
+		self.assertIsNot(loaded.uris[0].tags[0], loaded.uris[3].tags[0])
+		loaded.uris[0].tags[0].values[0] = '1.000'
+		self.assertEqual(loaded.uris[3].tags[0].values[0], '6.000')
+
+		# The known durations are dropped when the tags change.
+		loaded.uris[1].tags[0] = m3u.Tag('#EXTINF:2.5,')
+		self.assertEqual(loaded.uris[1].duration(), 2.5)
+
+	def test_versions(self):
+		l = m3u.Playlist("#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXTINF:6.000,\na.ts\n")
+		data = m3u.dumps(l)
+		self.assertRaises(m3u.ParsingError, m3u.loads, data[:4] + chr(99) + data[5:])
+
+		# The previous format can still be loaded.
+		tags = [
+			('EXTM3U', 0, None, None, None),
+			('EXT-X-TARGETDURATION', 1, ['6'], None, None),
+			('EXTINF', 2, ['6.000', ''], None, None)
+		]
+		previous = m3u.loads(marshal.dumps((1, False, tags, [0, 1], [(u'a.ts', [2])]), 2))
+		self.assertEqual(previous.text(), l.text())
+
+class TagListTestCase(unittest.TestCase):
+
+	def test_lookups(self):
+		a, b, c = m3u.Tag('#EXT-X-VERSION:3'), m3u.Tag('#EXT-X-TARGETDURATION:10'), m3u.Tag('#EXT-X-VERSION:4')
+		tags = m3u.TagList([a, b])
+		self.assertIs(tags.first('EXT-X-VERSION'), a)
+		self.assertIsNone(tags.first('EXT-X-ENDLIST'))
+		# The index should follow all kinds of modifications.
+		tags.insert(0, c)
+		self.assertIs(tags.first('EXT-X-VERSION'), c)
+		del tags[0]
+		self.assertIs(tags.first('EXT-X-VERSION'), a)
+		tags[0] = c
+		self.assertIs(tags.first('EXT-X-VERSION'), c)
+		tags[:] = [b]
+		self.assertFalse(tags.has('EXT-X-VERSION'))
+		tags += [a]
+		self.assertIs(tags.first('EXT-X-VERSION'), a)
+		tags.remove_all('EXT-X-VERSION')
+		self.assertEqual(tags, [b])
+
+	def test_derived(self):
+		playlist = m3u.Playlist(SnapshotTestCase.text)
+		self.assertEqual(playlist.target_duration(), 10)
+		self.assertEqual(playlist.playlist_type(), 'VOD')
+		playlist.remove_global_tag('EXT-X-TARGETDURATION')
+		self.assertEqual(playlist.target_duration(), 0)
+		playlist.globals.append(m3u.Tag('#EXT-X-TARGETDURATION:6'))
+		self.assertEqual(playlist.target_duration(), 6)
+		# Plain lists can be assigned as well.
+		playlist.globals = filter(lambda t: t.name != 'EXT-X-PLAYLIST-TYPE', playlist.globals)
+		self.assertEqual(playlist.playlist_type(), '')
+		self.assertEqual(playlist.target_duration(), 6)
+		
+		u = playlist.uris[0]
+		self.assertEqual(u.duration(), 9.009)
+		u.remove_tag('EXTINF')
+		self.assertEqual(u.duration(), 0)
+		u.tags = [m3u.Tag('#EXTINF:4,')]
+		self.assertEqual(u.duration(), 4)
+
+	def test_iterators(self):
+		playlist = m3u.Playlist(SnapshotTestCase.text)
+		self.assertFalse(isinstance(playlist.iter_tags(), list))
+		self.assertEqual(list(playlist.iter_tags()), playlist.all_tags())
+		self.assertEqual(list(playlist.iter_items()), playlist.items())
+
+class SnapshotTestCase(unittest.TestCase):
+
+	text = inspect.cleandoc("""
+		#EXTM3U
+		#EXT-X-TARGETDURATION:10
+		#EXT-X-PLAYLIST-TYPE:VOD
+		#EXT-X-MAP:URI="init.mp4"
+		#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x1234
+		#EXTINF:9.009,
+		first.ts
+		#EXT-X-DISCONTINUITY
+		#EXTINF:3.003,
+		second.ts
+		#EXTINF:5,
+		third.ts
+		#EXT-X-ENDLIST
+		"""
+	)
+
+	def modify(self, playlist):
+		playlist.remove_global_tag('EXT-X-PLAYLIST-TYPE')
+		playlist.remove_global_tag('EXT-X-ENDLIST')
+		playlist.add_global_tag(m3u.Tag('#EXT-X-PLAYLIST-TYPE:EVENT'))
+		playlist.map_uris(lambda uri: 'http://example.com/' + uri)
+		playlist.map_tag_uris(lambda tag, uri: '%s/%s' % (tag.name, uri))
+		playlist.set_window(2)
+
+	def test_same_as_playlist(self):
+		playlist = m3u.Playlist(self.text)
+		self.modify(playlist)
+		view = m3u.Snapshot(m3u.Playlist(self.text)).view()
+		self.modify(view)
+		self.assertEqual(view.text(), playlist.text())
+		self.assertEqual(view.segment_ends(), tuple(playlist.segment_ends()))
+
+	def test_views_are_independent(self):
+		snapshot = m3u.Snapshot(m3u.Playlist(self.text))
+		original = snapshot.text()
+		self.assertEqual(original, m3u.Playlist(self.text).text())
+		a = snapshot.view()
+		self.modify(a)
+		b = snapshot.view()
+		b.set_window(1)
+		self.assertNotEqual(a.text(), b.text())
+		self.assertEqual(snapshot.text(), original)
+		self.assertEqual(snapshot.segment_ends(), (9.009, 9.009 + 3.003, 9.009 + 3.003 + 5))
+		self.assertEqual(snapshot.target_duration(), 10)
+
 if __name__ == '__main__':
 	unittest.main()
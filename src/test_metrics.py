@@ -0,0 +1,80 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+import metrics
+import shutil
+import tempfile
+import unittest
+
+class ExpositionTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.counter = metrics.Counter('test_events_total', 'Test events.', ('kind',))
+		self.histogram = metrics.Histogram('test_duration_seconds', 'Test durations.', buckets = (0.1, 1))
+
+	def tearDown(self):
+		metrics._registry.remove(self.counter)
+		metrics._registry.remove(self.histogram)
+
+	def test_counter(self):
+		self.counter.inc(('a',))
+		self.counter.inc(('a',), 2)
+		self.counter.inc(('b"',))
+		text = metrics.exposition()
+		self.assertIn('# TYPE test_events_total counter\n', text)
+		self.assertIn('test_events_total{kind="a"} 3\n', text)
+		self.assertIn('test_events_total{kind="b\\""} 1\n', text)
+
+	def test_histogram(self):
+		self.histogram.observe(0.05)
+		self.histogram.observe(0.5)
+		self.histogram.observe(5)
+		text = metrics.exposition()
+		self.assertIn('test_duration_seconds_bucket{le="0.1"} 1\n', text)
+		self.assertIn('test_duration_seconds_bucket{le="1"} 2\n', text)
+		self.assertIn('test_duration_seconds_bucket{le="+Inf"} 3\n', text)
+		self.assertIn('test_duration_seconds_sum 5.55\n', text)
+		self.assertIn('test_duration_seconds_count 3\n', text)
+
+class StageTimerTestCase(unittest.TestCase):
+
+	def test_server_timing(self):
+		timer = metrics.StageTimer()
+		timer.lap('fetch', 'hit')
+		timer.lap('parse')
+		self.assertRegexpMatches(
+			timer.server_timing(total = 0.5),
+			r'^fetch;desc="hit";dur=[0-9]+\.[0-9]{3}, parse;dur=[0-9]+\.[0-9]{3}, total;dur=500\.000$'
+		)
+
+	def test_monotonic(self):
+		t = metrics.clock()
+		self.assertLessEqual(t, metrics.clock())
+
+class MultiProcessTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.saved_dir = metrics.METRICS_DIR
+		metrics.METRICS_DIR = self.dir
+		self.counter = metrics.Counter('test_events_total', 'Test events.')
+
+	def tearDown(self):
+		metrics._registry.remove(self.counter)
+		metrics.METRICS_DIR = self.saved_dir
+		shutil.rmtree(self.dir)
+
+	def test_merge(self):
+		self.counter.inc(amount = 2)
+		# Pretending that another process has saved its snapshot already.
+		saved_id = metrics._process_id
+		metrics.maybe_flush(force = True)
+		metrics._process_id = saved_id + '-other'
+		try:
+			self.counter.inc()
+			self.assertIn('test_events_total 5\n', metrics.exposition())
+		finally:
+			metrics._process_id = saved_id
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+from flask import Flask
+import aliases
+import origin
+import os
+import serve
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import urllib2
+
+class OriginTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		os.makedirs(os.path.join(self.dir, 'test', 'media'))
+		with open(os.path.join(self.dir, 'test', 'index.m3u8'), 'w') as f:
+			f.write("#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXTINF:6,\nmedia/0.ts\n#EXT-X-ENDLIST\n")
+		self.segment = ''.join(map(chr, range(256))) * 1000
+		with open(os.path.join(self.dir, 'test', 'media', '0.ts'), 'wb') as f:
+			f.write(self.segment)
+		with open(os.path.join(self.dir, 'secret'), 'w') as f:
+			f.write('secret')
+
+		self.saved_mirrors_dir = aliases.MIRRORS_DIR
+		aliases.MIRRORS_DIR = self.dir
+
+		self.app = Flask(__name__)
+		self.app.register_blueprint(origin.blueprint, url_prefix = '/origin')
+		self.client = self.app.test_client()
+
+	def tearDown(self):
+		aliases.MIRRORS_DIR = self.saved_mirrors_dir
+		shutil.rmtree(self.dir)
+
+	def test_content_types(self):
+		r = self.client.get('/origin/test/index.m3u8')
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.mimetype, 'application/vnd.apple.mpegurl')
+		self.assertTrue(r.data.startswith('#EXTM3U'))
+		r = self.client.get('/origin/test/media/0.ts')
+		self.assertEqual(r.mimetype, 'video/mp2t')
+		self.assertEqual(r.data, self.segment)
+		self.assertEqual(r.headers['Content-Length'], str(len(self.segment)))
+
+	def test_ranges(self):
+		r = self.client.get('/origin/test/media/0.ts', headers = { 'Range': 'bytes=100-299' })
+		self.assertEqual(r.status_code, 206)
+		self.assertEqual(r.data, self.segment[100:300])
+		self.assertEqual(r.headers['Content-Range'], 'bytes 100-299/%d' % (len(self.segment),))
+		r = self.client.get('/origin/test/media/0.ts', headers = { 'Range': 'bytes=-10' })
+		self.assertEqual(r.data, self.segment[-10:])
+		r = self.client.get('/origin/test/media/0.ts', headers = { 'Range': 'bytes=%d-' % (len(self.segment),) })
+		self.assertEqual(r.status_code, 416)
+
+	def test_not_found(self):
+		self.assertEqual(self.client.get('/origin/test/missing.ts').status_code, 404)
+		self.assertEqual(self.client.get('/origin/test/media').status_code, 404)
+		self.assertEqual(self.client.get('/origin/test/../secret').status_code, 404)
+		self.assertEqual(self.client.get('/origin/test/%2e%2e/secret').status_code, 404)
+
+	def test_aliases(self):
+		self.assertEqual(aliases.mirrors(), ['test'])
+		self.assertEqual(aliases.resolve_hls('test', 'http://localhost/origin/'), 'http://localhost/origin/test/index.m3u8')
+		# Only when we know where the mirrors are served.
+		self.assertEqual(aliases.resolve_hls('test'), 'test')
+		self.assertEqual(aliases.resolve_hls('elephant', 'http://localhost/origin/'), aliases.HLS['elephant'])
+
+	def test_sendfile(self):
+		server = serve.PooledWSGIServer('127.0.0.1', 0, self.app, 2, handler = origin.SendfileRequestHandler)
+		t = threading.Thread(target = server.serve_forever)
+		t.daemon = True
+		t.start()
+		try:
+			url = 'http://127.0.0.1:%d/origin/test/media/0.ts' % (server.server_port,)
+			self.assertEqual(urllib2.urlopen(url).read(), self.segment)
+			r = urllib2.urlopen(urllib2.Request(url, headers = { 'Range': 'bytes=1000-' }))
+			self.assertEqual(r.getcode(), 206)
+			self.assertEqual(r.read(), self.segment[1000:])
+		finally:
+			server.shutdown()
+			server.server_close()
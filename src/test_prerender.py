@@ -0,0 +1,97 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+from flask import Flask
+import aliases
+import bench
+import gzip
+import m3u
+import origin
+import os
+import prerender
+import re
+import serve
+import sessions
+import shutil
+import tempfile
+import threading
+import unittest
+import upstream
+
+class Params:
+	url = None
+	start_time = 1612345678
+	event_duration = 300
+	ad_interval = 60
+	ad_duration = 15
+	ad_style = 0
+	proxy_segments = False
+	pdt_interval = 5
+
+class PrerenderTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		os.makedirs(os.path.join(self.dir, 'mirrors', 'test', 'low'))
+		with open(os.path.join(self.dir, 'mirrors', 'test', 'index.m3u8'), 'w') as f:
+			f.write("#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1000000\nlow/variant.m3u8\n")
+		with open(os.path.join(self.dir, 'mirrors', 'test', 'low', 'variant.m3u8'), 'w') as f:
+			f.write(bench.large_media_playlist_text(100))
+
+		self.saved_mirrors_dir = aliases.MIRRORS_DIR
+		aliases.MIRRORS_DIR = os.path.join(self.dir, 'mirrors')
+		origin_app = Flask(__name__)
+		origin_app.register_blueprint(origin.blueprint)
+		self.origin = serve.PooledWSGIServer('127.0.0.1', 0, origin_app, 4)
+		t = threading.Thread(target = self.origin.serve_forever)
+		t.daemon = True
+		t.start()
+		self.base_url = 'http://127.0.0.1:%d/test/' % (self.origin.server_port,)
+
+	def tearDown(self):
+		self.origin.shutdown()
+		self.origin.server_close()
+		aliases.MIRRORS_DIR = self.saved_mirrors_dir
+		shutil.rmtree(self.dir)
+
+	def read(self, output, path):
+		with gzip.open(os.path.join(output, path + '.gz')) as f:
+			return f.read()
+
+	def test_prerender(self):
+		output = os.path.join(self.dir, 'static')
+		params = Params()
+		index = prerender.prerender(self.base_url + 'index.m3u8', params, output)
+		self.assertEqual(index['variants'], ['v0'])
+		self.assertEqual(len(index['times']), index['states'] - 1)
+
+		master = m3u.Playlist(self.read(output, index['master']).decode('utf_8'))
+		self.assertEqual(map(lambda u: u.uri, master.uris), ['v0.m3u8'])
+
+		# Every state is exactly what the session would render at any time (till the next ad after the end).
+		variant_url = self.base_url + 'low/variant.m3u8'
+		playlist, hit = upstream.get_playlist(variant_url)
+		timeline = sessions.Timeline(prerender.hlsed.rebase(playlist, variant_url, None), None)
+		session = sessions.Session('x', {}, params)
+		for t in range(params.start_time - 100, params.start_time + 320, 3) + index['times']:
+			self.assertEqual(self.read(output, prerender.lookup(index, 'v0', t)), session.render(timeline, t), t)
+		self.assertIn('#EXT-X-ENDLIST', self.read(output, prerender.lookup(index, 'v0', params.start_time + 1000)))
+
+		# Rendering again replaces everything.
+		params.ad_interval = 0
+		index = prerender.prerender(self.base_url + 'index.m3u8', params, output)
+		self.assertEqual(sorted(os.listdir(output)), ['index.json', 'index.m3u8.gz', 'nginx.conf', 'v0'])
+		self.assertEqual(len(os.listdir(os.path.join(output, 'v0'))), index['states'])
+
+		with open(os.path.join(output, 'nginx.conf')) as f:
+			config = f.read()
+		last = int(index['times'][-1])
+		self.assertIn("\t%d %05d;" % (params.start_time, prerender.state_at(index['times'], params.start_time)), config)
+		regex = re.search(r'"~(.*)" %05d;' % (index['states'] - 1,), config).group(1)
+		self.assertFalse(re.match(regex, str(last)))
+		self.assertTrue(re.match(regex, str(last + 1)))
+		self.assertTrue(re.match(regex, str(last + 1000)))
+		self.assertTrue(re.match(regex, str(last * 10)))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,36 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+import marshal
+import profiling
+import time
+import unittest
+
+def busy(seconds):
+	started = time.time()
+	while time.time() - started < seconds:
+		pass
+	return 'done'
+
+class ProfileCallTestCase(unittest.TestCase):
+
+	def test_sampling(self):
+		result, data, extension = profiling.profile_call(profiling.SAMPLING, busy, 0.05)
+		self.assertEqual(result, 'done')
+		self.assertEqual(extension, '.folded')
+		lines = data.splitlines()
+		self.assertGreater(len(lines), 0)
+		for line in lines:
+			stack, count = line.rsplit(' ', 1)
+			self.assertGreater(int(count), 0)
+		self.assertTrue(any(map(lambda line: 'busy (test_profiling.py:' in line, lines)))
+
+	def test_deterministic(self):
+		result, data, extension = profiling.profile_call(profiling.DETERMINISTIC, busy, 0.01)
+		self.assertEqual(result, 'done')
+		self.assertEqual(extension, '.pstats')
+		stats = marshal.loads(data)
+		self.assertTrue(any(map(lambda key: key[2] == 'busy', stats.keys())))
+
+if __name__ == '__main__':
+	unittest.main()
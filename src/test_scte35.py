@@ -1,6 +1,8 @@
 # HLS tools.
 # Copyright (C) 2021, MediaMonks B.V. All rights reserved.
 
+import base64
+import random
 import scte35
 import inspect
 import unittest
@@ -23,5 +25,75 @@ class SCTE35TestCase(unittest.TestCase):
 			scte35.splice_info_with_splice_insert(1234, True, 1000, 30, auto_return = True)
 		)
 
+class BatchTestCase(unittest.TestCase):
+
+	def cues(self, count):
+		r = random.Random(1234)
+		result = []
+		for i in range(count):
+			cue = (r.randint(0, 0xFFFFFFFF), r.random() < 0.5, r.random() * 86400)
+			kind = i % 3
+			if kind == 1:
+				cue += (r.random() * 120, r.random() < 0.5)
+			elif kind == 2:
+				cue += (None, False, r.randint(0, 0xFFFF), r.randint(0, 255), r.randint(0, 255), r.random() * 100)
+			result.append(cue)
+		return result
+
+	def test_same_as_single(self):
+		cues = self.cues(300)
+		self.assertEqual(
+			scte35.splice_infos_with_splice_insert(cues),
+			map(lambda c: scte35.splice_info_with_splice_insert(*c), cues)
+		)
+		self.assertEqual(scte35.splice_infos_with_splice_insert([]), [])
+
+class DecodingTestCase(unittest.TestCase):
+
+	# The examples from SCTE 35 2019, section 14.
+	time_signal = base64.b64decode("/DA0AAAAAAAA///wBQb+cr0AUAAeAhxDVUVJSAAAjn/PAAGlmbAICAAAAAAsoKGKNAIAmsnRfg==")
+	splice_insert = base64.b64decode("/DAvAAAAAAAA///wFAVIAACPf+/+c2nALv4AUsz1AAAAAAAKAAhDVUVJAAABNWLbowo=")
+
+	def test_crc(self):
+		self.assertEqual(scte35.mpeg2_crc32("123456789"), 0x0376E6E7)
+		broken = self.splice_insert[:-1] + chr(ord(self.splice_insert[-1]) ^ 1)
+		self.assertRaises(scte35.DecodingError, scte35.decode, broken)
+		self.assertEqual(scte35.decode(broken, check_crc = False).command.splice_event_id, 0x4800008F)
+
+	def test_time_signal(self):
+		info = scte35.decode(self.time_signal)
+		self.assertEqual(info.command_type, scte35.TIME_SIGNAL)
+		self.assertEqual(info.splice_time(), 0x072BD0050)
+		self.assertEqual(len(info.descriptors), 1)
+		d = info.descriptors[0]
+		self.assertTrue(isinstance(d, scte35.SegmentationDescriptor))
+		self.assertEqual(d.segmentation_event_id, 0x4800008E)
+		self.assertEqual(d.segmentation_duration, 0x0001A599B0)
+		self.assertEqual((d.upid_type, d.upid), (0x08, "\x00\x00\x00\x00\x2C\xA0\xA1\x8A"))
+		self.assertEqual((d.type_id, d.segment_num, d.segments_expected), (0x34, 2, 0))
+
+	def test_splice_insert(self):
+		info = scte35.decode(self.splice_insert)
+		c = info.command
+		self.assertEqual(c.splice_event_id, 0x4800008F)
+		self.assertTrue(c.out_of_network_indicator)
+		self.assertEqual(c.pts_time, 0x07369C02E)
+		self.assertEqual((c.auto_return, c.break_duration), (True, 0x00052CCF5))
+		self.assertEqual(info.descriptors[0].identifier, 0x43554549)
+
+	def test_encoded(self):
+		# The encoder is using a different CRC.
+		info = scte35.decode(scte35.splice_info_with_splice_insert(1234, True, 1000, 30, auto_return = True), False)
+		self.assertEqual(info.command.splice_event_id, 1234)
+		self.assertEqual(scte35.pts_seconds(info.splice_time()), 1000)
+		self.assertEqual(scte35.pts_seconds(info.command.break_duration), 30)
+
+	def test_pts_adjustment(self):
+		section = scte35.with_pts_adjustment(self.splice_insert, -90000)
+		info = scte35.decode(section)
+		self.assertEqual(info.pts_adjustment, scte35.PTS_MODULO - 90000)
+		self.assertEqual(info.command.pts_time, 0x07369C02E)
+		self.assertEqual(section[9:-4], self.splice_insert[9:-4])
+
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,57 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+from flask import Flask
+import requests
+import serve
+import test_upstream
+import threading
+import time
+import unittest
+
+class PooledWSGIServerTestCase(unittest.TestCase):
+
+	def start(self, **kwargs):
+		slow_app = Flask(__name__)
+		@slow_app.route('/slow')
+		def slow():
+			time.sleep(0.5)
+			return "OK"
+		server = serve.PooledWSGIServer('127.0.0.1', 0, slow_app, 1, handler = test_upstream.QuietHandler, **kwargs)
+		t = threading.Thread(target = server.serve_forever)
+		t.daemon = True
+		t.start()
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+		return 'http://127.0.0.1:%d/slow' % (server.server_port,)
+
+	def get_concurrently(self, url, count):
+		results = [None] * count
+		def get(i):
+			started = time.time()
+			r = requests.get(url)
+			results[i] = (r.status_code, r.headers.get('Retry-After'), time.time() - started)
+		threads = []
+		for i in range(count):
+			threads.append(threading.Thread(target = get, args = (i,)))
+			threads[-1].start()
+			time.sleep(0.05)
+		for t in threads:
+			t.join()
+		return results
+
+	def test_shedding(self):
+		url = self.start(max_queued = 1, queue_timeout = 0.2, retry_after = 3)
+		# The first one is handled, the second one waits for too long and the third one does not fit the queue.
+		first, second, third = self.get_concurrently(url, 3)
+		self.assertEqual(first[0], 200)
+		self.assertEqual(second[:2], (503, '3'))
+		self.assertEqual(third[:2], (503, '3'))
+		self.assertLess(third[2], 0.2)
+
+	def test_waiting(self):
+		url = self.start(max_queued = 1)
+		self.assertEqual(map(lambda r: r[0], self.get_concurrently(url, 3)), [200] * 3)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,109 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+import bench
+import cache
+import hlsed
+import m3u
+import sessions
+import shutil
+import tempfile
+import unittest
+
+class Params:
+	def __init__(self, args):
+		self.url = args['url']
+		self.start_time = int(args.get('ref_time', 1612345678))
+		self.event_duration = int(args.get('duration', 60))
+		self.ad_interval = int(args.get('ad_interval', 0))
+		self.ad_duration = int(args.get('ad_duration', 30))
+		self.ad_style = int(args.get('ad_style', hlsed.CUE_STYLE_IN_OUT))
+		self.proxy_segments = False
+		self.pdt_interval = int(args.get('pdt_interval', 0))
+
+class SessionTestCase(unittest.TestCase):
+
+	playlist_url = "https://origin.example.com/event/variant.m3u8"
+
+	def expected(self, params, current_time):
+		playlist = m3u.Playlist(self.text)
+		hlsed.rebase(playlist, self.playlist_url, "https://hlsed.example.com/v1/eventify?session=x")
+		hlsed.Pipeline([hlsed.UpstreamCuesStage(params.event_duration, params.start_time, current_time)]).apply(playlist)
+		hlsed.event_to_vod(
+			playlist,
+			event_duration = params.event_duration,
+			ref_time = params.start_time,
+			current_time = current_time,
+			program_date_time = True,
+			program_date_time_interval = params.pdt_interval
+		)
+		if params.ad_interval > 0 and params.ad_duration > 0:
+			hlsed.insert_ad_cues(
+				playlist,
+				event_duration = params.event_duration,
+				ref_time = params.start_time,
+				current_time = current_time,
+				time_between_ads = params.ad_interval,
+				ad_duration = params.ad_duration,
+				style = params.ad_style
+			)
+		return playlist.text()
+
+	def check(self, args):
+		params = Params(args)
+		session = sessions.Session('x', args, params)
+		playlist = m3u.Playlist(self.text)
+		hlsed.rebase(playlist, self.playlist_url, "https://hlsed.example.com/v1/eventify?session=x")
+		timeline = sessions.Timeline(playlist, 'digest')
+		# Going back in time as well, the ad schedule should handle this.
+		for delta in [0, 1, 17, 18, 19, 60, 300, 1000, 123, 3599, 3600, 3700]:
+			current_time = params.start_time + delta
+			self.assertEqual(session.render(timeline, current_time), self.expected(params, current_time), delta)
+
+	def test_same_as_eventify(self):
+		self.text = bench.large_media_playlist_text(1000)
+		self.check({ 'url': self.playlist_url, 'duration': 3600 })
+		self.check({ 'url': self.playlist_url, 'duration': 300, 'ad_interval': 60, 'ad_duration': 15 })
+		self.check({ 'url': self.playlist_url, 'duration': 300, 'ad_interval': 30, 'ad_duration': 10, 'ad_style': 1 })
+		self.check({ 'url': self.playlist_url, 'duration': 300, 'pdt_interval': 1 })
+		self.check({ 'url': self.playlist_url, 'duration': 300, 'pdt_interval': 7 })
+
+	def test_with_upstream_cues(self):
+		self.text = bench.large_media_playlist_text(100).replace(
+			"#EXTINF", 
+			'#EXT-X-DATERANGE:ID="a",START-DATE="2021-01-01T00:00:30Z",DURATION=10\n'
+			'#EXT-X-DATERANGE:ID="b",START-DATE="2021-01-01T00:01:00Z",END-DATE="2021-01-01T00:01:30Z"\n'
+			'#EXT-X-PROGRAM-DATE-TIME:2021-01-01T00:00:00Z\n'
+			'#EXTINF',
+			1
+		)
+		self.check({ 'url': self.playlist_url, 'duration': 300, 'ad_interval': 60, 'ad_duration': 15 })
+
+	def test_with_original_type(self):
+		self.text = bench.large_media_playlist_text(10).replace("#EXTM3U", "#EXTM3U\n#EXT-X-PLAYLIST-TYPE:VOD")
+		self.check({ 'url': self.playlist_url, 'duration': 30 })
+
+class RegistryTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_ids(self):
+		args = { 'url': 'apple1', 'ref_time': u'1612345678' }
+		self.assertEqual(sessions.session_id(args), sessions.session_id(dict(args)))
+		self.assertNotEqual(sessions.session_id(args), sessions.session_id(dict(args, duration = '60')))
+		self.assertEqual(len(sessions.session_id(args)), 16)
+
+	def test_restore(self):
+		registry = sessions.Registry(Params, cache.DiskCache(self.dir))
+		session = registry.create({ 'url': 'apple1', 'duration': '120' })
+		self.assertIs(registry.get(session.id), session)
+		self.assertIs(registry.create({ 'url': 'apple1', 'duration': '120' }), session)
+		self.assertIsNone(registry.get('unknown'))
+		# Another process sharing the same disk cache.
+		restored = sessions.Registry(Params, cache.DiskCache(self.dir)).get(session.id)
+		self.assertEqual(restored.args, session.args)
+		self.assertEqual(restored.params.event_duration, 120)
@@ -0,0 +1,277 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+from flask import Flask, Response, request
+from werkzeug.serving import WSGIRequestHandler
+import bench
+import collections
+import metrics
+import requests
+import serve
+import threading
+import time
+import unittest
+import upstream
+
+class QuietHandler(WSGIRequestHandler):
+	def log_request(self, *args, **kwargs):
+		pass
+
+def flaky_origin():
+
+	"""A stand-in origin that can be slow or fail on purpose, counting the requests for every path."""
+
+	origin = Flask(__name__)
+	origin.hits = collections.Counter()
+	origin.down = False
+	lock = threading.Lock()
+	text = bench.large_media_playlist_text(10)
+
+	def hit():
+		with lock:
+			origin.hits[request.path] += 1
+			return origin.hits[request.path]
+
+	@origin.route('/flaky/<name>')
+	def flaky(name):
+		# Fails the given number of times first.
+		if hit() <= int(request.args.get('failures', 1)):
+			return ("Unavailable", 503)
+		return (text, 200, { 'Content-Type': 'application/vnd.apple.mpegurl' })
+
+	@origin.route('/slow/<name>')
+	def slow(name):
+		# Only the given number of first requests is slow.
+		if hit() <= int(request.args.get('slow', 1)):
+			time.sleep(float(request.args.get('delay', 1)))
+		return (text, 200, { 'Content-Type': 'application/vnd.apple.mpegurl' })
+
+	@origin.route('/versioned/<name>')
+	def versioned(name):
+		# Every request gets a new version of the playlist, slowly, unless the origin is "down".
+		n = hit()
+		if origin.down:
+			return ("Unavailable", 503)
+		time.sleep(float(request.args.get('delay', 0)))
+		versioned_text = text.replace('MEDIA-SEQUENCE:0', 'MEDIA-SEQUENCE:%d' % (n,))
+		return (versioned_text, 200, { 'Content-Type': 'application/vnd.apple.mpegurl' })
+
+	@origin.route('/segment/<name>')
+	def segment(name):
+		# The body comes in chunks, slowly.
+		hit()
+		delay = float(request.args.get('delay', 0))
+		def chunks():
+			for i in range(3):
+				time.sleep(delay)
+				yield 'x' * 1000
+		return Response(chunks(), mimetype = 'video/mp2t')
+
+	@origin.route('/missing')
+	def missing():
+		hit()
+		return ("Not found", 404)
+
+	return origin
+
+class UpstreamTestCase(unittest.TestCase):
+
+	settings = [
+		'READ_TIMEOUT', 'RETRIES', 'RETRY_BACKOFF', 'HEDGE_PERCENTILE', 'HEDGE_MIN_DELAY', 'latencies',
+		'PLAYLIST_TTL', 'PLAYLIST_STALE_TTL', 'PLAYLIST_STALE_IF_ERROR_TTL', 'PLAYLIST_ERROR_TTL', 'limits'
+	]
+
+	def setUp(self):
+		self.saved = dict(map(lambda name: (name, getattr(upstream, name)), self.settings))
+		upstream.RETRY_BACKOFF = 0.01
+		upstream.latencies = upstream.Latencies()
+		self.origin = flaky_origin()
+		self.server = serve.PooledWSGIServer('127.0.0.1', 0, self.origin, 8, handler = QuietHandler)
+		t = threading.Thread(target = self.server.serve_forever)
+		t.daemon = True
+		t.start()
+		self.base_url = 'http://127.0.0.1:%d' % (self.server.server_port,)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		for name, value in self.saved.items():
+			setattr(upstream, name, value)
+
+	def counter(self, metric, host):
+		return metric._values.get((host,), 0)
+
+	def test_retries(self):
+		host = upstream.host_of(self.base_url)
+		retries = self.counter(metrics.UPSTREAM_RETRIES, host)
+
+		upstream.RETRIES = 2
+		self.assertIn('#EXTM3U', upstream.fetch_playlist(self.base_url + '/flaky/a?failures=2'))
+		self.assertEqual(self.origin.hits['/flaky/a'], 3)
+		self.assertEqual(self.counter(metrics.UPSTREAM_RETRIES, host), retries + 2)
+
+		self.assertRaises(requests.HTTPError, upstream.fetch_playlist, self.base_url + '/flaky/b?failures=3')
+		self.assertEqual(self.origin.hits['/flaky/b'], 3)
+
+		# Client errors are not retried.
+		self.assertRaises(requests.HTTPError, upstream.fetch, self.base_url + '/missing')
+		self.assertEqual(self.origin.hits['/missing'], 1)
+
+		upstream.RETRIES = 0
+		self.assertRaises(requests.HTTPError, upstream.fetch_playlist, self.base_url + '/flaky/c')
+
+	def test_timeouts(self):
+		upstream.READ_TIMEOUT = 0.2
+		upstream.RETRIES = 1
+		started = time.time()
+		self.assertIn('#EXTM3U', upstream.fetch_playlist(self.base_url + '/slow/a?delay=2'))
+		self.assertLess(time.time() - started, 1)
+		self.assertEqual(self.origin.hits['/slow/a'], 2)
+
+		self.assertRaises(requests.Timeout, upstream.fetch_playlist, self.base_url + '/slow/b?delay=2&slow=2')
+
+	def test_hedging(self):
+		host = upstream.host_of(self.base_url)
+		hedges = self.counter(metrics.UPSTREAM_HEDGES, host)
+		upstream.HEDGE_PERCENTILE = 95
+		upstream.HEDGE_MIN_DELAY = 0.05
+
+		# Not before there are enough latencies to go by.
+		self.assertIsNone(upstream.latencies.percentile(host, 95, upstream.HEDGE_MIN_SAMPLES))
+		for i in range(upstream.HEDGE_MIN_SAMPLES):
+			upstream.fetch_playlist(self.base_url + '/slow/warm%d?delay=0' % (i,))
+		self.assertLess(upstream.latencies.percentile(host, 95, upstream.HEDGE_MIN_SAMPLES), 0.05)
+
+		# The first request is stuck, the second one is not.
+		started = time.time()
+		self.assertIn('#EXTM3U', upstream.fetch_playlist(self.base_url + '/slow/a?delay=1'))
+		self.assertLess(time.time() - started, 0.5)
+		self.assertEqual(self.origin.hits['/slow/a'], 2)
+		self.assertEqual(self.counter(metrics.UPSTREAM_HEDGES, host), hedges + 1)
+
+		# Segments are not hedged.
+		started = time.time()
+		upstream.fetch(self.base_url + '/slow/b?delay=0.3')
+		self.assertGreaterEqual(time.time() - started, 0.3)
+		self.assertEqual(self.origin.hits['/slow/b'], 1)
+
+	def test_stale_while_revalidate(self):
+		upstream.RETRIES = 0
+		upstream.PLAYLIST_TTL = 0.2
+		upstream.PLAYLIST_STALE_TTL = 1
+		upstream.PLAYLIST_STALE_IF_ERROR_TTL = 2
+		url = self.base_url + '/versioned/a?delay=0.3'
+
+		snapshot, hit = upstream.get_snapshot(url)
+		self.assertIn('MEDIA-SEQUENCE:1\n', snapshot.text())
+		time.sleep(0.25)
+
+		# The expired version is served right away, the new one is fetched and parsed in the background.
+		started = time.time()
+		for i in range(3):
+			stale, hit = upstream.get_snapshot(url)
+			self.assertIs(stale, snapshot)
+			self.assertTrue(hit)
+		self.assertLess(time.time() - started, 0.2)
+		time.sleep(0.5)
+		self.assertEqual(self.origin.hits['/versioned/a'], 2)
+		fresh, hit = upstream.get_snapshot(url)
+		self.assertIn('MEDIA-SEQUENCE:2\n', fresh.text())
+
+		# When the origin is down, the last version is served till it's too old.
+		self.origin.down = True
+		time.sleep(1.3)
+		self.assertIs(upstream.get_snapshot(url)[0], fresh)
+		time.sleep(1)
+		self.assertRaises(requests.HTTPError, upstream.get_snapshot, url)
+
+	def test_limits(self):
+		limits = upstream.HostLimits(2, 1, 0.2)
+		limits.acquire('a')
+		limits.acquire('a')
+		limits.acquire('b')
+		self.assertEqual(limits.busy('a'), (2, 0))
+
+		# The next one waits for its turn, the one after that does not fit the queue.
+		acquired = []
+		def acquire():
+			limits.acquire('a')
+			acquired.append(time.time())
+		t = threading.Thread(target = acquire)
+		t.start()
+		time.sleep(0.05)
+		self.assertEqual(limits.busy('a'), (2, 1))
+		self.assertRaises(upstream.Overloaded, limits.acquire, 'a')
+		limits.release('a')
+		t.join()
+		self.assertEqual(len(acquired), 1)
+		self.assertEqual(limits.busy('a'), (2, 0))
+
+		# Waiting for too long.
+		started = time.time()
+		self.assertRaises(upstream.Overloaded, limits.acquire, 'a')
+		self.assertGreaterEqual(time.time() - started, 0.2)
+		self.assertEqual(limits.busy('a'), (2, 0))
+
+		for host in ['a', 'a', 'b']:
+			limits.release(host)
+		self.assertEqual((limits._active, limits._queues), ({}, {}))
+
+	def test_concurrency(self):
+		upstream.limits = upstream.HostLimits(2, 10, 2)
+		started = time.time()
+		threads = [
+			threading.Thread(target = upstream.fetch, args = (self.base_url + '/slow/%d?delay=0.2' % (i,),))
+			for i in range(4)
+		]
+		for t in threads:
+			t.start()
+		time.sleep(0.1)
+		self.assertEqual(upstream.limits.busy(upstream.host_of(self.base_url)), (2, 2))
+		for t in threads:
+			t.join()
+		# Two at a time.
+		self.assertGreaterEqual(time.time() - started, 0.4)
+
+		# A slow origin does not hold up the requests to the others.
+		upstream.limits = upstream.HostLimits(1, 0, 1)
+		slow = threading.Thread(target = upstream.fetch, args = (self.base_url + '/slow/a?delay=0.3',))
+		slow.start()
+		time.sleep(0.1)
+		self.assertRaises(upstream.Overloaded, upstream.fetch, self.base_url + '/slow/b?delay=0')
+		other_url = self.base_url.replace('127.0.0.1', 'localhost') + '/slow/b?delay=0'
+		self.assertEqual(upstream.fetch(other_url).status_code, 200)
+		slow.join()
+
+	def test_segment_limits(self):
+		upstream.limits = upstream.HostLimits(2, 10, 2)
+		host = upstream.host_of(self.base_url)
+		results = []
+		t = threading.Thread(
+			target = lambda: results.append(upstream.get_segment(self.base_url + '/segment/a?delay=0.1'))
+		)
+		t.start()
+		# The headers are there, but not the whole body yet.
+		time.sleep(0.15)
+		self.assertEqual(upstream.limits.busy(host), (1, 0))
+		t.join()
+		(content_type, body, size), hit = results[0]
+		self.assertEqual(size, 3000)
+		self.assertEqual(upstream.limits.busy(host), (0, 0))
+
+		# Responses that are not successful are done right away.
+		self.assertRaises(requests.HTTPError, upstream.fetch, self.base_url + '/missing', stream = True)
+		self.assertEqual(upstream.limits.busy(host), (0, 0))
+
+	def test_latencies(self):
+		latencies = upstream.Latencies(size = 100)
+		for i in range(200):
+			latencies.add('a', i)
+		self.assertEqual(latencies.percentile('a', 50), 149)
+		self.assertEqual(latencies.percentile('a', 100), 199)
+		self.assertEqual(latencies.percentile('a', 0), 100)
+		self.assertIsNone(latencies.percentile('b', 50))
+		self.assertIsNone(latencies.percentile('a', 50, min_samples = 101))
+
+if __name__ == '__main__':
+	unittest.main()
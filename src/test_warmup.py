@@ -0,0 +1,114 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+from flask import Flask, request
+import aliases
+import bench
+import collections
+import serve
+import test_upstream
+import threading
+import time
+import unittest
+import upstream
+import warmup
+
+MASTER = """#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="English",URI="audio.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=1000000,AUDIO="audio"
+low.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2000000,AUDIO="audio"
+high.m3u8
+"""
+
+def origin_with_variants():
+
+	"""A stand-in origin with a master playlist, a live variant and VOD ones, counting the requests for every path."""
+
+	origin = Flask(__name__)
+	origin.hits = collections.Counter()
+	origin.master = MASTER
+	lock = threading.Lock()
+	vod_text = bench.large_media_playlist_text(10)
+
+	def playlist(text):
+		with lock:
+			origin.hits[request.path] += 1
+		return (text, 200, { 'Content-Type': 'application/vnd.apple.mpegurl' })
+
+	@origin.route('/master.m3u8')
+	def master():
+		return playlist(origin.master)
+
+	@origin.route('/high.m3u8')
+	def live():
+		return playlist(vod_text.replace('#EXT-X-ENDLIST', ''))
+
+	@origin.route('/<name>.m3u8')
+	def vod(name):
+		return playlist(vod_text)
+
+	return origin
+
+class RefresherTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.saved = (dict(aliases.HLS), upstream.PLAYLIST_TTL)
+		self.origin = origin_with_variants()
+		self.server = serve.PooledWSGIServer('127.0.0.1', 0, self.origin, 4, handler = test_upstream.QuietHandler)
+		t = threading.Thread(target = self.server.serve_forever)
+		t.daemon = True
+		t.start()
+		self.master_url = 'http://127.0.0.1:%d/master.m3u8' % (self.server.server_port,)
+		aliases.HLS['warm'] = self.master_url
+		aliases.HLS['down'] = 'http://127.0.0.1:%d/missing/master.m3u8' % (self.server.server_port,)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		aliases.HLS.clear()
+		aliases.HLS.update(self.saved[0])
+		upstream.PLAYLIST_TTL = self.saved[1]
+
+	def test_alias_names(self):
+		self.assertEqual(warmup.alias_names(' Apple1, elephant,'), ['apple1', 'elephant'])
+		self.assertEqual(warmup.alias_names('all'), sorted(aliases.HLS.keys()))
+		self.assertEqual(warmup.alias_names(''), [])
+
+	def test_refresh(self):
+
+		upstream.PLAYLIST_TTL = 0.1
+		refresher = warmup.Refresher(['warm', 'down'], interval = 0.3, vod_interval = 0.5)
+		self.assertEqual(refresher.warm_up(), 4)
+		self.assertEqual(self.origin.hits, { '/master.m3u8': 1, '/low.m3u8': 1, '/high.m3u8': 1, '/audio.m3u8': 1 })
+
+		# The requests are served from the cache even after their own TTL.
+		time.sleep(0.2)
+		for path in ['/master.m3u8', '/low.m3u8', '/high.m3u8', '/audio.m3u8']:
+			snapshot, hit = upstream.get_snapshot(self.master_url.replace('/master.m3u8', path))
+			self.assertTrue(hit)
+		self.assertEqual(sum(self.origin.hits.values()), 4)
+
+		# Only the live playlist is due, the one that failed is retried later.
+		time.sleep(0.15)
+		self.assertEqual(refresher.refresh_due(), 1)
+		self.assertEqual(self.origin.hits['/high.m3u8'], 2)
+
+		# Then the master and VOD ones. New variants are loaded right away, removed ones are forgotten.
+		self.origin.master = MASTER.replace('low.m3u8', 'other.m3u8')
+		time.sleep(0.2)
+		self.assertEqual(refresher.refresh_due(), 3)
+		self.assertEqual(refresher.refresh_due(), 1)
+		self.assertEqual(self.origin.hits['/master.m3u8'], 2)
+		self.assertEqual(self.origin.hits['/other.m3u8'], 1)
+		self.assertEqual(self.origin.hits['/low.m3u8'], 2)
+		self.assertNotIn(self.master_url.replace('master', 'low'), refresher._due)
+
+		refresher.start()
+		time.sleep(0.7)
+		refresher.stop()
+		self.assertGreaterEqual(self.origin.hits['/high.m3u8'], 4)
+		self.assertEqual(self.origin.hits['/audio.m3u8'], 3)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,594 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Fetching of playlists from upstream (origin) servers.
+
+import cache
+import collections
+import cues
+import errno
+import hashlib
+import hmac
+import m3u
+import metrics
+import os
+import Queue
+import random
+import requests
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+# How long (seconds) the downloaded playlists can be reused. Should be well below the target duration of live streams.
+PLAYLIST_TTL = float(os.environ.get('HLSED_PLAYLIST_TTL', 1))
+
+# Expired playlists are still used for this long (seconds) while they are downloaded again in the background...
+PLAYLIST_STALE_TTL = float(os.environ.get('HLSED_PLAYLIST_STALE_WHILE_REVALIDATE', 3))
+# ...and for this long when downloading them fails (see cache.TieredCache.get_or_revalidate()).
+PLAYLIST_STALE_IF_ERROR_TTL = float(os.environ.get('HLSED_PLAYLIST_STALE_IF_ERROR', 30))
+# After a failure, the playlist is not downloaded again for this long (seconds): the requests meanwhile get
+# the stale version (or the same error) right away instead of trying one after another.
+PLAYLIST_ERROR_TTL = float(os.environ.get('HLSED_PLAYLIST_ERROR_TTL', 1))
+
+# Playlists are stored by the hash of their content along with their parsed (serialized) form, 
+# so unchanged playlists are not parsed again after they are downloaded again, even after a restart.
+# These never change, so can be kept as long as they fit the size limit.
+CONTENT_TTL = 7 * 24 * 3600
+CONTENT_MAX_BYTES = int(os.environ.get('HLSED_CONTENT_CACHE_BYTES', 256 * 1024 * 1024))
+
+# Segments (and keys, init sections) proxied via us, see get_segment(). These don't change either, 
+# but take a lot of space, so only the most recently used ones are kept in memory.
+SEGMENT_TTL = float(os.environ.get('HLSED_SEGMENT_TTL', 3600))
+SEGMENT_MEMORY_ITEMS = int(os.environ.get('HLSED_SEGMENT_MEMORY_ITEMS', 50))
+SEGMENT_MAX_BYTES = int(os.environ.get('HLSED_SEGMENT_CACHE_BYTES', 1024 * 1024 * 1024))
+# Larger segments are not passed via us. With the cache directory they are streamed to the disk as they come,
+# only the ones up to SEGMENT_MEMORY_MAX_SIZE are kept in memory as well.
+SEGMENT_MAX_SIZE = int(os.environ.get('HLSED_SEGMENT_MAX_SIZE', 64 * 1024 * 1024))
+SEGMENT_MEMORY_MAX_SIZE = 4 * 1024 * 1024
+SEGMENT_CHUNK_SIZE = 64 * 1024
+
+# The URLs of segments passed via us are signed with this secret (see segment_signature()), so we only fetch
+# what our own playlists refer to. It should be the same for all the processes serving the same playlists:
+# when it's not set, the one kept in the cache directory is used (see configure_cache()), or a random one.
+segment_secret = os.environ.get('HLSED_SEGMENT_SECRET') or os.urandom(32).encode('hex')
+
+# Playlist URL -> the hash of the content most recently downloaded from it (with the time it expires).
+playlist_digests = cache.TieredCache(cache.MemoryCache())
+# Content hash -> a tuple with the text of the playlist and its serialized parsed form (see m3u.dumps()).
+playlist_contents = cache.TieredCache(cache.MemoryCache(max_items = 100))
+# Content hash -> an immutable parsed playlist (m3u.Snapshot) shared by all the threads of this process.
+snapshots = cache.MemoryCache(max_items = 100)
+# Segment URL -> a tuple with the content type and the body of the segment.
+segments = cache.TieredCache(cache.MemoryCache(max_items = SEGMENT_MEMORY_ITEMS))
+
+def configure_cache(directory = None):
+	"""
+	Sets up the caches of upstream playlists, using the given directory for the tier shared between processes
+	and persisted across restarts.
+	"""
+	global playlist_digests, playlist_contents, segments, segment_secret
+	if directory:
+		playlist_digests = cache.TieredCache(
+			cache.MemoryCache(), 
+			cache.DiskCache(os.path.join(directory, 'playlists'))
+		)
+		playlist_contents = cache.TieredCache(
+			cache.MemoryCache(max_items = 100), 
+			cache.DiskCache(os.path.join(directory, 'contents'), max_bytes = CONTENT_MAX_BYTES)
+		)
+		segments = cache.TieredCache(
+			cache.MemoryCache(max_items = SEGMENT_MEMORY_ITEMS),
+			cache.DiskCache(os.path.join(directory, 'segments'), max_bytes = SEGMENT_MAX_BYTES)
+		)
+		# (The directory exists now.)
+		if not os.environ.get('HLSED_SEGMENT_SECRET'):
+			segment_secret = _shared_secret(os.path.join(directory, 'segment-secret'))
+	else:
+		playlist_digests = cache.TieredCache(cache.MemoryCache())
+		playlist_contents = cache.TieredCache(cache.MemoryCache(max_items = 100))
+		segments = cache.TieredCache(cache.MemoryCache(max_items = SEGMENT_MEMORY_ITEMS))
+
+def _shared_secret(path):
+	# The first process creates it, all at once, the others read it.
+	try:
+		with open(path, 'rb') as f:
+			return f.read()
+	except IOError as e:
+		if e.errno != errno.ENOENT:
+			raise
+	fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(path), prefix = '.tmp-')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(os.urandom(32).encode('hex'))
+		os.link(temp_path, path)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+	finally:
+		os.remove(temp_path)
+	with open(path, 'rb') as f:
+		return f.read()
+
+# Timeouts (seconds) for connecting to upstream hosts and for waiting for the next bytes of their responses.
+CONNECT_TIMEOUT = float(os.environ.get('HLSED_UPSTREAM_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('HLSED_UPSTREAM_READ_TIMEOUT', 5))
+
+# How many times a request is retried after a connection error, a timeout or a response with one of RETRY_STATUSES.
+RETRIES = int(os.environ.get('HLSED_UPSTREAM_RETRIES', 2))
+# The upper bound of the random delay (seconds) before the first retry, doubled for every next one.
+RETRY_BACKOFF = float(os.environ.get('HLSED_UPSTREAM_RETRY_BACKOFF', 0.1))
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# If positive, then when a playlist takes longer than this percentile of the recent latencies of its host,
+# a second request for it is sent and whichever response comes first is used (a "hedged" request).
+HEDGE_PERCENTILE = float(os.environ.get('HLSED_UPSTREAM_HEDGE_PERCENTILE', 0))
+# Hedging is never sooner than this (seconds), and only once there are enough latencies to go by.
+HEDGE_MIN_DELAY = float(os.environ.get('HLSED_UPSTREAM_HEDGE_MIN_DELAY', 0.05))
+HEDGE_MIN_SAMPLES = 20
+
+# At most this many requests (per process) are sent to a single upstream host at a time, 0 for no limit,
+# so a slow origin cannot take up all the threads. The others wait for their turn...
+MAX_CONCURRENCY = int(os.environ.get('HLSED_UPSTREAM_MAX_CONCURRENCY', 16))
+# ...in a queue of up to this many requests, for up to this long (seconds), then they fail with Overloaded.
+MAX_QUEUED = int(os.environ.get('HLSED_UPSTREAM_MAX_QUEUED', 64))
+QUEUE_TIMEOUT = float(os.environ.get('HLSED_UPSTREAM_QUEUE_TIMEOUT', 1))
+# How long (seconds) the clients of the requests failed that way are asked to wait before trying again.
+RETRY_AFTER = int(os.environ.get('HLSED_RETRY_AFTER', 1))
+
+PLAYLIST_CONTENT_TYPES = ['application/vnd.apple.mpegurl', 'audio/mpegurl', 'vnd.apple.mpegurl', 'application/x-mpegurl']
+
+def host_of(url):
+	return urlparse.urlparse(url).netloc
+
+class Latencies:
+
+	"""The most recent latencies (seconds) of every upstream host, to know when requests take unusually long."""
+
+	def __init__(self, size = 200):
+		self.size = size
+		self._hosts = {}
+		self._lock = threading.Lock()
+
+	def add(self, host, seconds):
+		with self._lock:
+			latencies = self._hosts.get(host)
+			if latencies is None:
+				latencies = self._hosts[host] = collections.deque(maxlen = self.size)
+			latencies.append(seconds)
+
+	def percentile(self, host, p, min_samples = 1):
+		"""The given percentile (0-100) of the latencies of the host or None, if there are not enough of them."""
+		with self._lock:
+			latencies = sorted(self._hosts.get(host, ()))
+		if not latencies or len(latencies) < min_samples:
+			return None
+		return latencies[min(len(latencies) - 1, max(0, int(len(latencies) * p / 100.0 + 0.5) - 1))]
+
+latencies = Latencies()
+
+class Overloaded(Exception):
+	"""Raised when a request to an upstream host cannot be sent because of the limits (see HostLimits)."""
+	def __init__(self, message, retry_after = None):
+		Exception.__init__(self, message)
+		self.retry_after = RETRY_AFTER if retry_after is None else retry_after
+
+class HostLimits:
+
+	"""
+	Limits the number of concurrent requests per upstream host: those over the limit wait for their turn
+	in the order they came, unless there are too many of them waiting already or they wait for too long,
+	in which case Overloaded is raised.
+	"""
+
+	def __init__(self, max_concurrency, max_queued, queue_timeout):
+		self.max_concurrency = max_concurrency
+		self.max_queued = max_queued
+		self.queue_timeout = queue_timeout
+		self._condition = threading.Condition()
+		# Host -> the number of the requests in progress and the queue of the ones waiting (their events).
+		self._active = collections.defaultdict(int)
+		self._queues = collections.defaultdict(collections.deque)
+
+	def acquire(self, host):
+
+		if self.max_concurrency <= 0:
+			return
+		started = time.time()
+		with self._condition:
+			queue = self._queues[host]
+			if self._active[host] < self.max_concurrency and not queue:
+				self._active[host] += 1
+				return
+			if len(queue) >= self.max_queued:
+				metrics.UPSTREAM_REJECTED.inc((host, 'queue_full'))
+				raise Overloaded("Too many requests to '%s' are waiting already" % (host,))
+			turn = threading.Event()
+			queue.append(turn)
+		# Python 2 waits for conditions by polling, so every request waits for its own event instead.
+		turn.wait(self.queue_timeout)
+		with self._condition:
+			if not turn.is_set():
+				queue.remove(turn)
+				self._forget(host)
+				metrics.UPSTREAM_REJECTED.inc((host, 'queue_timeout'))
+				raise Overloaded("Waited for a request to '%s' for too long" % (host,))
+		# The slot was handed over by release().
+		metrics.UPSTREAM_QUEUE_SECONDS.observe(time.time() - started, (host,))
+
+	def release(self, host):
+		if self.max_concurrency <= 0:
+			return
+		with self._condition:
+			queue = self._queues[host]
+			if queue:
+				queue.popleft().set()
+			else:
+				self._active[host] -= 1
+				self._forget(host)
+
+	def _forget(self, host):
+		# There are many hosts, only the busy ones are kept.
+		if not self._queues[host]:
+			del self._queues[host]
+			if self._active[host] <= 0:
+				del self._active[host]
+
+	def busy(self, host):
+		"""A tuple with the number of the requests to the given host in progress and the ones waiting."""
+		with self._condition:
+			return self._active.get(host, 0), len(self._queues.get(host, ()))
+
+limits = HostLimits(MAX_CONCURRENCY, MAX_QUEUED, QUEUE_TIMEOUT)
+
+def _get(url, host, stream = False):
+
+	# A single request with retries, every attempt is recorded separately. Streamed bodies are counted by the caller.
+	attempt = 0
+	while True:
+		# Every attempt waits for its turn, so retries and hedged requests don't exceed the limits either.
+		limits.acquire(host)
+		started = metrics.clock()
+		streaming = False
+		try:
+			r = requests.get(url, timeout = (CONNECT_TIMEOUT, READ_TIMEOUT), stream = stream)
+		except Exception as e:
+			metrics.UPSTREAM_RESPONSES.inc((host, 'error'))
+			if not isinstance(e, (requests.ConnectionError, requests.Timeout)) or attempt >= RETRIES:
+				raise
+		else:
+			metrics.UPSTREAM_RESPONSES.inc((host, str(r.status_code)))
+			if not stream:
+				metrics.UPSTREAM_BYTES_IN.inc((host,), len(r.content))
+			if r.status_code not in RETRY_STATUSES or attempt >= RETRIES:
+				latencies.add(host, metrics.clock() - started)
+				if stream:
+					# The body is still to be downloaded, so the turn is over only when it's closed.
+					_release_on_close(r, host)
+					streaming = True
+				return r
+			r.close()
+		finally:
+			if not streaming:
+				limits.release(host)
+			metrics.UPSTREAM_SECONDS.observe(metrics.clock() - started, (host,))
+		
+		# "Full jitter", so clients failing at the same time don't retry at the same time.
+		time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+		attempt += 1
+		metrics.UPSTREAM_RETRIES.inc((host,))
+
+def _release_on_close(r, host):
+	close = r.close
+	released = []
+	def close_and_release():
+		try:
+			close()
+		finally:
+			if not released:
+				released.append(True)
+				limits.release(host)
+	r.close = close_and_release
+
+def _hedged_get(url, host, delay):
+
+	# Both requests run in their own threads, the slower one is left to finish (or time out) by itself.
+	results = Queue.Queue()
+	def run():
+		try:
+			results.put((_get(url, host), None))
+		except Exception:
+			results.put((None, sys.exc_info()))
+	
+	def start():
+		t = threading.Thread(target = run)
+		t.daemon = True
+		t.start()
+	
+	start()
+	try:
+		r, error = results.get(timeout = delay)
+	except Queue.Empty:
+		metrics.UPSTREAM_HEDGES.inc((host,))
+		start()
+		r, error = results.get()
+		if error is not None:
+			# The other one still has a chance.
+			r, other_error = results.get()
+			if other_error is None:
+				error = None
+	if error is not None:
+		raise error[0], error[1], error[2]
+	return r
+
+def fetch(url, hedged = False, stream = False):
+
+	"""
+	Downloads whatever is at `url` recording the metrics of the upstream host along the way.
+	Returns the response (requests.Response) or raises an exception when it is not successful.
+	With `stream` the body is left to be read (and counted in UPSTREAM_BYTES_IN) by the caller, which should close
+	the response then, as the request counts towards the limits of the host till then.
+	
+	Requests are limited by CONNECT_TIMEOUT and READ_TIMEOUT and retried up to RETRIES times. They wait for their turn
+	when there are too many of them to the same host (see `limits`) and fail with Overloaded when it takes too long.
+	With `hedged` (and HEDGE_PERCENTILE set), a second request is sent when the first one takes unusually long.
+	"""
+
+	host = host_of(url)
+	delay = None
+	if hedged and HEDGE_PERCENTILE > 0:
+		delay = latencies.percentile(host, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+	if delay is not None:
+		r = _hedged_get(url, host, max(delay, HEDGE_MIN_DELAY))
+	else:
+		r = _get(url, host, stream)
+
+	if not r.ok:
+		r.close()
+	r.raise_for_status()
+	return r
+
+def fetch_playlist(playlist_url):
+
+	"""
+	Downloads an HLS playlist from `playlist_url` and returns its text.
+	Raises an exception when the response is not successful or does not look like a playlist.
+	"""
+
+	r = fetch(playlist_url, hedged = True)
+	content_type = r.headers.get('content-type')
+	if content_type not in PLAYLIST_CONTENT_TYPES:
+		raise Exception("The playlist has unsupported content type ('%s')" % (content_type,))
+
+	return r.text
+
+def digest_of(text):
+	if isinstance(text, unicode):
+		text = text.encode('utf_8')
+	return hashlib.sha1(text).hexdigest()
+
+def parse_playlist(text):
+	"""The given playlist parsed, with the upstream ad cues prepared for re-presenting it (see cues.retime())."""
+	return cues.retime(m3u.Playlist(text))
+
+def _lap(timer):
+	def lap(name, desc = None):
+		if timer:
+			timer.lap(name, desc)
+	return lap
+
+def _fetch_digest(playlist_url, lap, parsed):
+	text = fetch_playlist(playlist_url)
+	lap('fetch', 'miss')
+	digest = digest_of(text)
+	if playlist_contents.get(digest) is None:
+		# Storing the content before the URL refers to it, so other processes can always find it.
+		playlist = parse_playlist(text)
+		playlist_contents.set(digest, (text, m3u.dumps(playlist)), CONTENT_TTL)
+		parsed.append(playlist)
+		lap('parse', 'miss')
+	return digest
+
+def _get_digest(playlist_url, lap, parsed):
+
+	def revalidate():
+		# Nobody is waiting for this, so let's prepare the new version for the next requests as well.
+		revalidated = []
+		digest = _fetch_digest(playlist_url, _lap(None), revalidated)
+		if snapshots.get(digest) is None:
+			_snapshot(playlist_url, digest, _lap(None), revalidated)
+		return digest
+
+	digest, hit, stale = playlist_digests.get_or_revalidate(
+		playlist_url, PLAYLIST_TTL, lambda: _fetch_digest(playlist_url, lap, parsed),
+		max_stale = PLAYLIST_STALE_TTL,
+		max_stale_if_error = PLAYLIST_STALE_IF_ERROR_TTL,
+		revalidate = revalidate,
+		error_ttl = PLAYLIST_ERROR_TTL
+	)
+	metrics.record_cache('upstream', hit)
+	if stale:
+		metrics.UPSTREAM_STALE.inc((host_of(playlist_url), stale))
+	if hit:
+		lap('fetch', 'stale' if stale else 'hit')
+	return digest, hit
+
+def get_digest(playlist_url, timer = None):
+	"""
+	Returns a tuple with the hash of the content of the playlist from `playlist_url` and True if it was downloaded 
+	recently enough to be taken from the cache. This is cheap when cached, so can be used to see if the playlist 
+	has changed without parsing it. 
+	"""
+	return _get_digest(playlist_url, _lap(timer), [])
+
+def get_playlist(playlist_url, timer = None):
+
+	"""
+	Returns a tuple with the playlist from `playlist_url` parsed (m3u.Playlist) and True if it was downloaded recently 
+	enough to be taken from the cache. The playlist is not shared with anyone, so it can be modified. 
+	
+	The time spent is recorded as 'fetch' and 'parse' stages of the `timer`, if provided.
+	"""
+	
+	lap = _lap(timer)
+	parsed = []
+	digest, hit = _get_digest(playlist_url, lap, parsed)
+	return _parsed_playlist(playlist_url, digest, lap, parsed), hit
+
+def _parsed_playlist(playlist_url, digest, lap, parsed):
+	
+	if parsed:
+		metrics.record_cache('parsed', False)
+		return parsed[0]
+		
+	content = playlist_contents.get(digest)
+	metrics.record_cache('parsed', content is not None)
+	if content is not None:
+		playlist = m3u.loads(content[1])
+	else:
+		# Could have been evicted in the meantime, which should be rare.
+		text = fetch_playlist(playlist_url)
+		playlist = parse_playlist(text)
+		playlist_contents.set(digest_of(text), (text, m3u.dumps(playlist)), CONTENT_TTL)
+	lap('parse', 'hit' if content is not None else 'miss')
+	
+	return playlist
+
+def get_snapshot(playlist_url, timer = None):
+
+	"""
+	Like get_playlist(), but returns an immutable version of the playlist (m3u.Snapshot), which is parsed 
+	only once per process for every version of the playlist. Use m3u.View to transform it.
+	"""
+
+	lap = _lap(timer)
+	parsed = []
+	digest, hit = _get_digest(playlist_url, lap, parsed)
+	
+	snapshot = snapshots.get(digest)
+	metrics.record_cache('snapshot', snapshot is not None)
+	if snapshot is not None:
+		lap('parse', 'hit')
+		return snapshot, hit
+	
+	return _snapshot(playlist_url, digest, lap, parsed), hit
+
+def refresh_snapshot(playlist_url, ttl):
+
+	"""
+	Downloads the playlist from `playlist_url` ahead of the requests (unless another process has just done it),
+	so get_snapshot() finds it fresh for the next `ttl` seconds. Returns its snapshot.
+	"""
+
+	parsed = []
+	digest = playlist_digests.refresh(
+		playlist_url, ttl, lambda: _fetch_digest(playlist_url, _lap(None), parsed),
+		max_stale = PLAYLIST_STALE_TTL,
+		max_stale_if_error = PLAYLIST_STALE_IF_ERROR_TTL
+	)
+	snapshot = snapshots.get(digest)
+	if snapshot is None:
+		snapshot = _snapshot(playlist_url, digest, _lap(None), parsed)
+	return snapshot
+
+def _snapshot(playlist_url, digest, lap, parsed):
+	snapshot = m3u.Snapshot(_parsed_playlist(playlist_url, digest, lap, parsed))
+	snapshots.set(digest, snapshot, CONTENT_TTL)
+	return snapshot
+
+class SegmentTooLarge(Exception):
+	pass
+
+def segment_signature(segment_url):
+	"""The signature of a segment URL passed via us (see hlsed.RebaseStage), for the current `segment_secret`."""
+	if isinstance(segment_url, unicode):
+		segment_url = segment_url.encode('utf_8')
+	return hmac.new(segment_secret, segment_url, hashlib.sha256).hexdigest()[:32]
+
+def is_signed_segment(segment_url, signature):
+	if isinstance(signature, unicode):
+		signature = signature.encode('utf_8')
+	return hmac.compare_digest(segment_signature(segment_url), signature or '')
+
+def get_segment(segment_url):
+
+	"""
+	Returns a tuple with the content type, the body of the segment (or a key, or an init section) at `segment_url` 
+	and its size, and True if it was taken from the cache. Concurrent requests for the same segment result 
+	in a single download.
+	
+	The body is either a string or, for larger segments in the cache directory, the file it's stored in positioned 
+	at the beginning of the body, which should be closed by the caller. Raises ValueError for URLs that are not 
+	HTTP(S) and SegmentTooLarge for segments larger than SEGMENT_MAX_SIZE.
+	"""
+
+	if urlparse.urlparse(segment_url).scheme.lower() not in ['http', 'https']:
+		raise ValueError("Only HTTP(S) segments can be passed")
+
+	segment = segments.memory.get(segment_url)
+	if segment is not None:
+		metrics.record_cache('segment', True)
+		return (segment[0], segment[1], len(segment[1])), True
+
+	if segments.disk is None:
+		with segments.locked(segment_url):
+			segment = segments.memory.get(segment_url)
+			hit = segment is not None
+			if not hit:
+				segment = _download_segment(segment_url, None)
+				# Larger ones would take too much memory.
+				if len(segment[1]) <= SEGMENT_MEMORY_MAX_SIZE:
+					segments.memory.set(segment_url, segment, SEGMENT_TTL)
+		metrics.record_cache('segment', hit)
+		return (segment[0], segment[1], len(segment[1])), hit
+
+	hit = True
+	entry = segments.disk.get_file(segment_url)
+	if entry is None:
+		with segments.locked(segment_url):
+			# Someone could have downloaded it while we were waiting for the lock.
+			entry = segments.disk.get_file(segment_url)
+			if entry is None:
+				hit = False
+				_download_segment(segment_url, segments.disk)
+				entry = segments.disk.get_file(segment_url)
+	metrics.record_cache('segment', hit)
+	if entry is None:
+		raise Exception("The segment was removed from the cache right away")
+
+	expires, content_type, f, size = entry
+	if size > SEGMENT_MEMORY_MAX_SIZE:
+		return (content_type, f, size), hit
+	try:
+		data = f.read(size)
+	finally:
+		f.close()
+	segments.memory.set(segment_url, (content_type, data), expires - time.time())
+	return (content_type, data, size), hit
+
+def _download_segment(segment_url, disk):
+
+	# The body is streamed into the disk cache, if given, otherwise returned with the content type.
+	host = host_of(segment_url)
+	r = fetch(segment_url, stream = True)
+	try:
+		content_type = r.headers.get('content-type', 'application/octet-stream')
+		if int(r.headers.get('content-length') or 0) > SEGMENT_MAX_SIZE:
+			raise SegmentTooLarge("The segment is larger than %d bytes" % (SEGMENT_MAX_SIZE,))
+
+		def chunks():
+			size = 0
+			for chunk in r.iter_content(SEGMENT_CHUNK_SIZE):
+				size += len(chunk)
+				metrics.UPSTREAM_BYTES_IN.inc((host,), len(chunk))
+				# The length could be missing or wrong.
+				if size > SEGMENT_MAX_SIZE:
+					raise SegmentTooLarge("The segment is larger than %d bytes" % (SEGMENT_MAX_SIZE,))
+				yield chunk
+
+		if disk is None:
+			return (content_type, ''.join(chunks()))
+		disk.set_file(segment_url, content_type, chunks(), SEGMENT_TTL)
+	finally:
+		r.close()
@@ -0,0 +1,176 @@
+# HLS tools.
+# Copyright (C) 2021, MediaMonks B.V. All rights reserved.
+
+# Keeps the well-known example streams (aliases.HLS) warm: their master playlists and all the variants are loaded
+# into the caches when a worker starts and then refreshed in the background ahead of the requests, so sessions
+# using the aliases never wait for the origins (see upstream.refresh_snapshot()).
+#
+# Live playlists are refreshed every WARM_INTERVAL seconds, VOD ones (with EXT-X-ENDLIST) and master playlists,
+# which hardly ever change, every WARM_VOD_INTERVAL.
+# The refreshes are shared by the worker processes via the cache directory, so adding workers does not multiply
+# the traffic to the origins.
+
+import aliases
+import hlsed
+import logging
+import metrics
+import multiprocessing.pool
+import os
+import threading
+import time
+import upstream
+
+# The aliases to keep warm (comma-separated), or 'all' of them. None by default (serve.py sets it).
+WARM_ALIASES = os.environ.get('HLSED_WARM_ALIASES', '')
+
+# How often (seconds) live and VOD (and master) playlists are refreshed.
+WARM_INTERVAL = float(os.environ.get('HLSED_WARM_INTERVAL', upstream.PLAYLIST_TTL))
+WARM_VOD_INTERVAL = float(os.environ.get('HLSED_WARM_VOD_INTERVAL', 60))
+
+# The number of playlists refreshed concurrently, so a slow origin does not hold up the others.
+WARM_THREADS = 4
+
+_logger = logging.getLogger(__name__)
+
+def alias_names(value):
+	"""The names of the aliases listed in `value` (comma-separated or 'all')."""
+	if value.strip().lower() == 'all':
+		return sorted(aliases.HLS.keys())
+	return filter(None, map(lambda name: name.strip().lower(), value.split(',')))
+
+def variant_urls(master_url, snapshot):
+	"""The absolute URLs of the variants and renditions of the given master playlist (m3u.Snapshot)."""
+	rebaser = hlsed.Rebaser(master_url)
+	urls = map(lambda (uri, tags): rebaser.absolute(uri), snapshot.uris)
+	for tag in snapshot.globals:
+		if tag.name in ['EXT-X-MEDIA', 'EXT-X-I-FRAME-STREAM-INF'] and tag.attributes and 'URI' in tag.attributes:
+			urls.append(rebaser.absolute(tag.attributes['URI'].value))
+	return urls
+
+def _rarely_changes(snapshot):
+	return snapshot.is_master_playlist or any(map(lambda tag: tag.name == 'EXT-X-ENDLIST', snapshot.globals))
+
+class Refresher:
+
+	"""
+	Loads the playlists of the given aliases and their variants and then keeps refreshing them, each one
+	a bit before it expires in the cache.
+	"""
+
+	def __init__(self, names, interval = None, vod_interval = None, threads = WARM_THREADS):
+		self.names = names
+		self.interval = WARM_INTERVAL if interval is None else interval
+		self.vod_interval = WARM_VOD_INTERVAL if vod_interval is None else vod_interval
+		self._pool = multiprocessing.pool.ThreadPool(threads)
+		# Playlist URL -> the alias and the time it should be refreshed next.
+		self._due = {}
+		# Master playlist URL -> the URLs of its variants.
+		self._variants = {}
+		# The URLs of the playlists refreshed every `vod_interval`.
+		self._rarely_changing = set()
+		# Playlist URL -> the number of the refreshes that failed in a row.
+		self._failures = {}
+		self._stopped = threading.Event()
+		self._thread = None
+
+	def warm_up(self):
+		"""Loads all the playlists, the master ones first, returns the number of the ones loaded."""
+		masters = map(lambda name: (aliases.resolve_hls(name), name), self.names)
+		return self._refresh(masters) + self._refresh(self._due_now())
+
+	def refresh_due(self):
+		"""Refreshes the playlists that are due, returns the number of the ones refreshed."""
+		return self._refresh(self._due_now())
+
+	def _due_now(self):
+		now = time.time()
+		return [(url, name) for url, (name, due) in self._due.items() if due <= now]
+
+	def _refresh(self, playlists):
+
+		def refresh((url, name)):
+			interval = self.vod_interval if url in self._rarely_changing else self.interval
+			try:
+				# Fresh in the cache till a while after the next refresh, in case that one is late.
+				return upstream.refresh_snapshot(url, 2 * interval)
+			except Exception as e:
+				_logger.warning("Could not refresh '%s' of '%s': %s", url, name, e)
+				return None
+
+		snapshots = self._pool.map(refresh, playlists)
+
+		now = time.time()
+		for (url, name), snapshot in zip(playlists, snapshots):
+			metrics.WARM_REFRESHES.inc((name, 'error' if snapshot is None else 'ok'))
+			if snapshot is None:
+				# The stale version is used meanwhile (if any), the origin is given more time after every failure.
+				failures = self._failures[url] = self._failures.get(url, 0) + 1
+				self._due[url] = (name, now + min(self.interval * 2 ** failures, self.vod_interval))
+				continue
+			self._failures.pop(url, None)
+			if _rarely_changes(snapshot):
+				self._rarely_changing.add(url)
+			else:
+				self._rarely_changing.discard(url)
+			self._due[url] = (name, now + (self.vod_interval if url in self._rarely_changing else self.interval))
+
+		# After the above, so the variants removed from the master playlists are not scheduled again.
+		for (url, name), snapshot in zip(playlists, snapshots):
+			if snapshot is not None and snapshot.is_master_playlist:
+				self._update_variants(url, name, variant_urls(url, snapshot))
+
+		return len(filter(None, snapshots))
+
+	def _update_variants(self, master_url, name, urls):
+		previous = self._variants.get(master_url, set())
+		for url in previous.difference(urls):
+			self._due.pop(url, None)
+			self._rarely_changing.discard(url)
+			self._failures.pop(url, None)
+		for url in set(urls).difference(previous):
+			self._due[url] = (name, 0)
+		self._variants[master_url] = set(urls)
+
+	def start(self):
+		"""Keeps refreshing the playlists in a background thread."""
+		self._thread = threading.Thread(target = self._run, name = 'Refresher')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		if self._thread is not None:
+			self._thread.join()
+		self._pool.close()
+
+	def _run(self):
+		while not self._stopped.is_set():
+			try:
+				self.refresh_due()
+			except Exception:
+				_logger.exception("Refreshing the warm playlists failed")
+			due = min(map(lambda (name, t): t, self._due.values()) or [time.time() + self.interval])
+			self._stopped.wait(min(max(due - time.time(), 0.01), self.interval))
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+def start(warm_up = False):
+
+	"""
+	Starts refreshing the playlists of WARM_ALIASES in this process, if any and unless it's been started already.
+	With `warm_up` the playlists are loaded before returning (which takes about as long as the slowest origin).
+	"""
+
+	global _refresher
+	names = alias_names(WARM_ALIASES)
+	with _refresher_lock:
+		if _refresher is not None or not names:
+			return _refresher
+		_refresher = Refresher(names)
+	if warm_up:
+		started = time.time()
+		count = _refresher.warm_up()
+		_logger.info("Warmed up %d playlist(s) of %s in %.2fs", count, ", ".join(names), time.time() - started)
+	_refresher.start()
+	return _refresher